@@ -0,0 +1,182 @@
+import asyncio
+import time
+import serial
+
+
+class AsyncIngestor:
+    def __init__(self, tracker, poll_interval=0.01):
+        """Concurrent BLE + GPS ingestion for a CombinedTracker on one event loop
+
+        Both serial file descriptors are watched with loop.add_reader and
+        switched to non-blocking reads, so each stream is decoded as soon as
+        bytes arrive: BLE frames go through the tracker's frame scanner and
+        _process_frame, NMEA lines through _handle_gps_line into the shared
+        last_gps_data. Ports without a file descriptor (e.g. replay sources)
+        are polled every poll_interval seconds instead; an exhausted replay
+        ends ingestion and an as-fast-as-possible replay is stepped chunk by
+        chunk. The tracker's AdaptiveScheduler, if any, is updated from the
+        loop as well. A GPS port that fails (e.g. an unplugged USB receiver)
+        stops being read and buffers go on with the last known position.
+        """
+        self.tracker = tracker
+        self.poll_interval = poll_interval
+        self.buffers_processed = 0
+        self._gps_line = bytearray()
+        self._done = None
+        self._loop = None
+        self._gps_fd = None
+        self._gps_stopped = False
+        self._saved_timeouts = {}
+        self._polls = []
+        self._polled = []  # (port, handler) pairs without a file descriptor
+
+    async def run(self, duration=None):
+        """Ingest until duration elapses, the BLE port fails or the task is cancelled"""
+        tracker = self.tracker
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self._done = loop.create_future()
+
+        # The GPS port is drained by its reader callback, never by the BLE path
+        gps_polling, tracker.gps_polling = tracker.gps_polling, False
+        watched = []
+        try:
+            ports = [(tracker.serial, self._on_ble)]
+            if not tracker.gps_reader:
+                # Unless a GPSReader thread already owns the GPS port
+                ports.append((tracker.gps_ser, self._on_gps))
+            for port, handler in ports:
+                fd = self._fileno(port)
+                if fd is None:
+                    self._polled.append((port, handler))
+                    continue
+                self._saved_timeouts[port] = port.timeout
+                port.timeout = 0  # Non-blocking reads inside callbacks
+                loop.add_reader(fd, handler)
+                watched.append(fd)
+                if port is tracker.gps_ser:
+                    self._gps_fd = fd
+            if self._polled:
+                virtual = any(self._virtual_clock(port) for port, _ in self._polled)
+                self._every(loop, 0 if virtual else self.poll_interval, self._poll_ports)
+            if tracker.scheduler:
+                self._every(loop, tracker.scheduler.interval, tracker.scheduler.update)
+
+            tracker.logger.info("=== Iniciando recepción asíncrona de buffers combinados ===")
+            start = time.time()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._done), duration)
+            except asyncio.TimeoutError:
+                tracker.logger.info(f"Tiempo de ejecución ({duration}s) completado")
+            finally:
+                tracker.logger.info(
+                    f"Total de buffers procesados: {self.buffers_processed} "
+                    f"en {time.time() - start:.1f}s"
+                )
+        finally:
+            for fd in watched:
+                loop.remove_reader(fd)
+            for handle in self._polls:
+                handle.cancel()
+            for port, timeout in self._saved_timeouts.items():
+                port.timeout = timeout
+            tracker.gps_polling = gps_polling
+
+    @staticmethod
+    def _fileno(port):
+        try:
+            return port.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _virtual_clock(port):
+        """The ReplayClock of an as-fast-as-possible replay source, else None"""
+        clock = getattr(port, 'clock', None)
+        return clock if clock is not None and clock.speed is None else None
+
+    def _poll_ports(self):
+        """Fallback for ports without a file descriptor (e.g. replay sources)"""
+        for port, handler in self._polled:
+            handler(poll=True)
+        # A virtual clock only moves on when a reader waits for the next chunk
+        pending = [port for port, _ in self._polled
+                   if self._virtual_clock(port) and port.next_time is not None]
+        if pending and not any(port.in_waiting for port, _ in self._polled):
+            port = min(pending, key=lambda port: port.next_time)
+            port.clock.wait_until(port.next_time)
+
+    def _every(self, loop, interval, function):
+        """Call function now and then every interval seconds until ingestion stops"""
+        slot = len(self._polls)  # Only the pending handle is kept, for cancellation
+
+        def tick():
+            function()
+            if not self._done.done():
+                self._polls[slot] = loop.call_later(interval, tick)
+        self._polls.append(loop.call_soon(tick))
+
+    def _stop(self, error=None):
+        if not self._done.done():
+            if error:
+                self.tracker.logger.error(f"Error de comunicación serie: {error}")
+            self._done.set_result(error)
+
+    def _on_ble(self, poll=False):
+        """BLE port readable: feed the frame scanner and process complete frames"""
+        tracker = self.tracker
+        try:
+            if poll:
+                # No readiness signal: only take what is buffered, never wait in the loop
+                waiting = tracker.serial.in_waiting
+                if not waiting and getattr(tracker.serial, 'exhausted', False):
+                    tracker.logger.info("Captura reproducida por completo")
+                    self._stop()
+                    return
+                data = tracker.serial.read(waiting) if waiting else b''
+            else:
+                data = tracker.serial.read(tracker.serial.in_waiting or 1)
+            if not data:
+                return
+            tracker._rx_feed(data)
+            while True:
+                frame = tracker._rx_pop_frame()
+                if not frame:
+                    break
+                if tracker._process_frame(*frame):
+                    self.buffers_processed += 1
+        except serial.SerialException as e:
+            self._stop(e)
+        except Exception as e:
+            tracker.logger.error(f"Error inesperado: {e}")
+
+    def _on_gps(self, poll=False):
+        """GPS port readable: split NMEA lines and update the latest fix"""
+        tracker = self.tracker
+        port = tracker.gps_ser
+        if self._gps_stopped:
+            return
+        try:
+            waiting = port.in_waiting
+            if poll and not waiting:
+                if getattr(port, 'exhausted', False):
+                    self._gps_stopped = True  # End of the replayed GPS stream
+                return
+            self._gps_line += port.read(waiting or 1)
+            received_at = tracker._arrival(port)
+            while True:
+                end = self._gps_line.find(b'\n')
+                if end < 0:
+                    break
+                line = bytes(self._gps_line[:end + 1])
+                del self._gps_line[:end + 1]
+                try:
+                    tracker._handle_gps_line(line, received_at)
+                except Exception as e:
+                    tracker.logger.error(f"Error parseando GPS: {e}")
+        except serial.SerialException as e:
+            # A failed port stays readable and raises on every callback
+            tracker.logger.error(f"Error leyendo GPS, se deja de leer el puerto: {e}")
+            self._gps_stopped = True
+            if self._gps_fd is not None:
+                self._loop.remove_reader(self._gps_fd)
@@ -0,0 +1,283 @@
+"""Benchmark suite for the BLE/GPS ingestion pipeline
+
+Generates synthetic frames in the exact HEADER_FORMAT/DEVICE_FORMAT layout
+and reports frames per second and microseconds per device for each stage,
+as JSON, so runs on a Pi can be compared between changes.
+
+    python bench_ingest.py --macs 1 64 256 1024 --frames 200 --mongo mongomock
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from capture import CaptureWriter, ReplaySource, STREAM_BLE, STREAM_GPS
+from uart import UARTReceiver, frame_macs
+
+# 115200 baud, 8N1: 10 bits on the wire per byte
+LINK_BYTES_PER_S = 115200 / 10
+
+
+def make_frame(receiver, seq, n_mac, rng):
+    """Build one synthetic BLE buffer in the receiver's wire format"""
+    devices = bytearray()
+    n_adv_raw = 0
+    for _ in range(n_mac):
+        n_adv = rng.randint(1, 255)
+        n_adv_raw += n_adv
+        data_len = rng.randint(0, 31)
+        devices += rng.randbytes(6)                        # mac
+        devices += bytes((rng.randint(0, 3),               # addr_type
+                          rng.randint(0, 4),               # adv_type
+                          rng.randint(0, 255),             # rssi
+                          data_len))
+        devices += rng.randbytes(data_len) + bytes(31 - data_len)
+        devices.append(n_adv)
+    header = receiver.HEADER_STRUCT.pack(
+        receiver.HEADER_MAGIC, seq % 256, n_adv_raw & 0xFFFF, n_mac)
+    return header + bytes(devices)
+
+
+def read_fields(receiver, devices):
+    """Read every field of decoded devices, as the old eager decode did
+
+    BLEDevice records decode lazily, so timing the decode alone would
+    only measure slicing.
+    """
+    if receiver.frame_format == 'numpy':
+        return frame_macs(devices), devices.tolist()
+    return [device.to_dict() for device in devices]
+
+
+def make_garbage(rng, max_len=64):
+    """Random line noise, sometimes ending in a run of 0x55"""
+    garbage = rng.randbytes(rng.randint(1, max_len))
+    if rng.random() < 0.3:
+        garbage += b'\x55' * rng.randint(1, 4)
+    return garbage
+
+
+def make_rmc(rng):
+    """Valid $GPRMC sentence around a random position"""
+    body = (f"GPRMC,{rng.randint(0, 235959):06d}.00,A,"
+            f"{rng.randint(3600, 3700)}.{rng.randint(0, 99999):05d},N,"
+            f"{rng.randint(0, 600):05d}.{rng.randint(0, 99999):05d},W,"
+            f"{rng.uniform(0, 20):.2f},{rng.uniform(0, 360):.2f},180324,,,A")
+    checksum = 0
+    for char in body.encode('ascii'):
+        checksum ^= char
+    return f"${body}*{checksum:02X}\r\n".encode('ascii')
+
+
+def replay_source(path, stream, chunks):
+    """Write chunks to a capture file and replay them as fast as possible"""
+    writer = CaptureWriter(path)
+    for i, chunk in enumerate(chunks):
+        writer.write(stream, chunk, timestamp=float(i))
+    writer.close()
+    return ReplaySource(path, stream, speed=None)
+
+
+def timed(func, repeat):
+    """Run func repeat times, return elapsed seconds"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return time.perf_counter() - start
+
+
+def result(bench, n_mac, frames, devices, elapsed, frame_bytes=None, **extra):
+    """One machine-readable result row"""
+    row = {
+        'bench': bench,
+        'n_mac': n_mac,
+        'frames': frames,
+        'seconds': elapsed,
+        'frames_per_s': frames / elapsed if elapsed else None,
+        'us_per_device': elapsed / devices * 1e6 if devices else None,
+    }
+    if frame_bytes:
+        # How many times faster than a saturated 115200-baud link we are
+        link_fps = LINK_BYTES_PER_S / frame_bytes
+        row['link_frames_per_s'] = link_fps
+        row['link_headroom'] = row['frames_per_s'] / link_fps if elapsed else None
+    row.update(extra)
+    return row
+
+
+def bench_parsing(receiver, n_mac, n_frames, garbage_ratio, rng):
+    """Header, device, bulk decode and resync benchmarks for one frame size"""
+    frames = [make_frame(receiver, seq, n_mac, rng) for seq in range(n_frames)]
+    frame_bytes = len(frames[0])
+    rows = []
+
+    headers = [frame[:receiver.HEADER_LENGTH] for frame in frames]
+    elapsed = timed(lambda: [receiver._parse_header(h) for h in headers], 1)
+    rows.append(result('parse_header', n_mac, n_frames, n_frames * n_mac, elapsed, frame_bytes))
+
+    step = receiver.DEVICE_LENGTH
+    slices = [frame[i:i + step]
+              for frame in frames
+              for i in range(receiver.HEADER_LENGTH, len(frame), step)]
+    elapsed = timed(lambda: [receiver._parse_device(d).to_dict() for d in slices], 1)
+    rows.append(result('parse_device', n_mac, n_frames, len(slices), elapsed, frame_bytes))
+
+    payloads = [frame[receiver.HEADER_LENGTH:] for frame in frames]
+    elapsed = timed(
+        lambda: [read_fields(receiver, receiver._decode_devices(p)) for p in payloads], 1)
+    rows.append(result('decode_frame', n_mac, n_frames, n_frames * n_mac, elapsed, frame_bytes,
+                       frame_format=receiver.frame_format))
+
+    stream = bytearray()
+    for frame in frames:
+        if rng.random() < garbage_ratio:
+            stream += make_garbage(rng)
+        stream += frame
+    stream = bytes(stream)
+
+    def resync():
+        receiver._rx.clear()
+        receiver._rx_last_seq = None
+        receiver.resync_skipped = 0
+        found = 0
+        for i in range(0, len(stream), 4096):
+            receiver._rx_feed(stream[i:i + 4096])
+            while receiver._rx_pop_frame():
+                found += 1
+        return found
+
+    start = time.perf_counter()
+    found = resync()
+    elapsed = time.perf_counter() - start
+    rows.append(result('resync', n_mac, found, found * n_mac, elapsed, frame_bytes,
+                       frames_expected=n_frames,
+                       skipped_bytes=receiver.resync_skipped,
+                       stream_bytes=len(stream)))
+    return rows
+
+
+def bench_tracker(args, workdir, rng):
+    """_parse_gps and _store_buffer benchmarks on a CombinedTracker"""
+    from gps_ble_tracker import CombinedTracker
+
+    if args.mongo == 'mongomock':
+        import mongomock
+        client = mongomock.MongoClient()
+        # mongomock lacks the hello command that ingest marks read the server time from
+        client.tracking_bench.command = lambda name: {
+            'localTime': datetime.now(timezone.utc).replace(tzinfo=None)}
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(args.mongo)
+
+    n_sentences = args.frames * 4
+    gps = replay_source(os.path.join(workdir, 'gps.cap'), STREAM_GPS,
+                        [make_rmc(rng) for _ in range(n_sentences)])
+    ble = replay_source(os.path.join(workdir, 'ble.cap'), STREAM_BLE, [b'\x00'])
+
+    # 2-byte n_mac like the parsing benchmarks, so sizes above 255 fit the header
+    tracker = CombinedTracker(gps_port=gps, ble_port=ble, mongo_client=client,
+                              log_level='info', frame_format=args.frame_format,
+                              write_batch_size=args.write_batch, n_mac_bytes=2)
+    # Keep benchmark documents out of the production collection
+    tracker.collection = client.tracking_bench.portfinal
+    if tracker.writer:
+        tracker.writer.collection = tracker.collection
+    tracker.collection.drop()
+    rows = []
+
+    try:
+        def poll_gps():
+            # One sentence is due per poll: advance the replay clock past it
+            tracker._parse_gps()
+            gps.clock.wait_until(gps.clock.now() + 1.0)
+
+        elapsed = timed(poll_gps, n_sentences)
+        if tracker.nmea.sentences != n_sentences:
+            raise RuntimeError(
+                f"parse_gps parsed {tracker.nmea.sentences} of {n_sentences} sentences")
+        rows.append(result('parse_gps', None, n_sentences, 0, elapsed))
+
+        for n_mac in args.macs:
+            frames = [make_frame(tracker, seq, n_mac, rng) for seq in range(args.frames)]
+            decoded = [(tracker._parse_header(f[:tracker.HEADER_LENGTH]),
+                        tracker._decode_devices(f[tracker.HEADER_LENGTH:]))
+                       for f in frames]
+            start = time.perf_counter()
+            for header, devices in decoded:
+                tracker._store_buffer(header, devices)
+            if tracker.writer:
+                # Count the time until the batches are actually written
+                tracker.writer.flush()
+            elapsed = time.perf_counter() - start
+            stored = tracker.collection.count_documents({'sequence': {'$exists': True}})
+            tracker.collection.delete_many({})
+            if stored != len(frames):
+                raise RuntimeError(f"store_buffer stored {stored} of {len(frames)} buffers")
+            rows.append(result('store_buffer', n_mac, len(frames), len(frames) * n_mac,
+                               elapsed, len(frames[0]), mongo=args.mongo,
+                               write_batch=args.write_batch))
+    finally:
+        tracker.collection.drop()
+        tracker.close()
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the BLE/GPS ingestion pipeline")
+    parser.add_argument("--macs", type=int, nargs="+", default=[1, 16, 64, 256, 1024],
+                        help="MACs per frame to benchmark (default: 1 16 64 256 1024)")
+    parser.add_argument("--frames", type=int, default=200,
+                        help="Frames per size (default: 200)")
+    parser.add_argument("--garbage", type=float, default=0.1,
+                        help="Fraction of frames preceded by line noise (default: 0.1)")
+    parser.add_argument("--frame-format", choices=["dict", "numpy"], default="dict",
+                        help="Decoder output format (default: dict)")
+    parser.add_argument("--mongo", type=str, default=None,
+                        help="'mongomock' or a MongoDB URI to benchmark _parse_gps/_store_buffer")
+    parser.add_argument("--write-batch", type=int, default=100,
+                        help="BatchWriter batch size for store_buffer (0 = insert_one, default: 100)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--output", type=str, help="Write JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        ble = replay_source(os.path.join(workdir, 'idle.cap'), STREAM_BLE, [b'\x00'])
+        receiver = UARTReceiver(port=ble, frame_format=args.frame_format)
+        for n_mac in args.macs:
+            results.extend(bench_parsing(receiver, n_mac, args.frames, args.garbage, rng))
+        if args.mongo:
+            results.extend(bench_tracker(args, workdir, rng))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'frame_format': args.frame_format,
+            'frames': args.frames,
+            'garbage': args.garbage,
+            'seed': args.seed,
+            'link_bytes_per_s': LINK_BYTES_PER_S,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
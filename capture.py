@@ -0,0 +1,237 @@
+import struct
+import threading
+import time
+from collections import deque
+
+import serial
+
+# Segment file layout: CAPTURE_MAGIC followed by chunks of
+# CHUNK_HEADER (timestamp, stream id, length) + raw bytes
+CAPTURE_MAGIC = b'RPCAP\x01'
+CHUNK_HEADER = struct.Struct('<dBI')
+
+STREAM_BLE = 0
+STREAM_GPS = 1
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        """Open a capture segment file for appending (safe to share between threads)"""
+        self.path = path
+        self.file = open(path, 'ab')
+        self._lock = threading.Lock()
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+
+    def write(self, stream, data, timestamp=None):
+        """Append one timestamped chunk of raw bytes"""
+        if not data:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        # The BLE loop and the GPS thread share the writer: one chunk per write
+        chunk = CHUNK_HEADER.pack(timestamp, stream, len(data)) + bytes(data)
+        with self._lock:
+            self.file.write(chunk)
+
+    def close(self):
+        """Flush and close the segment file"""
+        with self._lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class CaptureTap:
+    def __init__(self, port, writer, stream):
+        """Wrap a serial port so every byte read from it is captured"""
+        self.port = port
+        self.writer = writer
+        self.stream = stream
+
+    @property
+    def in_waiting(self):
+        return self.port.in_waiting
+
+    @property
+    def is_open(self):
+        return self.port.is_open
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.port.timeout = value
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self.writer.write(self.stream, data)
+        return data
+
+    def readinto(self, buffer):
+        count = self.port.readinto(buffer)
+        if count:
+            self.writer.write(self.stream, bytes(buffer[:count]))
+        return count
+
+    def readline(self):
+        data = self.port.readline()
+        self.writer.write(self.stream, data)
+        return data
+
+    def close(self):
+        self.port.close()
+
+    def __getattr__(self, name):
+        # Anything else (fileno, baudrate, ...) goes to the real port
+        return getattr(self.port, name)
+
+
+def read_chunks(path, stream=None):
+    """Yield (timestamp, stream, data) chunks from a capture segment file"""
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                return
+            timestamp, chunk_stream, length = CHUNK_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # Truncated tail (capture interrupted mid-write)
+                return
+            if stream is None or chunk_stream == stream:
+                yield timestamp, chunk_stream, data
+
+
+class ReplayClock:
+    def __init__(self, origin, speed=1.0):
+        """Maps wall time onto capture time
+
+        speed is the replay rate relative to real time (e.g. 100 for 100x);
+        None replays as fast as possible, advancing capture time only when a
+        reader needs the next chunk.
+        """
+        self.origin = origin
+        self.speed = speed
+        self.virtual = origin
+        self.started = time.monotonic()
+
+    def now(self):
+        """Current capture time"""
+        if self.speed is None:
+            return self.virtual
+        return self.origin + (time.monotonic() - self.started) * self.speed
+
+    def wait_until(self, timestamp):
+        """Block until capture time reaches timestamp"""
+        if self.speed is None:
+            self.virtual = max(self.virtual, timestamp)
+            return
+        delay = (timestamp - self.now()) / self.speed
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ReplaySource:
+    def __init__(self, path, stream=STREAM_BLE, speed=1.0, clock=None):
+        """Serial-like source that replays one stream of a capture file
+
+        Offers the read/readinto/readline/in_waiting subset of serial.Serial
+        used by the trackers. Raises serial.SerialException from read() once
+        the capture is exhausted. arrival_time is the capture time of the
+        chunk holding the last byte returned, i.e. when it reached the port.
+        """
+        self.path = path
+        self.stream = stream
+        self._chunks = read_chunks(path, stream)
+        self._next = next(self._chunks, None)
+        if clock is None:
+            clock = ReplayClock(self._next[0] if self._next else 0.0, speed)
+        self.clock = clock
+        self._buffer = bytearray()
+        self._arrivals = deque()  # [capture time, bytes left] per buffered chunk
+        self.arrival_time = None
+        self.is_open = True
+
+    def _release(self):
+        """Move chunks whose capture time has passed into the read buffer"""
+        now = self.clock.now()
+        while self._next is not None and self._next[0] <= now:
+            self._buffer += self._next[2]
+            self._arrivals.append([self._next[0], len(self._next[2])])
+            self._next = next(self._chunks, None)
+
+    def _take(self, size):
+        """Remove size bytes from the read buffer, tracking when they arrived"""
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        left = len(data)
+        while left:
+            arrival = self._arrivals[0]
+            self.arrival_time = arrival[0]
+            used = min(left, arrival[1])
+            left -= used
+            arrival[1] -= used
+            if not arrival[1]:
+                self._arrivals.popleft()
+        return data
+
+    def _wait_next(self):
+        """Wait for the next chunk; False once the capture is exhausted"""
+        if self._next is None:
+            return False
+        self.clock.wait_until(self._next[0])
+        self._release()
+        return True
+
+    @property
+    def next_time(self):
+        """Capture time of the next chunk not yet released, None at the end"""
+        return self._next[0] if self._next is not None else None
+
+    @property
+    def exhausted(self):
+        return self._next is None and not self._buffer
+
+    @property
+    def in_waiting(self):
+        self._release()
+        return len(self._buffer)
+
+    def read(self, size=1):
+        self._release()
+        while len(self._buffer) < size and self._wait_next():
+            pass
+        if not self._buffer and self._next is None:
+            raise serial.SerialException(f"Replay of {self.path} finished")
+        return self._take(size)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        self._release()
+        while b'\n' not in self._buffer and self._wait_next():
+            pass
+        return self._take(self._buffer.find(b'\n') + 1 or len(self._buffer))
+
+    def close(self):
+        self.is_open = False
+
+    def __repr__(self):
+        return f"ReplaySource({self.path!r}, stream={self.stream})"
+
+
+def open_replay(path, speed=1.0):
+    """Open BLE and GPS replay sources for a capture, sharing one clock"""
+    first = next(read_chunks(path), None)
+    clock = ReplayClock(first[0] if first else 0.0, speed)
+    return (
+        ReplaySource(path, STREAM_BLE, clock=clock),
+        ReplaySource(path, STREAM_GPS, clock=clock),
+    )
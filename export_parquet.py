@@ -0,0 +1,242 @@
+import argparse
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pymongo import MongoClient
+
+from mongo_writer import server_time
+from rollups import EPOCH, ingested
+from schema import int_to_mac, is_compact
+
+# One row per device sighting
+SCHEMA = pa.schema([
+    ('timestamp', pa.timestamp('ms')),
+    ('receiver_id', pa.string()),
+    ('sequence', pa.int32()),
+    ('n_adv_raw', pa.int32()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('speed', pa.float64()),
+    ('gps_age', pa.float64()),
+    ('mac', pa.string()),
+    ('addr_type', pa.uint8()),
+    ('adv_type', pa.uint8()),
+    ('rssi', pa.int8()),
+    ('data_len', pa.uint8()),
+    ('n_adv', pa.uint8()),
+    ('data', pa.binary()),
+])
+
+CHECKPOINT_FILE = '_checkpoint.json'
+
+
+def device_rows(document):
+    """(mac, addr_type, adv_type, rssi, data_len, n_adv, data) per device, either schema"""
+    if is_compact(document):
+        for mac, addr_type, adv_type, rssi, n_adv, payload in zip(
+                document['macs'], document['addr_type'], document['adv_type'],
+                document['rssi'], document['n_adv'], document['payloads']):
+            yield int_to_mac(mac), addr_type, adv_type, rssi, len(payload), n_adv, bytes(payload)
+    else:
+        for device in document.get('devices', []):
+            data_len = min(device['data_len'], 31)
+            yield (device['mac'], device['addr_type'], device['adv_type'], device['rssi'],
+                   data_len, device['n_adv'], bytes.fromhex(device['data'])[:data_len])
+
+
+class ParquetExporter:
+    def __init__(self, collection, output_dir, batch_size=2000, row_group_rows=100000,
+                 compression='zstd', logger=None):
+        """Stream buffer documents into receiver/date partitioned Parquet files
+
+        Files are laid out as output_dir/receiver_id=<id>/date=<YYYY-MM-DD>/
+        part-<first timestamp>.parquet with one row per device. Documents are read with
+        a cursor of batch_size and written every row_group_rows rows, so
+        memory use does not depend on the exported range. Each run exports,
+        per receiver, the documents inserted (ingested_at) since the previous
+        run, in timestamp order, so buffers that reach the database late are
+        exported too, into a new file of their date. The insert-time mark per
+        receiver (server clock, like ingested_at) is kept in
+        output_dir/_checkpoint.json, together with the
+        last exported timestamp while a run is in progress; both are only
+        advanced once a partition file is complete, and files are written
+        under a temporary name until then.
+        """
+        self.collection = collection
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.row_group_rows = row_group_rows
+        self.compression = compression
+        self.logger = logger or logging.getLogger(__name__)
+        self.checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+        self.checkpoint = self._load_checkpoint()
+
+        # Current partition
+        self._writer = None
+        self._path = None
+        self._partition = None
+        self._run = None  # (since, upper) insert times of the receiver being exported
+        self._last_timestamp = None
+        self._columns = None
+        self.rows = 0
+        self.documents = 0
+
+    def export(self, receivers=None, until=None):
+        """Export documents inserted after each receiver's checkpoint and up to until"""
+        if receivers is None:
+            receivers = list(dict.fromkeys(self.collection.distinct('receiver_id') + [None]))
+        for receiver_id in receivers:
+            self.export_receiver(receiver_id, until)
+        self._save_checkpoint()
+        return self.rows
+
+    def export_receiver(self, receiver_id, until=None):
+        state = self.checkpoint.get(str(receiver_id)) or {}
+        since = datetime.fromisoformat(state['ingested']) if 'ingested' in state else EPOCH
+        query = {'receiver_id': receiver_id}
+        if 'until' in state:
+            # Resume an interrupted run where its last complete file ended
+            upper = datetime.fromisoformat(state['until'])
+            query['timestamp'] = {'$gt': datetime.fromisoformat(state['timestamp'])}
+        else:
+            upper = until or server_time(self.collection)
+        query.update(ingested(since, upper))
+        self._run = (since, upper)
+
+        cursor = self.collection.find(query, batch_size=self.batch_size).sort('timestamp', 1)
+        try:
+            for document in cursor:
+                partition = (receiver_id, document['timestamp'].date().isoformat())
+                if partition != self._partition:
+                    self._close_partition()
+                    self._open_partition(partition, document['timestamp'])
+                self._append(document)
+            self._close_partition()
+            self.checkpoint[str(receiver_id)] = {'ingested': upper.isoformat()}
+        finally:
+            cursor.close()
+            if self._writer:
+                # Interrupted: drop the incomplete file, the checkpoint is untouched
+                self._writer.close()
+                os.remove(self._path + '.tmp')
+                self._writer = None
+                self._partition = None
+
+    def _open_partition(self, partition, first_timestamp):
+        receiver_id, date = partition
+        directory = os.path.join(self.output_dir, f"receiver_id={receiver_id}", f"date={date}")
+        os.makedirs(directory, exist_ok=True)
+        # Named after its first row, so a re-run after a crash rewrites the same file
+        name = f"part-{first_timestamp:%Y%m%dT%H%M%S%f}.parquet"
+        self._path = os.path.join(directory, name)
+        self._writer = pq.ParquetWriter(self._path + '.tmp', SCHEMA, compression=self.compression)
+        self._partition = partition
+        self._columns = {field: [] for field in SCHEMA.names}
+
+    def _append(self, document):
+        gps = document.get('gps_data') or {}
+        coordinates = gps.get('coordinates') or {}
+        buffer_values = (
+            document['timestamp'], document.get('receiver_id'), document.get('sequence'),
+            document.get('n_adv_raw'), coordinates.get('latitude'), coordinates.get('longitude'),
+            gps.get('speed'), document.get('gps_age'),
+        )
+        columns = self._columns
+        buffer_fields = SCHEMA.names[:len(buffer_values)]
+        device_fields = SCHEMA.names[len(buffer_values):]
+        for row in device_rows(document):
+            for field, value in zip(buffer_fields, buffer_values):
+                columns[field].append(value)
+            for field, value in zip(device_fields, row):
+                columns[field].append(value)
+        self.documents += 1
+        self._last_timestamp = document['timestamp']
+        if len(columns['timestamp']) >= self.row_group_rows:
+            self._write_rows()
+
+    def _write_rows(self):
+        count = len(self._columns['timestamp'])
+        if not count:
+            return
+        self._writer.write_batch(pa.RecordBatch.from_pydict(self._columns, schema=SCHEMA))
+        self.rows += count
+        for values in self._columns.values():
+            values.clear()
+
+    def _close_partition(self):
+        if not self._writer:
+            return
+        self._write_rows()
+        self._writer.close()
+        self._writer = None
+        os.replace(self._path + '.tmp', self._path)
+        receiver_id = self._partition[0]
+        since, upper = self._run
+        self.checkpoint[str(receiver_id)] = {
+            'ingested': since.isoformat(),
+            'until': upper.isoformat(),
+            'timestamp': self._last_timestamp.isoformat(),
+        }
+        self._save_checkpoint()
+        self.logger.info(f"Exportado {self._path}")
+        self._partition = None
+
+    def _load_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                return json.load(f)
+        return {}
+
+    def _save_checkpoint(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.checkpoint, f, indent=2)
+        os.replace(tmp, self.checkpoint_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exporta portfinal a Parquet particionado por receptor y fecha")
+    parser.add_argument("--output", type=str, required=True, help="Directorio de salida")
+    parser.add_argument(
+        "--mongo-uri",
+        type=str,
+        default="mongodb://localhost:27017/",
+        help="URI de MongoDB (default: mongodb://localhost:27017/)",
+    )
+    parser.add_argument("--receiver-id", type=str, nargs="+", help="Exporta solo estos receptores")
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=60,
+        help="No exporta buffers insertados hace menos de estos segundos (default: 60)"
+    )
+    parser.add_argument("--batch-size", type=int, default=2000, help="Tamaño de lote del cursor (default: 2000)")
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default="zstd",
+        help="Compresión Parquet: zstd, snappy, gzip o none (default: zstd)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    client = MongoClient(args.mongo_uri)
+    try:
+        exporter = ParquetExporter(
+            client.tracking_data.portfinal,
+            args.output,
+            batch_size=args.batch_size,
+            compression=args.compression
+        )
+        rows = exporter.export(
+            receivers=args.receiver_id,
+            until=server_time(client.tracking_data.portfinal) - timedelta(seconds=args.settle)
+        )
+        logging.info(f"{exporter.documents} buffers, {rows} filas exportadas")
+    finally:
+        client.close()
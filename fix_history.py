@@ -0,0 +1,117 @@
+import math
+import threading
+
+from track import METRES_PER_DEGREE
+
+METRES_PER_SECOND_PER_KNOT = 1852 / 3600
+
+
+def _course_between(c0, c1, ratio):
+    """Interpolate a heading along the shorter arc"""
+    if c0 is None or c1 is None:
+        return c1 if c0 is None else c0
+    delta = (c1 - c0 + 180) % 360 - 180
+    return (c0 + delta * ratio) % 360
+
+
+class FixHistory:
+    def __init__(self, size=600, max_extrapolation=5.0, max_gap=10.0):
+        """Fixed-size ring of recent GPSFix values ordered by received_at
+
+        at(t) returns the position at an arbitrary local time t in O(log n):
+        interpolated between the two surrounding fixes, or dead-reckoned
+        from the newest fix (speed and course) for at most
+        max_extrapolation seconds. Two fixes more than max_gap seconds apart
+        are not interpolated across; the nearer one is used under the same
+        extrapolation limit. Writers (the GPS thread) and readers (the BLE
+        path) may run concurrently.
+        """
+        self.size = size
+        self.max_extrapolation = max_extrapolation
+        self.max_gap = max_gap
+        self._fixes = [None] * size
+        self._times = [0.0] * size
+        self._start = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, fix):
+        """Append a fix; out-of-order fixes are ignored, same-time fixes replace"""
+        with self._lock:
+            if self._count:
+                last = (self._start + self._count - 1) % self.size
+                if fix.received_at < self._times[last]:
+                    return
+                if fix.received_at == self._times[last]:
+                    self._fixes[last] = fix
+                    return
+            if self._count < self.size:
+                slot = (self._start + self._count) % self.size
+                self._count += 1
+            else:
+                # Full: overwrite the oldest
+                slot = self._start
+                self._start = (self._start + 1) % self.size
+            self._fixes[slot] = fix
+            self._times[slot] = fix.received_at
+
+    def latest(self):
+        with self._lock:
+            if not self._count:
+                return None
+            return self._fixes[(self._start + self._count - 1) % self.size]
+
+    def at(self, timestamp):
+        """(GPSFix at timestamp, seconds to the nearest real fix), or None
+
+        None means no fix close enough: history empty, timestamp older than
+        the history, or beyond max_extrapolation from the nearest fix.
+        """
+        with self._lock:
+            if not self._count:
+                return None
+            # Last logical index with time <= timestamp, -1 if none
+            low, high = 0, self._count
+            while low < high:
+                middle = (low + high) // 2
+                if self._times[(self._start + middle) % self.size] <= timestamp:
+                    low = middle + 1
+                else:
+                    high = middle
+            before = self._fixes[(self._start + low - 1) % self.size] if low else None
+            after = self._fixes[(self._start + low) % self.size] if low < self._count else None
+
+        if before and after and after.received_at - before.received_at <= self.max_gap:
+            return self._interpolate(before, after, timestamp)
+        if before and timestamp - before.received_at <= self.max_extrapolation:
+            return self._extrapolate(before, timestamp)
+        if after and after.received_at - timestamp <= self.max_extrapolation:
+            # Only backwards into a gap or before the history: hold the fix
+            return after._replace(received_at=timestamp), after.received_at - timestamp
+        return None
+
+    def _interpolate(self, before, after, timestamp):
+        span = after.received_at - before.received_at
+        ratio = (timestamp - before.received_at) / span if span > 0 else 0.0
+        fix = before._replace(
+            latitude=before.latitude + (after.latitude - before.latitude) * ratio,
+            longitude=before.longitude + (after.longitude - before.longitude) * ratio,
+            speed=(before.speed or 0) + ((after.speed or 0) - (before.speed or 0)) * ratio,
+            course=_course_between(before.course, after.course, ratio),
+            received_at=timestamp,
+        )
+        return fix, min(timestamp - before.received_at, after.received_at - timestamp)
+
+    def _extrapolate(self, fix, timestamp):
+        elapsed = timestamp - fix.received_at
+        latitude, longitude = fix.latitude, fix.longitude
+        if fix.course is not None and fix.speed:
+            distance = fix.speed * METRES_PER_SECOND_PER_KNOT * elapsed
+            heading = math.radians(fix.course)
+            latitude += distance * math.cos(heading) / METRES_PER_DEGREE
+            longitude += (distance * math.sin(heading)
+                          / (METRES_PER_DEGREE * math.cos(math.radians(fix.latitude))))
+        return fix._replace(latitude=latitude, longitude=longitude, received_at=timestamp), elapsed
@@ -0,0 +1,179 @@
+import time
+from collections import deque
+
+
+class FrameLossTracker:
+    # Sequence numbers are 1 byte; a jump of more than half the space
+    # backwards can only be a late frame if that sequence went missing
+    SEQUENCE_SPACE = 256
+    MAX_GAP = SEQUENCE_SPACE // 2
+    # Consecutive out-of-window sequences after which the stream is resynced
+    RESYNC_AFTER = 3
+
+    def __init__(self, window=60.0):
+        """Track frame loss from the 1-byte buffer sequence number
+
+        window is the length in seconds of the rolling rate calculation.
+        """
+        self.window = window
+        self.last_sequence = None
+
+        # Totals since start
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.stale = 0
+        self.resyncs = 0
+        self.restarts = 0
+        self.short_reads = 0
+        self.short_bytes = 0
+
+        self._lost_since_last = 0
+        self._events = deque()  # (timestamp, received, lost)
+        self._missing = set()   # Sequences lost within the last MAX_GAP frames
+        self._strays = []       # Current run of consecutive out-of-window sequences
+
+    def observe(self, sequence, now=None):
+        """Account for a received frame
+
+        Returns (kind, count) where kind is 'first', 'ok', 'gap',
+        'duplicate', 'reorder' (a frame counted as lost turned up late),
+        'stale' (out of window, not yet trusted), 'resync' or 'restart',
+        and count the frames lost in a gap or resync.
+
+        RESYNC_AFTER consecutive out-of-window sequences mean the stream
+        moved on: a burst loss longer than MAX_GAP (counted as lost) or a
+        firmware restart from sequence 0 (not counted).
+        """
+        now = time.monotonic() if now is None else now
+        self.received += 1
+
+        if self.last_sequence is None:
+            self.last_sequence = sequence
+            self._record(now, 0)
+            return 'first', 0
+
+        step = (sequence - self.last_sequence) % self.SEQUENCE_SPACE
+        if step > self.MAX_GAP:
+            if sequence in self._missing:
+                self._missing.discard(sequence)
+                self._strays = []
+                self.reordered += 1
+                self._recover()
+                self._record(now, 0)
+                return 'reorder', 0
+            return self._stray(sequence, now)
+
+        self._strays = []
+        if step == 1:
+            kind, lost = 'ok', 0
+        elif step == 0:
+            self.duplicates += 1
+            kind, lost = 'duplicate', 0
+        else:
+            kind, lost = 'gap', step - 1
+            self._missing.update(
+                (self.last_sequence + i) % self.SEQUENCE_SPACE for i in range(1, step))
+        self._advance(sequence)
+        self.lost += lost
+        self._lost_since_last += lost
+        self._record(now, lost)
+        return kind, lost
+
+    def _stray(self, sequence, now):
+        """Out-of-window sequence: stale on its own, a resync once a run forms"""
+        if self._strays and sequence != (self._strays[-1] + 1) % self.SEQUENCE_SPACE:
+            self._strays = []
+        self._strays.append(sequence)
+        if len(self._strays) < self.RESYNC_AFTER:
+            self.stale += 1
+            self._record(now, 0)
+            return 'stale', 0
+
+        # The earlier frames of the run were counted as stale, not as frames
+        first = self._strays[0]
+        self.stale -= len(self._strays) - 1
+        self._strays = []
+        self._missing.clear()
+        if first == 0:
+            self.restarts += 1
+            kind, lost = 'restart', 0
+        else:
+            self.resyncs += 1
+            kind = 'resync'
+            lost = (first - self.last_sequence - 1) % self.SEQUENCE_SPACE
+        self.last_sequence = sequence
+        self.lost += lost
+        self._lost_since_last += lost
+        self._record(now, lost)
+        return kind, lost
+
+    def _advance(self, sequence):
+        self.last_sequence = sequence
+        # Sequences more than MAX_GAP behind can no longer be told from new ones
+        self._missing = {
+            missing for missing in self._missing
+            if (sequence - missing) % self.SEQUENCE_SPACE <= self.MAX_GAP}
+
+    def record_short_read(self, expected, received):
+        """Account for a frame abandoned with received of its expected bytes"""
+        self.short_reads += 1
+        self.short_bytes += expected - received
+
+    def take_lost_since_last(self):
+        """Frames lost since the previous call (e.g. since the last stored buffer)"""
+        lost, self._lost_since_last = self._lost_since_last, 0
+        return lost
+
+    @property
+    def lost_since_last(self):
+        return self._lost_since_last
+
+    def rates(self, now=None):
+        """Rolling received/lost frame rates over the last window seconds"""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        received = sum(event[1] for event in self._events)
+        lost = sum(event[2] for event in self._events)
+        total = received + lost
+        return {
+            'frames_per_s': received / self.window,
+            'lost_per_s': lost / self.window,
+            'loss_ratio': lost / total if total else 0.0,
+        }
+
+    def stats(self, now=None):
+        """Totals and rolling rates as a plain dict (for logs or storage)"""
+        stats = {
+            'received': self.received,
+            'lost': self.lost,
+            'duplicates': self.duplicates,
+            'reordered': self.reordered,
+            'stale': self.stale,
+            'resyncs': self.resyncs,
+            'restarts': self.restarts,
+            'short_reads': self.short_reads,
+            'short_bytes': self.short_bytes,
+        }
+        stats.update(self.rates(now))
+        return stats
+
+    def _recover(self):
+        if self.lost:
+            self.lost -= 1
+        if self._lost_since_last:
+            self._lost_since_last -= 1
+        for i in range(len(self._events) - 1, -1, -1):
+            timestamp, received, lost = self._events[i]
+            if lost:
+                self._events[i] = (timestamp, received, lost - 1)
+                break
+
+    def _record(self, now, lost):
+        self._events.append((now, 1, lost))
+        self._expire(now)
+
+    def _expire(self, now):
+        while self._events and now - self._events[0][0] > self.window:
+            self._events.popleft()
@@ -0,0 +1,203 @@
+import json
+import math
+from collections import namedtuple
+
+from track import METRES_PER_DEGREE
+
+GeofenceEvent = namedtuple('GeofenceEvent', ['kind', 'zone', 'timestamp', 'latitude', 'longitude'])
+GeofenceEvent.__doc__ = """'enter' or 'exit' of a zone; timestamp is when the crossing was first seen"""
+
+
+def _ring_contains(ring, x, y):
+    """Ray casting: is (x, y) inside the closed ring [(x, y), ...]"""
+    inside = False
+    x1, y1 = ring[-1]
+    for x2, y2 in ring:
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    ratio = 0.0 if length == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length))
+    return math.hypot(px - (ax + dx * ratio), py - (ay + dy * ratio))
+
+
+class Zone:
+    """Polygon zone (a harbor or a dock); coordinates are (longitude, latitude)"""
+
+    def __init__(self, name, polygons, kind='harbor'):
+        # polygons: [[outer ring, hole, ...], ...] as in a GeoJSON MultiPolygon
+        self.name = name
+        self.kind = kind
+        self.polygons = [[[tuple(point[:2]) for point in ring] for ring in polygon]
+                         for polygon in polygons]
+        points = [point for polygon in self.polygons for point in polygon[0]]
+        self.bbox = (min(x for x, _ in points), min(y for _, y in points),
+                     max(x for x, _ in points), max(y for _, y in points))
+
+    def __repr__(self):
+        return f"Zone({self.name!r}, kind={self.kind!r})"
+
+    def in_bbox(self, x, y, margin=0.0):
+        west, south, east, north = self.bbox
+        return west - margin <= x <= east + margin and south - margin <= y <= north + margin
+
+    def contains(self, longitude, latitude):
+        if not self.in_bbox(longitude, latitude):
+            return False
+        for outer, *holes in self.polygons:
+            if _ring_contains(outer, longitude, latitude) and not any(
+                    _ring_contains(hole, longitude, latitude) for hole in holes):
+                return True
+        return False
+
+    def boundary_distance(self, longitude, latitude):
+        """Metres from the point to the nearest edge (equirectangular approximation)"""
+        scale = math.cos(math.radians(latitude))
+        best = math.inf
+        for polygon in self.polygons:
+            for ring in polygon:
+                ax, ay = ring[-1]
+                for bx, by in ring:
+                    best = min(best, _segment_distance(
+                        longitude * scale, latitude, ax * scale, ay, bx * scale, by))
+                    ax, ay = bx, by
+        return best * METRES_PER_DEGREE
+
+
+def load_zones(path):
+    """Zones from a GeoJSON FeatureCollection of Polygon / MultiPolygon features
+
+    Each feature's properties may give a name and a kind (harbor, dock, ...).
+    """
+    with open(path, encoding='utf-8') as f:
+        collection = json.load(f)
+    zones = []
+    for number, feature in enumerate(collection.get('features', [])):
+        geometry = feature.get('geometry') or {}
+        properties = feature.get('properties') or {}
+        if geometry.get('type') == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        zones.append(Zone(properties.get('name', f"zone-{number}"), polygons,
+                          properties.get('kind', 'harbor')))
+    return zones
+
+
+class Geofence:
+    def __init__(self, zones, margin=15.0, dwell=10.0, cell_size=0.01):
+        """Zone membership of a fix stream with enter/exit events
+
+        Zones are indexed on a grid of cell_size degrees: each cell lists the
+        zones whose bounding box overlaps it, so a fix only tests the few
+        zones of its cell (bbox first, then ray casting) plus those it is
+        currently in. To ignore GPS jitter at the pier, a crossing only
+        counts once the fix is margin metres past the boundary, and only
+        becomes an event after the fix stays on the new side for dwell
+        seconds. The first fix seeds the membership at once (an 'enter' for
+        each zone it is in), so a boat moored when tracking starts is never
+        taken for one at sea. Subscribers are called with each GeofenceEvent
+        from the thread that calls update().
+        """
+        self.zones = list(zones)
+        self.margin = margin
+        self.dwell = dwell
+        self.cell_size = cell_size
+        self.inside = set()
+        self.events = 0
+        self._seeded = False
+        self._pending = {}  # zone -> time the crossing was first seen
+        self._subscribers = []
+        self._grid = {}
+        for zone in self.zones:
+            west, south, east, north = zone.bbox
+            for cx in range(self._cell(west), self._cell(east) + 1):
+                for cy in range(self._cell(south), self._cell(north) + 1):
+                    self._grid.setdefault((cx, cy), []).append(zone)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(load_zones(path), **kwargs)
+
+    def _cell(self, degrees):
+        return math.floor(degrees / self.cell_size)
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    @property
+    def in_port(self):
+        return bool(self.inside)
+
+    def zones_at(self, longitude, latitude):
+        """Zones containing the point, without hysteresis"""
+        candidates = self._grid.get((self._cell(longitude), self._cell(latitude)), ())
+        return [zone for zone in candidates if zone.contains(longitude, latitude)]
+
+    def nearest_distance(self, longitude, latitude):
+        """Metres to the nearest zone's bounding box (0 inside one); O(zones)"""
+        scale = math.cos(math.radians(latitude))
+        best = math.inf
+        for zone in self.zones:
+            west, south, east, north = zone.bbox
+            dx = max(west - longitude, 0, longitude - east) * scale
+            dy = max(south - latitude, 0, latitude - north)
+            best = min(best, math.hypot(dx, dy))
+        return best * METRES_PER_DEGREE
+
+    def update(self, fix):
+        """Feed a GPSFix; returns the events it completed"""
+        longitude, latitude = fix.longitude, fix.latitude
+        now = fix.received_at
+        raw = set(self.zones_at(longitude, latitude))
+
+        if not self._seeded:
+            self._seeded = True
+            self.inside = raw
+            return self._publish([GeofenceEvent('enter', zone, now, latitude, longitude)
+                                  for zone in raw])
+
+        events = []
+        for zone in raw.symmetric_difference(self.inside):
+            if not self._past_margin(zone, longitude, latitude):
+                self._pending.pop(zone, None)
+                continue
+            since = self._pending.setdefault(zone, now)
+            if now - since < self.dwell:
+                continue
+            del self._pending[zone]
+            if zone in raw:
+                self.inside.add(zone)
+                kind = 'enter'
+            else:
+                self.inside.discard(zone)
+                kind = 'exit'
+            events.append(GeofenceEvent(kind, zone, since, latitude, longitude))
+
+        # Crossings that turned back before the dwell time are forgotten
+        for zone in [zone for zone in self._pending if (zone in raw) == (zone in self.inside)]:
+            del self._pending[zone]
+        return self._publish(events)
+
+    def _publish(self, events):
+        self.events += len(events)
+        for event in events:
+            for callback in self._subscribers:
+                callback(event)
+        return events
+
+    def _past_margin(self, zone, longitude, latitude):
+        if not self.margin:
+            return True
+        margin_degrees = self.margin / METRES_PER_DEGREE
+        if not zone.in_bbox(longitude, latitude, margin_degrees / max(
+                math.cos(math.radians(latitude)), 1e-6)):
+            return True  # Far outside: no need to measure
+        return zone.boundary_distance(longitude, latitude) >= self.margin
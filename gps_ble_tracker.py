@@ -1,13 +1,41 @@
 import serial
 import time
 from datetime import datetime
-import pynmea2
 import os
+import socket
 from pymongo import MongoClient
 import logging
-from uart import UARTReceiver
+from uart import UARTReceiver, frame_macs, frame_rssi
+from capture import CaptureTap, STREAM_GPS, open_replay
+from gps_reader import GPSReader
+from nmea import FixAssembler
+from fix_history import FixHistory
+from geofence import Geofence
+from motion import MotionDetector
+from mongo_writer import BatchWriter, INGEST_FIELD, stamp_ingest
+from spool import Spool
+from schema import SCHEMAS, compact_devices, compact_frame
+from provision import provision_collection, provision_presence, provision_tracks, provision_trips
+from presence import PresenceTable, position_point
+from track import TrackRecorder
+from trips import TripSegmenter
+from scheduler import AdaptiveScheduler
 from enum import Enum
 
+RAW_STORAGE = ("all", "sample", "none")
+
+# Compresión de la subida a MongoDB (pymongo omite zstd, con un aviso, si falta su módulo)
+WIRE_COMPRESSORS = "zstd,zlib"
+
+
+def _suffixed(path, suffix):
+    """'spool.db' -> 'spool-presence.db'; None se mantiene"""
+    if not path:
+        return None
+    root, ext = os.path.splitext(path)
+    return f"{root}-{suffix}{ext}"
+
+
 ## Log level
 class LogLevel(str, Enum):
     INFO = "info"
@@ -20,56 +48,259 @@ class CombinedTracker(UARTReceiver):
         ble_port="COM20",
         ble_baudrate=115200,
         gps_baudrate=115200,
+        n_mac_bytes=1,
         mongo_uri="mongodb://localhost:27017/",
-        log_level="info"
+        mongo_compressors=WIRE_COMPRESSORS,
+        log_level="info",
+        frame_format="dict",
+        capture_path=None,
+        mongo_client=None,
+        gps_mode="poll",
+        max_hdop=None,
+        min_satellites=None,
+        gps_history=600,
+        gps_max_extrapolation=5.0,
+        geofence_path=None,
+        geofence_margin=15.0,
+        geofence_dwell=10.0,
+        motion=False,
+        trips=False,
+        trip_arrive_dwell=120.0,
+        adaptive=False,
+        write_batch_size=100,
+        write_flush_ms=500,
+        write_queue_size=10000,
+        write_policy="block",
+        spill_path=None,
+        spool_path=None,
+        schema="full",
+        receiver_id=None,
+        provision=False,
+        presence=False,
+        presence_idle=60,
+        raw_storage="all",
+        raw_sample_every=10,
+        track=False,
+        track_tolerance=10.0,
+        embed_gps=True
     ):
-        """Inicializa el tracker"""
+        """Inicializa el tracker
+
+        gps_port y ble_port aceptan tambien objetos tipo serial ya abiertos
+        (p.ej. capture.ReplaySource). Con capture_path se guardan los bytes
+        crudos de ambos puertos en un fichero de captura. mongo_client permite
+        usar un cliente ya creado (p.ej. mongomock) en lugar de mongo_uri.
+        mongo_compressors son los compresores de red del cliente creado
+        (zstd,zlib por defecto; None o vacío para no comprimir).
+        n_mac_bytes es el ancho del campo n_mac de la cabecera BLE (1 por
+        defecto, la cabecera de 8 bytes ya desplegada; 2 con la cabecera de
+        9 bytes de main.c).
+        Con gps_mode="thread" un hilo GPSReader lee el GPS en segundo plano y
+        el camino BLE solo consulta la última posición publicada. max_hdop y
+        min_satellites descartan posiciones de mala calidad (según GGA).
+        Las últimas gps_history posiciones se guardan con su hora para
+        interpolar la posición de cada buffer a su hora de recepción; más
+        allá de gps_max_extrapolation segundos de la posición más cercana el
+        buffer se guarda sin gps_data.
+        geofence_path es un GeoJSON con los polígonos de puertos y muelles
+        (ver geofence.py); cada posición actualiza la zona actual y los
+        buffers llevan in_port. Una entrada o salida solo cuenta a más de
+        geofence_margin metros del borde y tras geofence_dwell segundos.
+        Con motion=True se clasifica el barco como parado o en movimiento
+        (ver motion.py) y cada buffer lleva el estado en motion.
+        Con trips=True el recorrido se divide en viajes (salida y vuelta a
+        puerto según la geocerca o, sin ella, según el estado de movimiento;
+        la vuelta cuenta tras trip_arrive_dwell segundos). Cada viaje se
+        guarda en la colección trips al terminar y los buffers llevan su
+        trip_id (None en puerto).
+        Con adaptive=True un AdaptiveScheduler ajusta el intervalo de
+        comprobación de red, los lotes de escritura, la lectura del GPS y el
+        nivel de log de consola según el barco esté amarrado, en puerto,
+        cerca de la costa o mar adentro (ver scheduler.py).
+        Los buffers se escriben en lotes desde un hilo BatchWriter (cada
+        write_batch_size documentos o write_flush_ms ms); write_policy decide
+        qué hacer con la cola llena (block, drop_oldest o spill a spill_path).
+        Con write_batch_size=0 cada buffer se inserta directamente.
+        Con spool_path los buffers se guardan solo en un spool local (SQLite)
+        que se sube a MongoDB con drain_spool() cuando hay conexión.
+        schema="compact" guarda los dispositivos en columnas (MAC como
+        entero, payload binario recortado a data_len); ver schema.py.
+        receiver_id identifica el barco/receptor en cada documento (por
+        defecto $RECEIVER_ID o el hostname). Con provision=True se crea la
+        colección time-series y sus índices al arrancar (ver provision.py).
+        Con presence=True se agregan los avistamientos por MAC en intervalos
+        (colección presence) que se cierran tras presence_idle segundos sin
+        verla. raw_storage decide qué buffers crudos se guardan además:
+        all, sample (1 de cada raw_sample_every) o none.
+        Con track=True las posiciones se simplifican en línea (error máximo
+        track_tolerance metros) y se guardan como polilíneas por viaje en la
+        colección tracks (ver track.py); cada buffer lleva trip_id y
+        trip_offset (segundos desde el inicio del viaje). Sin trips, cada
+        ejecución del tracker se registra como un viaje. Con embed_gps=False
+        los buffers ya no copian gps_data y la posición se obtiene de la traza.
+        """
         # Configurar logging
+        if schema not in SCHEMAS:
+            raise ValueError(f"Esquema desconocido: {schema}")
+        self.schema = schema
+        if raw_storage not in RAW_STORAGE:
+            raise ValueError(f"Modo de almacenamiento desconocido: {raw_storage}")
+        if raw_storage != "all" and not presence:
+            raise ValueError("raw_storage distinto de 'all' requiere presence=True")
+        if not embed_gps and not track:
+            raise ValueError("embed_gps=False requiere track=True")
+        if trips and not geofence_path:
+            # Sin geocerca los viajes se delimitan por el estado de movimiento
+            motion = True
+        self.embed_gps = embed_gps
+        self.raw_storage = raw_storage
+        self.raw_sample_every = raw_sample_every
+        self._raw_counter = 0
         self.log_level = log_level.lower()
         self._setup_logging()
         self.logger.info("Iniciando rastreador combinado GPS + BLE")
 
         # Inicializar receptor UART BLE
-        super().__init__(port=ble_port, baudrate=ble_baudrate)
+        super().__init__(
+            port=ble_port,
+            baudrate=ble_baudrate,
+            frame_format=frame_format,
+            capture_path=capture_path,
+            n_mac_bytes=n_mac_bytes
+        )
+        # Al reproducir una captura las horas son las de la captura, no las del reloj
+        self.clock = getattr(ble_port, 'clock', None) or getattr(gps_port, 'clock', None)
 
         # Configuración MongoDB
-        self.client = MongoClient(mongo_uri)
+        if mongo_client is not None:
+            self.client = mongo_client
+        elif mongo_compressors:
+            self.client = MongoClient(mongo_uri, compressors=mongo_compressors)
+        else:
+            self.client = MongoClient(mongo_uri)
         self.db = self.client.tracking_data
         self.collection = self.db.portfinal
+        self.receiver_id = receiver_id or os.environ.get("RECEIVER_ID") or socket.gethostname()
+        if provision:
+            self.collection = provision_collection(self.db, "portfinal", logger=self.logger)
+        self.write_options = {
+            'batch_size': write_batch_size,
+            'flush_interval': write_flush_ms / 1000,
+            'max_queue': write_queue_size,
+            'policy': write_policy,
+        }
+        self.spool_path = spool_path
+        self.spill_path = spill_path
+        self.spool = Spool(spool_path) if spool_path else None
+        self.writer = None if self.spool else self._make_writer(self.collection, spill_path)
+        # Colecciones secundarias: nombre -> (colección, writer, spool)
+        self.sinks = {}
+
+        # Intervalos de presencia por MAC
+        self.presence = None
+        if presence:
+            self.presence = PresenceTable(idle_timeout=presence_idle)
+            if provision:
+                provision_presence(self.db, "presence", logger=self.logger)
+            self._open_sink("presence")
+
+        # Traza GPS simplificada del viaje
+        self.track = None
+        self.trip_id = None
+        if track:
+            self.track = TrackRecorder(tolerance=track_tolerance)
+            if provision:
+                provision_tracks(self.db, "tracks", logger=self.logger)
+            self._open_sink("tracks")
+            if not trips:
+                # Sin segmentación de viajes, cada ejecución del tracker es un viaje
+                self.trip_id = f"{self.receiver_id}-{datetime.now():%Y%m%d%H%M%S}"
+                self.track.start(self.trip_id, self._now())
+                self.logger.info(f"Registrando traza del viaje {self.trip_id}")
 
         # Configuración GPS
         self.gps_port = gps_port
         self.gps_baudrate = gps_baudrate
         self.last_gps_data = None
+        self.last_fix = None
+        self.gps_history = FixHistory(size=gps_history, max_extrapolation=gps_max_extrapolation)
+        self.geofence = None
+        if geofence_path:
+            self.geofence = Geofence.from_file(
+                geofence_path, margin=geofence_margin, dwell=geofence_dwell)
+            self.geofence.subscribe(self._log_geofence_event)
+            self.logger.info(f"Geocerca: {len(self.geofence.zones)} zonas de {geofence_path}")
+        self.motion = None
+        if motion:
+            self.motion = MotionDetector()
+            self.motion.subscribe(self._log_motion_event)
+        self.trips = None
+        if trips:
+            self.trips = TripSegmenter(self.receiver_id, arrive_dwell=trip_arrive_dwell)
+            if provision:
+                provision_trips(self.db, "trips", logger=self.logger)
+            self._open_sink("trips")
+        self.scheduler = AdaptiveScheduler(self) if adaptive else None
+        self.gps_reader = None
+        # En modo síncrono, segundos mínimos entre lecturas del puerto GPS
+        self.gps_poll_interval = 0
+        self._next_gps_poll = 0.0
+        self.nmea = FixAssembler(max_hdop=max_hdop, min_satellites=min_satellites)
+        # En modo síncrono el bucle BLE lee el GPS; otros modos lo drenan aparte
+        self.gps_polling = True
         
         try:
-            self.gps_ser = serial.Serial(self.gps_port, self.gps_baudrate, timeout=1)
+            if hasattr(self.gps_port, 'read'):
+                self.gps_ser = self.gps_port
+            else:
+                self.gps_ser = serial.Serial(self.gps_port, self.gps_baudrate, timeout=1)
             self.logger.info(f"GPS conectado en {self.gps_port}")
         except serial.SerialException as e:
             self.logger.error(f"Error conectando GPS: {e}")
             raise
 
-        # Formato del buffer BLE
-        self.HEADER_MAGIC = b"\x55\x55\x55\x55"
-        self.HEADER_FORMAT = {
-            "header": 4,
-            "sequence": 1,
-            "n_adv_raw": 2,
-            "n_mac": 1,
-        }
+        if self.capture:
+            self.gps_ser = CaptureTap(self.gps_ser, self.capture, STREAM_GPS)
+            self.logger.info(f"Capturando UART en {self.capture.path}")
 
-        self.DEVICE_FORMAT = {
-            "mac": 6,
-            "addr_type": 1,
-            "adv_type": 1,
-            "rssi": 1,
-            "data_len": 1,
-            "data": 31,
-            "n_adv": 1,
-        }
+        if gps_mode == "thread":
+            self.gps_reader = GPSReader(self.gps_ser, parse=self._feed_nmea, logger=self.logger)
+            self.gps_reader.start()
+            self.gps_polling = False
+            self.logger.info("GPS leído en hilo dedicado")
+        elif gps_mode != "poll":
+            raise ValueError(f"Modo GPS desconocido: {gps_mode}")
 
-        self.HEADER_LENGTH = sum(self.HEADER_FORMAT.values())
-        self.DEVICE_LENGTH = sum(self.DEVICE_FORMAT.values())
+    def _make_writer(self, collection, spill_path):
+        """BatchWriter para collection, None si la escritura es directa"""
+        if not self.write_options['batch_size']:
+            return None
+        writer = BatchWriter(collection, spill_path=spill_path, ingest_field=INGEST_FIELD,
+                             logger=self.logger, **self.write_options)
+        writer.start()
+        return writer
+
+    def _open_sink(self, name):
+        """Abre la colección secundaria name con el mismo camino de escritura que los buffers"""
+        collection = self.db[name]
+        spool = Spool(_suffixed(self.spool_path, name)) if self.spool_path else None
+        writer = None if spool else self._make_writer(collection, _suffixed(self.spill_path, name))
+        self.sinks[name] = (collection, writer, spool)
+        return self.sinks[name]
+
+    def _write(self, document, collection, writer, spool):
+        """Escribe un documento por el camino configurado (spool, lotes o directo)"""
+        if spool:
+            spool.append(document)
+            return True
+        if writer:
+            if not writer.put(document):
+                self.logger.warning("Cola de escritura llena: documento volcado a disco")
+            return True
+        stamp_ingest(collection, [document])
+        result = collection.insert_one(document)
+        self.logger.debug(f"Documento almacenado - ID: {result.inserted_id}")
+        return True
 
     def _setup_logging(self):
         """Configura el sistema de logging"""
@@ -93,6 +324,7 @@ class CombinedTracker(UARTReceiver):
         # Handler para consola con más información
         console_handler = logging.StreamHandler()
         console_handler.setLevel(logging.INFO)  # Cambiar a DEBUG para ver más detalles
+        self.console_handler = console_handler
 
         # Formato detallado para consola
         console_formatter = logging.Formatter(
@@ -110,63 +342,329 @@ class CombinedTracker(UARTReceiver):
         self.logger.addHandler(file_handler)
         self.logger.addHandler(console_handler)
 
+    def _now(self):
+        """Hora actual del rastreador: la de la captura al reproducir, si no time.time()"""
+        return self.clock.now() if self.clock else time.time()
+
+    def _arrival(self, port):
+        """Hora de llegada de lo último leído de port, si la fuente la conoce"""
+        arrival = getattr(port, 'arrival_time', None)
+        return self._now() if arrival is None else arrival
+
+    def _feed_nmea(self, line, received_at=None):
+        """Parsea una sentencia NMEA y pasa cada posición nueva a la traza"""
+        fix = self.nmea.feed(line, self._now() if received_at is None else received_at)
+        if fix:
+            self.gps_history.add(fix)
+            if self.geofence:
+                self.geofence.update(fix)
+            if self.motion:
+                self.motion.update(fix)
+            if self.trips:
+                self._update_trip(fix)
+            if self.track:
+                self._record_fix(fix)
+        return fix
+
+    def _record_fix(self, fix):
+        chunk = self.track.add(fix)
+        if chunk:
+            self._store_track_chunk(chunk)
+
+    def _update_trip(self, fix):
+        at_sea = not self.geofence.in_port if self.geofence else self.motion.moving
+        started, finished = self.trips.update(fix, at_sea)
+        if finished:
+            self._end_trip(finished, 'arrival')
+        if started:
+            self.trip_id = started.trip_id
+            if self.track:
+                self.track.start(started.trip_id, started.start)
+            self.logger.info(f"Inicio del viaje {started.trip_id}")
+
+    def _end_trip(self, trip, reason):
+        """Cierra la traza del viaje y guarda su resumen"""
+        if self.track:
+            self._finish_track()
+        self.trip_id = None
+        self._write(trip.to_document(reason), *self.sinks["trips"])
+        self.logger.info(
+            f"Fin del viaje {trip.trip_id}: {trip.end - trip.start:.0f}s, "
+            f"{trip.distance_m:.0f} m, {len(trip.macs)} dispositivos"
+        )
+
+    def _finish_track(self):
+        chunk = self.track.finish()
+        if chunk:
+            self._store_track_chunk(chunk)
+        self.logger.info(
+            f"Traza del viaje {self.trip_id}: {self.track.kept} de {self.track.fixes} posiciones"
+        )
+
+    def _store_track_chunk(self, chunk):
+        chunk['receiver_id'] = self.receiver_id
+        self._write(chunk, *self.sinks["tracks"])
+        self.logger.debug(f"Traza: tramo {chunk['chunk']} con {chunk['points']} puntos")
+
+    def _log_geofence_event(self, event):
+        action = "Entrada en" if event.kind == 'enter' else "Salida de"
+        self.logger.info(
+            f"{action} {event.zone.kind} {event.zone.name} "
+            f"({event.latitude:.6f}, {event.longitude:.6f})"
+        )
+
+    def _log_motion_event(self, event):
+        estado = "en movimiento" if event.state == 'moving' else "parado"
+        self.logger.info(
+            f"Barco {estado} desde {datetime.fromtimestamp(event.timestamp):%H:%M:%S} "
+            f"({event.speed:.2f} knots)"
+        )
+
+    def _handle_gps_line(self, line, received_at=None):
+        """Procesa una sentencia NMEA llegada en received_at; devuelve la nueva posición o None"""
+        fix = self._feed_nmea(line, received_at)
+        if fix:
+            self.last_fix = fix
+            self.last_gps_data = fix.as_document()
+            return self.last_gps_data
+        return None
+
     def _parse_gps(self):
         """Parsea datos GPS"""
+        if self.gps_poll_interval:
+            now = time.time()
+            if now < self._next_gps_poll:
+                return self.last_gps_data
+            self._next_gps_poll = now + self.gps_poll_interval
         try:
-            while self.gps_ser.in_waiting:  # Read all available GPS data
-                line = self.gps_ser.readline().decode('ascii', errors='replace')
-                
-                if line.startswith("$GPRMC"):
-                    msg = pynmea2.parse(line)
-                    if msg.status == 'A':  # Solo almacena si el estado es válido
-                        self.last_gps_data = {
-                            "coordinates": {
-                                "longitude": msg.longitude if msg.longitude else None,
-                                "latitude": msg.latitude if msg.latitude else None,
-                            },
-                            "speed": msg.spd_over_grnd if msg.spd_over_grnd else 0,
-                            "track_valid": True
-                        }
-                        return self.last_gps_data  # Return the most recent GPS data
-                    
+            # Lee todas las sentencias pendientes para quedarse con la más reciente
+            while self.gps_ser.in_waiting:
+                line = self.gps_ser.readline()
+                self._handle_gps_line(line, self._arrival(self.gps_ser))
+
         except Exception as e:
             self.logger.error(f"Error parseando GPS: {e}")
         return self.last_gps_data  # Return last known position if no new data
 
+    def _current_gps(self):
+        """Última posición conocida, leyendo el puerto GPS solo en modo síncrono"""
+        if self.gps_reader:
+            # Sin I/O: solo se lee la referencia publicada por el hilo GPS
+            fix = self.gps_reader.latest
+            if fix is not self.last_fix:
+                self.last_fix = fix
+                self.last_gps_data = fix.as_document() if fix else None
+            return self.last_gps_data
+        if self.gps_polling:
+            return self._parse_gps() or self.last_gps_data
+        return self.last_gps_data
+
+    def _check_sequence(self, received_seq):
+        """Verifica la secuencia del buffer y registra pérdidas de tramas"""
+        kind, lost = self.loss.observe(received_seq)
+        if kind == 'gap':
+            self.logger.warning(f"Secuencia #{received_seq}: {lost} tramas perdidas")
+        elif kind == 'duplicate':
+            self.logger.warning(f"Secuencia #{received_seq}: trama duplicada")
+        elif kind == 'reorder':
+            self.logger.warning(f"Secuencia #{received_seq}: trama desordenada")
+        elif kind == 'stale':
+            self.logger.warning(f"Secuencia #{received_seq}: fuera de ventana, se ignora")
+        elif kind == 'resync':
+            self.logger.warning(f"Secuencia #{received_seq}: resincronizada, {lost} tramas perdidas")
+        elif kind == 'restart':
+            self.logger.warning(f"Secuencia #{received_seq}: el receptor se ha reiniciado")
+        self.sequence = self.loss.last_sequence
+        return kind, lost
+
+    def _summarize_devices(self, devices, limit=3):
+        """Resumen corto de los primeros dispositivos para el log"""
+        if self.frame_format == 'numpy':
+            head = devices[:limit]
+            summary = [
+                f"{mac}(RSSI:{rssi}dB)"
+                for mac, rssi in zip(frame_macs(head), frame_rssi(head).tolist())
+            ]
+        else:
+            summary = [
+                f"{dev['mac']}(RSSI:{dev['rssi']}dB)"
+                for dev in devices[:limit]
+            ]
+        if len(devices) > limit:
+            summary.append(f"... +{len(devices)-limit} más")
+        return summary
+
     def _store_buffer(self, header, devices):
         """Almacena el buffer BLE y datos GPS en MongoDB"""
         try:
-            # Obtener datos GPS actuales
-            gps_data = self._parse_gps() or self.last_gps_data
+            received_at = header.get('received_at') or self._now()
+            # Lee las posiciones pendientes y calcula la de la hora de recepción
+            self._current_gps()
+            position = self.gps_history.at(received_at)
+            if position:
+                fix, gps_age = position
+                gps_data = fix.as_document()
+            else:
+                # Sin posición fiable: se guarda solo la antigüedad de la última
+                gps_data = None
+                gps_age = self.last_fix.age(received_at) if self.last_fix else None
 
             document = {
-                'timestamp': datetime.now(),
+                'timestamp': datetime.fromtimestamp(received_at),
+                'receiver_id': self.receiver_id,
                 'sequence': header['sequence'],
                 'n_adv_raw': header['n_adv_raw'],
                 'n_mac': header['n_mac'],
-                'devices': [],
-                'gps_data': gps_data
+                'gps_age': round(gps_age, 3) if gps_age is not None else None,
+                'frames_lost_since_last': self.loss.take_lost_since_last()
             }
+            if self.embed_gps:
+                document['gps_data'] = gps_data
+            if self.geofence:
+                document['in_port'] = self.geofence.in_port
+            if self.motion:
+                document['motion'] = self.motion.state.value
+            if self.track or self.trips:
+                document['trip_id'] = self.trip_id
+            if self.track:
+                # Referencia a la traza del viaje en lugar de copiar coordenadas
+                document['trip_offset'] = self.track.offset(received_at)
 
-            for device in devices:
-                device_doc = {
-                    'mac': device['mac'],
-                    'addr_type': device['addr_type'],
-                    'adv_type': device['adv_type'],
-                    'rssi': device['rssi'],
-                    'data_len': device['data_len'],
-                    'data': device['data'].hex(),
-                    'n_adv': device['n_adv']
-                }
-                document['devices'].append(device_doc)
-            
-            result = self.collection.insert_one(document)
-            self.logger.debug(f"Buffer combinado almacenado - ID: {result.inserted_id}")
-            return True
+            if self.schema == 'compact':
+                # Columnas por dispositivo en lugar de subdocumentos
+                document['schema'] = 'compact'
+                if self.frame_format == 'numpy':
+                    document.update(compact_frame(devices))
+                else:
+                    document.update(compact_devices(devices))
+            else:
+                document['devices'] = [
+                    {
+                        'mac': device['mac'],
+                        'addr_type': device['addr_type'],
+                        'adv_type': device['adv_type'],
+                        'rssi': device['rssi'],
+                        'data_len': device['data_len'],
+                        'data': device.data_hex,
+                        'n_adv': device['n_adv']
+                    }
+                    for device in self._device_list(devices)
+                ]
+
+            return self._write(document, self.collection, self.writer, self.spool)
         except Exception as e:
             self.logger.error(f"Error almacenando en BD: {e}")
             return False
 
+    def drain_spool(self, batch_size=1000, should_stop=None):
+        """Sube a MongoDB los documentos guardados en los spools locales"""
+        uploaded = 0
+        targets = [(self.collection, self.writer, self.spool)] + list(self.sinks.values())
+        for collection, _, spool in targets:
+            if not spool:
+                continue
+            pending = spool.pending()
+            if not pending:
+                continue
+            self.logger.info(f"Subiendo {pending} documentos del spool a {collection.name}")
+            start = time.time()
+            count = spool.drain(collection, batch_size, should_stop, ingest_field=INGEST_FIELD)
+            self.logger.info(
+                f"Spool: {count} documentos subidos en {time.time() - start:.1f}s "
+                f"({spool.pending()} pendientes)"
+            )
+            uploaded += count
+        return uploaded
+
+    def _update_presence(self, devices, gps_data):
+        """Actualiza los intervalos de presencia y guarda los que se cierran"""
+        macs = self._macs(devices)
+        if self.frame_format == 'numpy':
+            rssis = frame_rssi(devices).tolist()
+            n_advs = devices['n_adv'].tolist()
+        else:
+            rssis = [device.rssi for device in devices]
+            n_advs = [device.n_adv for device in devices]
+
+        now = datetime.now()
+        closed = [(interval, 'evicted') for interval in self.presence.observe(
+            macs, rssis, n_advs, now, position_point(gps_data))]
+        closed += [(interval, 'idle') for interval in self.presence.expire(now)]
+        self._store_presence(closed)
+
+    def _macs(self, devices):
+        if self.frame_format == 'numpy':
+            return frame_macs(devices)
+        return [device.mac for device in devices]
+
+    def _store_presence(self, closed):
+        for interval, reason in closed:
+            self._write(interval.to_document(self.receiver_id, reason), *self.sinks["presence"])
+        if closed:
+            self.logger.debug(f"{len(closed)} intervalos de presencia cerrados")
+
+    def _keep_raw(self):
+        """Decide si el buffer crudo se almacena según raw_storage"""
+        if self.raw_storage == 'all':
+            return True
+        if self.raw_storage == 'none':
+            return False
+        keep = self._raw_counter % self.raw_sample_every == 0
+        self._raw_counter += 1
+        return keep
+
+    def _process_frame(self, header, payload):
+        """Decodifica, registra y almacena una trama BLE; True si se procesó"""
+        header['received_at'] = self._arrival(self.serial)
+        self._check_sequence(header['sequence'])
+        self.logger.debug(
+            f"Trama UART encontrada (bytes descartados en resync: {self.resync_skipped})"
+        )
+
+        # Decodifica todos los dispositivos de la trama
+        devices = self._decode_devices(payload)
+
+        # Procesa el buffer si hay dispositivos
+        if not len(devices):
+            return False
+
+        # Obtener datos GPS actuales
+        gps_data = self._current_gps()
+
+        # Crear resumen de dispositivos
+        devices_summary = self._summarize_devices(devices)
+
+        # Log detallado en consola
+        status_msg = (
+            f"\n"
+            f"├─ Secuencia: #{header['sequence']}\n"
+            f"├─ Dispositivos: {len(devices)} ({', '.join(devices_summary)})\n"
+            f"├─ Anuncios raw: {header['n_adv_raw']}\n"
+            f"├─ Tramas perdidas: {self.loss.lost_since_last} "
+            f"(total {self.loss.lost}, tasa {self.loss.rates()['loss_ratio']:.1%})\n"
+            f"└─ GPS: {'✓' if gps_data else '✗'}"
+        )
+
+        if gps_data and gps_data.get('coordinates'):
+            status_msg += (
+                f"\n   └─ Pos: {gps_data['coordinates']['latitude']:.6f}, "
+                f"{gps_data['coordinates']['longitude']:.6f} "
+                f"({gps_data.get('speed', 0):.2f} knots)"
+            )
+
+        self.logger.info(status_msg)
+
+        if self.trips:
+            self.trips.observe(self._macs(devices))
+
+        if self.presence is not None:
+            self._update_presence(devices, gps_data)
+            if not self._keep_raw():
+                return True
+
+        # Almacenar en MongoDB
+        return self._store_buffer(header, devices)
+
     def receive_messages(self, duration=None):
         """Recibe y almacena buffers BLE con datos GPS"""
         self.logger.info("=== Iniciando recepción de buffers combinados ===")
@@ -181,72 +679,28 @@ class CombinedTracker(UARTReceiver):
                     self.logger.info(f"Total de buffers procesados: {buffers_procesados}")
                     break
 
+                if self.scheduler:
+                    self.scheduler.update()
+
                 # Update GPS data 
-                self._parse_gps()
-
-                # Busca la cabecera BLE
-                while True:
-                    if self.serial.read() == b'\x55':
-                        potential_header = b'\x55' + self.serial.read(3)
-                        if potential_header == self.HEADER_MAGIC:
-                            self.logger.debug("Cabecera UART encontrada")
-                            break
-
-                # Lee y parsea la cabecera
-                header_data = potential_header + self.serial.read(self.HEADER_LENGTH - 4)
-                header = self._parse_header(header_data)
-                
-                if not header:
-                    self.logger.warning("Error al parsear cabecera")
-                    continue
+                if self.gps_polling:
+                    self._parse_gps()
 
-                # Lee todos los dispositivos
-                devices = []
-                for i in range(header['n_mac']):
-                    device_data = self.serial.read(self.DEVICE_LENGTH)
-                    device = self._parse_device(device_data)
-                    if device:
-                        devices.append(device)
-
-                # Procesa el buffer si hay dispositivos
-                if devices:
-                    # Obtener datos GPS actuales
-                    gps_data = self._parse_gps() or self.last_gps_data
-                    
-                    # Crear resumen de dispositivos
-                    devices_summary = [
-                        f"{dev['mac']}(RSSI:{dev['rssi']}dB)" 
-                        for dev in devices[:3]
-                    ]
-                    if len(devices) > 3:
-                        devices_summary.append(f"... +{len(devices)-3} más")
-
-                    # Log detallado en consola
-                    status_msg = (
-                        f"\n"
-                        f"├─ Secuencia: #{header['sequence']}\n"
-                        f"├─ Dispositivos: {len(devices)} ({', '.join(devices_summary)})\n"
-                        f"├─ Anuncios raw: {header['n_adv_raw']}\n"
-                        f"└─ GPS: {'✓' if gps_data else '✗'}"
-                    )
-                    
-                    if gps_data and gps_data.get('coordinates'):
-                        status_msg += (
-                            f"\n   └─ Pos: {gps_data['coordinates']['latitude']:.6f}, "
-                            f"{gps_data['coordinates']['longitude']:.6f} "
-                            f"({gps_data.get('speed', 0):.2f} knots)"
-                        )
-                    
-                    self.logger.info(status_msg)
-                    
-                    # Almacenar en MongoDB
-                    if self._store_buffer(header, devices):
-                        buffers_procesados += 1
+                # Busca la siguiente trama BLE completa
+                frame = self._next_frame()
+                if not frame:
+                    continue
+                if self._process_frame(*frame):
+                    buffers_procesados += 1
 
             except KeyboardInterrupt:
                 self.logger.info("\n=== Captura interrumpida por el usuario ===")
                 self.logger.info(f"Total de buffers procesados: {buffers_procesados}")
                 break
+            except serial.SerialException as e:
+                self.logger.error(f"Error de comunicación serie: {e}")
+                self.logger.info(f"Total de buffers procesados: {buffers_procesados}")
+                break
             except Exception as e:
                 self.logger.error(f"Error inesperado: {e}")
                 continue
@@ -254,10 +708,29 @@ class CombinedTracker(UARTReceiver):
     def close(self):
         """Cierra todas las conexiones"""
         try:
+            if self.gps_reader:
+                self.gps_reader.stop()
             super().close()  # Cierra UART BLE
             if hasattr(self, 'gps_ser'):
                 self.gps_ser.close()
                 self.logger.info("Conexión GPS cerrada")
+            if self.presence is not None:
+                self._store_presence(
+                    [(interval, 'shutdown') for interval in self.presence.close_all()])
+            if self.trips and self.trips.current:
+                self._end_trip(self.trips.close(), 'shutdown')
+            elif self.track and self.trip_id:
+                self._finish_track()
+                self.trip_id = None
+            targets = [(self.collection, self.writer, self.spool)] + list(self.sinks.values())
+            for _, writer, _ in targets:
+                if writer:
+                    writer.close()
+                    self.logger.info(f"Escritor por lotes detenido: {writer.stats()}")
+            for _, _, spool in targets:
+                if spool:
+                    self.logger.info(f"Spool cerrado: {spool.stats()}")
+                    spool.close()
             self.client.close()
             self.logger.info("Conexión MongoDB cerrada")
         except Exception as e:
@@ -281,6 +754,12 @@ if __name__ == "__main__":
         default="mongodb://localhost:27017/",
         help="URI de MongoDB (default: mongodb://localhost:27017/)",
     )
+    parser.add_argument(
+        "--mongo-compressors",
+        type=str,
+        default=WIRE_COMPRESSORS,
+        help=f"Compresores de red de MongoDB, 'none' para desactivar (default: {WIRE_COMPRESSORS})",
+    )
     parser.add_argument(
         "--log-level",
         type=str,
@@ -288,21 +767,254 @@ if __name__ == "__main__":
         default="info",
         help="Nivel de logging (default: info)"
     )
+    parser.add_argument(
+        "--frame-format",
+        type=str,
+        choices=["dict", "numpy"],
+        default="dict",
+        help="Formato de las tramas BLE decodificadas (default: dict)"
+    )
+    parser.add_argument(
+        "--n-mac-bytes",
+        type=int,
+        choices=[1, 2],
+        default=1,
+        help="Ancho del campo n_mac de la cabecera BLE según el firmware "
+             "(default: 1, cabecera de 8 bytes; 2 con la cabecera de 9 bytes de main.c)"
+    )
+    parser.add_argument(
+        "--ingest",
+        type=str,
+        choices=["sync", "async"],
+        default="sync",
+        help="Modo de ingesta: bucle síncrono o asyncio con BLE y GPS concurrentes (default: sync)"
+    )
+    parser.add_argument(
+        "--gps-mode",
+        type=str,
+        choices=["poll", "thread"],
+        default="poll",
+        help="Lectura del GPS: en el bucle BLE o en un hilo dedicado (default: poll)"
+    )
+    parser.add_argument(
+        "--max-hdop", type=float, help="Descarta posiciones con HDOP mayor que este valor"
+    )
+    parser.add_argument(
+        "--min-sats", type=int, help="Descarta posiciones con menos satélites que este valor"
+    )
+    parser.add_argument(
+        "--gps-history",
+        type=int,
+        default=600,
+        help="Posiciones recientes guardadas para interpolar la posición de cada buffer (default: 600)"
+    )
+    parser.add_argument(
+        "--gps-max-extrapolation",
+        type=float,
+        default=5.0,
+        help="Segundos máximos de extrapolación desde la última posición (default: 5)"
+    )
+    parser.add_argument(
+        "--geofence", type=str, help="GeoJSON con los polígonos de puertos y muelles"
+    )
+    parser.add_argument(
+        "--geofence-margin",
+        type=float,
+        default=15.0,
+        help="Metros más allá del borde para contar una entrada o salida (default: 15)"
+    )
+    parser.add_argument(
+        "--geofence-dwell",
+        type=float,
+        default=10.0,
+        help="Segundos al otro lado del borde antes de confirmar el cambio (default: 10)"
+    )
+    parser.add_argument(
+        "--motion",
+        action="store_true",
+        help="Detecta si el barco está parado o en movimiento"
+    )
+    parser.add_argument(
+        "--trips",
+        action="store_true",
+        help="Divide el recorrido en viajes (colección trips); sin --geofence usa --motion"
+    )
+    parser.add_argument(
+        "--trip-arrive-dwell",
+        type=float,
+        default=120.0,
+        help="Segundos de vuelta en puerto para cerrar un viaje (default: 120)"
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Ajusta comprobaciones de red, lotes, lectura GPS y log según el estado del barco"
+    )
+    parser.add_argument(
+        "--capture", type=str, help="Guarda los bytes UART crudos en este fichero"
+    )
+    parser.add_argument(
+        "--replay", type=str, help="Reproduce un fichero de captura en lugar de los puertos"
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="Velocidad de reproducción (1 = tiempo real, 0 = lo más rápido posible)"
+    )
+    parser.add_argument(
+        "--write-batch",
+        type=int,
+        default=100,
+        help="Documentos por lote de escritura (0 = insert_one por buffer, default: 100)"
+    )
+    parser.add_argument(
+        "--write-flush-ms",
+        type=int,
+        default=500,
+        help="Tiempo máximo de espera de un lote en ms (default: 500)"
+    )
+    parser.add_argument(
+        "--write-queue",
+        type=int,
+        default=10000,
+        help="Tamaño máximo de la cola de escritura (default: 10000)"
+    )
+    parser.add_argument(
+        "--write-policy",
+        type=str,
+        choices=BatchWriter.POLICIES,
+        default="block",
+        help="Con la cola llena: bloquear, descartar el más antiguo o volcar a disco (default: block)"
+    )
+    parser.add_argument(
+        "--spill", type=str, help="Fichero JSONL donde volcar buffers con la cola llena"
+    )
+    parser.add_argument(
+        "--schema",
+        type=str,
+        choices=SCHEMAS,
+        default="full",
+        help="Esquema de los documentos: subdocumentos por dispositivo o columnas compactas (default: full)"
+    )
+    parser.add_argument(
+        "--receiver-id", type=str, help="Identificador del barco/receptor (default: $RECEIVER_ID o hostname)"
+    )
+    parser.add_argument(
+        "--provision",
+        action="store_true",
+        help="Crea la colección time-series y los índices si no existen"
+    )
+    parser.add_argument(
+        "--presence",
+        action="store_true",
+        help="Agrega los avistamientos por MAC en intervalos de presencia"
+    )
+    parser.add_argument(
+        "--presence-idle",
+        type=float,
+        default=60,
+        help="Segundos sin ver una MAC para cerrar su intervalo (default: 60)"
+    )
+    parser.add_argument(
+        "--raw-storage",
+        type=str,
+        choices=RAW_STORAGE,
+        default="all",
+        help="Buffers crudos a guardar con --presence: todos, una muestra o ninguno (default: all)"
+    )
+    parser.add_argument(
+        "--raw-sample-every",
+        type=int,
+        default=10,
+        help="Con --raw-storage sample, guarda 1 de cada N buffers (default: 10)"
+    )
+    parser.add_argument(
+        "--track",
+        action="store_true",
+        help="Guarda la traza GPS simplificada del viaje como polilínea (colección tracks)"
+    )
+    parser.add_argument(
+        "--track-tolerance",
+        type=float,
+        default=10.0,
+        help="Error máximo en metros de la traza simplificada (default: 10)"
+    )
+    parser.add_argument(
+        "--no-embed-gps",
+        action="store_true",
+        help="Con --track, no copia gps_data en cada buffer (solo trip_id y trip_offset)"
+    )
+    parser.add_argument(
+        "--spool", type=str, help="Guarda los buffers en este spool SQLite en lugar de MongoDB"
+    )
+    parser.add_argument(
+        "--drain-spool",
+        action="store_true",
+        help="Sube el contenido de --spool a MongoDB y termina"
+    )
 
     args = parser.parse_args()
 
+    gps_port, ble_port = args.gps_port, args.ble_port
+    if args.replay:
+        ble_port, gps_port = open_replay(args.replay, speed=args.replay_speed or None)
+
     try:
         tracker = CombinedTracker(
-            gps_port=args.gps_port, 
-            ble_port=args.ble_port, 
+            gps_port=gps_port, 
+            ble_port=ble_port, 
             mongo_uri=args.mongo_uri,
-            log_level=args.log_level
+            mongo_compressors=None if args.mongo_compressors == "none" else args.mongo_compressors,
+            log_level=args.log_level,
+            frame_format=args.frame_format,
+            n_mac_bytes=args.n_mac_bytes,
+            capture_path=args.capture,
+            gps_mode=args.gps_mode,
+            max_hdop=args.max_hdop,
+            min_satellites=args.min_sats,
+            gps_history=args.gps_history,
+            gps_max_extrapolation=args.gps_max_extrapolation,
+            geofence_path=args.geofence,
+            geofence_margin=args.geofence_margin,
+            geofence_dwell=args.geofence_dwell,
+            motion=args.motion,
+            trips=args.trips,
+            trip_arrive_dwell=args.trip_arrive_dwell,
+            adaptive=args.adaptive,
+            write_batch_size=args.write_batch,
+            write_flush_ms=args.write_flush_ms,
+            write_queue_size=args.write_queue,
+            write_policy=args.write_policy,
+            spill_path=args.spill,
+            spool_path=args.spool,
+            schema=args.schema,
+            receiver_id=args.receiver_id,
+            provision=args.provision,
+            presence=args.presence,
+            presence_idle=args.presence_idle,
+            raw_storage=args.raw_storage,
+            raw_sample_every=args.raw_sample_every,
+            track=args.track,
+            track_tolerance=args.track_tolerance,
+            embed_gps=not args.no_embed_gps
         )
-        tracker.logger.info(
-            "Iniciando captura %s", 
-            "indefinida" if not args.duration else f"por {args.duration} segundos"
-        )
-        tracker.receive_messages(duration=args.duration)
+        if args.drain_spool:
+            tracker.drain_spool()
+        else:
+            tracker.logger.info(
+                "Iniciando captura %s", 
+                "indefinida" if not args.duration else f"por {args.duration} segundos"
+            )
+            if args.ingest == "async":
+                import asyncio
+                from async_ingest import AsyncIngestor
+                try:
+                    asyncio.run(AsyncIngestor(tracker).run(duration=args.duration))
+                except KeyboardInterrupt:
+                    tracker.logger.info("\n=== Captura interrumpida por el usuario ===")
+            else:
+                tracker.receive_messages(duration=args.duration)
     except Exception as e:
         if hasattr(tracker, "logger"):
             tracker.logger.error(f"Error: {e}")
@@ -0,0 +1,49 @@
+import threading
+
+from nmea import FixAssembler
+
+
+class GPSReader(threading.Thread):
+    def __init__(self, port, parse=None, logger=None):
+        """Background thread that owns the GPS port and publishes the latest fix
+
+        The fix is an immutable GPSFix published by replacing the latest
+        reference, so readers just load gps_reader.latest without locks or
+        I/O. parse turns a raw line and its arrival time (None when the port
+        does not report one) into a GPSFix (or None) and defaults to a
+        FixAssembler. The port should have a read timeout so stop() is honoured.
+        """
+        super().__init__(name="GPSReader", daemon=True)
+        self.port = port
+        self.parse = parse or FixAssembler().feed
+        self.logger = logger
+        self.latest = None
+        self.sentences = 0
+        self.errors = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                line = self.port.readline()
+                if not line:
+                    # Timeout or exhausted source, don't spin
+                    self._stop_event.wait(0.05)
+                    continue
+                self.sentences += 1
+                fix = self.parse(line, getattr(self.port, 'arrival_time', None))
+                if fix:
+                    self.latest = fix
+            except Exception as e:
+                self.errors += 1
+                if self.logger:
+                    self.logger.error(f"Error parseando GPS: {e}")
+                if not getattr(self.port, 'is_open', True):
+                    break
+                self._stop_event.wait(0.05)
+
+    def stop(self, timeout=2.0):
+        """Ask the thread to finish and wait for it"""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,330 @@
+import os
+import threading
+import time
+from collections import deque
+
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, PyMongoError
+
+DUPLICATE_KEY = 11000
+
+# Set on each document just before it is inserted; incremental jobs key on it
+INGEST_FIELD = 'ingested_at'
+
+
+def server_time(collection):
+    """Current time on the MongoDB server (naive UTC)
+
+    Ingest marks are stamped and compared on this one clock: the Pi's own
+    clock can be far off until NTP syncs (no RTC, fake-hwclock), and the
+    jobs reading the marks run on other hosts.
+    """
+    return collection.database.command('hello')['localTime']
+
+
+def stamp_ingest(collection, documents, field=INGEST_FIELD):
+    """Record the server's insert time on documents about to be sent to collection"""
+    now = server_time(collection)
+    for document in documents:
+        document[field] = now
+
+
+def unwritten(collection, documents, time_field='timestamp'):
+    """Documents whose _id is not in the collection yet
+
+    Time-series collections do not enforce unique _ids, so a batch retried
+    after an unknown outcome is checked first instead of relying on
+    duplicate-key errors. The time range keeps the lookup on the time index.
+    """
+    ids = [document['_id'] for document in documents if '_id' in document]
+    if not ids:
+        return documents
+    query = {'_id': {'$in': ids}}
+    times = [document[time_field] for document in documents if time_field in document]
+    if times:
+        query[time_field] = {'$gte': min(times), '$lte': max(times)}
+    written = {document['_id'] for document in collection.find(query, {'_id': 1})}
+    return [document for document in documents if document.get('_id') not in written]
+
+
+class BatchWriter(threading.Thread):
+    POLICIES = ('block', 'drop_oldest', 'spill')
+
+    def __init__(
+        self,
+        collection,
+        batch_size=100,
+        flush_interval=0.5,
+        max_queue=10000,
+        policy='block',
+        spill_path=None,
+        ingest_field=None,
+        logger=None
+    ):
+        """Background MongoDB writer with a bounded queue
+
+        Documents are flushed with insert_many(ordered=False) once batch_size
+        have accumulated or the oldest has waited flush_interval seconds.
+        When the queue holds max_queue documents, put() applies the policy:
+        'block' waits for room, 'drop_oldest' discards the oldest queued
+        document and 'spill' appends the new one to spill_path (JSON lines),
+        which is fed back to the database once the queue drains. With
+        ingest_field, every insert attempt stamps its batch with the server time.
+        """
+        super().__init__(name="BatchWriter", daemon=True)
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        if policy == 'spill' and not spill_path:
+            raise ValueError("policy='spill' requires spill_path")
+
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.policy = policy
+        self.spill_path = spill_path
+        self.ingest_field = ingest_field
+        self.logger = logger
+
+        self._queue = deque()  # (enqueued_at, document)
+        self._cond = threading.Condition()
+        self._closing = False
+        self._flushing = 0
+        self._retry_delay = 0.0
+        self._spill_reader = None
+        self._in_flight = None  # Batch taken from the queue and not yet written
+
+        # Statistics
+        self.inserted = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
+        self.errors = 0
+        self.flushes = 0
+        self.batch_sizes = deque(maxlen=100)
+        self.flush_latencies = deque(maxlen=100)
+
+    def put(self, document):
+        """Queue a document; returns False if it was dropped or spilled"""
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                if self.policy == 'block':
+                    while len(self._queue) >= self.max_queue and not self._closing:
+                        self._cond.wait()
+                elif self.policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._spill([document])
+                    return False
+            self._queue.append((time.monotonic(), document))
+            if len(self._queue) == 1 or len(self._queue) >= self.batch_size:
+                # The first document starts the flush_interval timer
+                self._cond.notify_all()
+        return True
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been written"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while (self._queue or self._in_flight) and self.is_alive():
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return not self._queue and not self._in_flight
+
+    def close(self, timeout=10.0):
+        """Flush what can be flushed, then stop the writer thread"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+        with self._cond:
+            left = []
+            if self.is_alive() and self._in_flight:
+                # Timed out while writing: the batch may or may not get through
+                left = list(self._in_flight)
+            if self._queue or left:
+                left += [document for _, document in self._queue]
+                self._queue.clear()
+                if self.spill_path:
+                    self._spill(left)
+                else:
+                    self.failed += len(left)
+                    self._log('error', f"{len(left)} documentos sin escribir al cerrar")
+        if self._spill_reader:
+            self._spill_reader.close()
+
+    def stats(self):
+        """Queue, throughput and latency figures as a plain dict"""
+        latencies = list(self.flush_latencies)
+        sizes = list(self.batch_sizes)
+        return {
+            'queued': len(self._queue),
+            'inserted': self.inserted,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'failed': self.failed,
+            'errors': self.errors,
+            'flushes': self.flushes,
+            'batch_size_mean': sum(sizes) / len(sizes) if sizes else 0,
+            'flush_ms_mean': 1000 * sum(latencies) / len(latencies) if latencies else 0,
+            'flush_ms_max': 1000 * max(latencies) if latencies else 0,
+        }
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if batch:
+                if self._retry_delay and not self._check_written(batch):
+                    if self._closing:
+                        return
+                    self._backoff()
+                    continue
+                if batch and not self._insert(batch):
+                    self._requeue(batch)
+                    if self._closing:
+                        return
+                    self._backoff()
+                    continue
+                self._written()
+            elif self._spill_reader or self._spill_pending():
+                self._reload_spill()
+
+    def _next_batch(self):
+        """Wait for a full batch or an expired one; [] means idle, None means stop"""
+        with self._cond:
+            while True:
+                if self._queue:
+                    waited = time.monotonic() - self._queue[0][0]
+                    if (len(self._queue) >= self.batch_size or self._closing
+                            or self._flushing or waited >= self.flush_interval):
+                        count = min(self.batch_size, len(self._queue))
+                        batch = [self._queue.popleft()[1] for _ in range(count)]
+                        self._in_flight = batch
+                        self._cond.notify_all()  # Room for blocked producers
+                        return batch
+                    timeout = self.flush_interval - waited
+                elif self._closing:
+                    return None
+                elif self._spill_reader or self._spill_pending():
+                    return []
+                else:
+                    timeout = None
+                self._cond.wait(timeout)
+
+    def _insert(self, batch):
+        """insert_many one batch; False on a connection-level failure"""
+        start = time.monotonic()
+        inserted = len(batch)
+        try:
+            if self.ingest_field:
+                stamp_ingest(self.collection, batch, self.ingest_field)
+            self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            inserted = e.details.get('nInserted', 0)
+            # Duplicates come from retried batches that partially succeeded
+            errors = [err for err in e.details.get('writeErrors', [])
+                      if err.get('code') != DUPLICATE_KEY]
+            if errors:
+                self.failed += len(errors)
+                self._log('error', f"{len(errors)} documentos rechazados: {errors[0].get('errmsg')}")
+        except PyMongoError as e:
+            self.errors += 1
+            self._log('error', f"Error escribiendo lote en BD: {e}")
+            return False
+
+        elapsed = time.monotonic() - start
+        self.inserted += inserted
+        self.flushes += 1
+        self.batch_sizes.append(len(batch))
+        self.flush_latencies.append(elapsed)
+        self._retry_delay = 0.0
+        self._log('debug', f"Lote de {len(batch)} documentos escrito en {elapsed * 1000:.1f} ms")
+        return True
+
+    def _written(self):
+        """The batch taken from the queue is in the database"""
+        with self._cond:
+            self._in_flight = None
+            self._cond.notify_all()  # Wake flush() waiters
+
+    def _check_written(self, batch):
+        """Drop documents of a retried batch that already reached the database"""
+        try:
+            batch[:] = unwritten(self.collection, batch)
+        except PyMongoError as e:
+            self._log('error', f"Error comprobando lote reintentado: {e}")
+            self._requeue(batch)
+            return False
+        return True
+
+    def _requeue(self, batch):
+        with self._cond:
+            self._in_flight = None
+            self._queue.extendleft((time.monotonic(), document) for document in reversed(batch))
+
+    def _backoff(self):
+        """Wait before retrying after a failure (interrupted by close)"""
+        self._retry_delay = min(max(self._retry_delay * 2, 0.5), 30.0)
+        with self._cond:
+            self._cond.wait_for(lambda: self._closing, self._retry_delay)
+
+    def _spill(self, documents):
+        with open(self.spill_path, 'a', encoding='utf-8') as f:
+            for document in documents:
+                # The _id makes the reload idempotent if a send already got through
+                document.setdefault('_id', ObjectId())
+                f.write(json_util.dumps(document))
+                f.write('\n')
+        self.spilled += len(documents)
+
+    def _spill_pending(self):
+        return bool(self.spill_path) and os.path.exists(self.spill_path)
+
+    def _reload_spill(self):
+        """Feed one batch of spilled documents back to the database"""
+        if self._spill_reader is None:
+            reloading = self.spill_path + '.reloading'
+            if not os.path.exists(reloading):
+                with self._cond:
+                    os.replace(self.spill_path, reloading)
+            self._spill_reader = open(reloading, 'r', encoding='utf-8')
+
+        position = self._spill_reader.tell()
+        batch = []
+        while len(batch) < self.batch_size:
+            line = self._spill_reader.readline()
+            if not line:
+                break
+            batch.append(json_util.loads(line))
+
+        if not batch:
+            self._spill_reader.close()
+            os.remove(self._spill_reader.name)
+            self._spill_reader = None
+            self._log('info', "Documentos volcados a disco reenviados a la BD")
+            return
+        try:
+            # Some may have got through before a crash or a close() timeout
+            batch = unwritten(self.collection, batch)
+        except PyMongoError as e:
+            self._log('error', f"Error comprobando documentos volcados a disco: {e}")
+        else:
+            if not batch or self._insert(batch):
+                return
+        self._spill_reader.seek(position)
+        self._backoff()
+
+    def _log(self, level, message):
+        if self.logger:
+            getattr(self.logger, level)(message)
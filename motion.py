@@ -0,0 +1,122 @@
+import math
+from collections import namedtuple
+from enum import Enum
+
+from fix_history import METRES_PER_SECOND_PER_KNOT
+from track import METRES_PER_DEGREE
+
+
+class MotionState(str, Enum):
+    UNKNOWN = "unknown"
+    STATIONARY = "stationary"
+    MOVING = "moving"
+
+
+MotionEvent = namedtuple('MotionEvent', ['state', 'timestamp', 'speed'])
+MotionEvent.__doc__ = """Confirmed transition; timestamp is when the new state started"""
+
+
+class MotionDetector:
+    def __init__(self, moving_speed=1.0, stationary_speed=0.5, moving_after=5.0,
+                 stationary_after=30.0, sog_sigma=0.3, position_sigma=3.0,
+                 position_baseline=30.0, acceleration=0.5, max_gap=10.0):
+        """Debounced stationary/moving classification of a GPSFix stream
+
+        Speed (knots) is estimated with a one-dimensional Kalman filter fed
+        two measurements: the receiver's speed over ground of every fix
+        (noise sog_sigma knots) and, every position_baseline seconds, the
+        speed implied by the position change over that baseline (noise from
+        position_sigma metres; a long baseline keeps jitter at the pier from
+        looking like motion). acceleration (knots per second) sets how
+        quickly the estimate may change. The state switches to
+        MOVING once the estimate stays above moving_speed for moving_after
+        seconds, and back to STATIONARY once it stays below stationary_speed
+        for stationary_after seconds. O(1) per fix.
+        """
+        self.moving_speed = moving_speed
+        self.stationary_speed = stationary_speed
+        self.moving_after = moving_after
+        self.stationary_after = stationary_after
+        self.sog_variance = sog_sigma ** 2
+        self.position_sigma = position_sigma
+        self.position_baseline = position_baseline
+        self.acceleration = acceleration
+        self.max_gap = max_gap
+
+        self.state = MotionState.UNKNOWN
+        self.since = None
+        self.speed = None
+        self.transitions = 0
+        self._variance = None
+        self._previous = None
+        self._anchor = None
+        self._candidate = None
+        self._candidate_since = None
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    @property
+    def moving(self):
+        return self.state == MotionState.MOVING
+
+    def update(self, fix):
+        """Feed a GPSFix; returns a MotionEvent on a confirmed transition, else None"""
+        now = fix.received_at
+        previous, self._previous = self._previous, fix
+        if previous is None or now - previous.received_at > self.max_gap:
+            # (Re)start the filter from the reported speed
+            self.speed = fix.speed or 0.0
+            self._variance = self.sog_variance
+            self._anchor = fix
+        else:
+            elapsed = now - previous.received_at
+            if elapsed <= 0:
+                return None
+            self._variance += (self.acceleration * elapsed) ** 2
+            if fix.speed is not None:
+                self._correct(fix.speed, self.sog_variance)
+            baseline = now - self._anchor.received_at
+            if baseline >= self.position_baseline:
+                # Both positions carry position_sigma of noise
+                sigma = math.sqrt(2) * self.position_sigma / baseline / METRES_PER_SECOND_PER_KNOT
+                self._correct(self._position_speed(self._anchor, fix) / baseline, sigma ** 2)
+                self._anchor = fix
+        return self._classify(now)
+
+    def _correct(self, measurement, variance):
+        gain = self._variance / (self._variance + variance)
+        self.speed += gain * (measurement - self.speed)
+        self._variance *= 1 - gain
+
+    @staticmethod
+    def _position_speed(a, b):
+        """Distance between two fixes in knot-seconds"""
+        dy = (b.latitude - a.latitude) * METRES_PER_DEGREE
+        dx = (b.longitude - a.longitude) * METRES_PER_DEGREE * math.cos(math.radians(a.latitude))
+        return math.hypot(dx, dy) / METRES_PER_SECOND_PER_KNOT
+
+    def _classify(self, now):
+        if self.speed > self.moving_speed:
+            candidate, needed = MotionState.MOVING, self.moving_after
+        elif self.speed < self.stationary_speed:
+            candidate, needed = MotionState.STATIONARY, self.stationary_after
+        else:
+            candidate, needed = None, None  # Between thresholds: keep the current state
+
+        if candidate is None or candidate == self.state:
+            self._candidate = self._candidate_since = None
+            return None
+        if candidate != self._candidate:
+            self._candidate, self._candidate_since = candidate, now
+        if now - self._candidate_since < needed:
+            return None
+
+        self.state, self.since = candidate, self._candidate_since
+        self._candidate = self._candidate_since = None
+        self.transitions += 1
+        event = MotionEvent(self.state, self.since, round(self.speed, 2))
+        for callback in self._subscribers:
+            callback(event)
+        return event
@@ -0,0 +1,222 @@
+import time
+from collections import namedtuple
+
+KNOTS_PER_KMH = 1 / 1.852
+
+
+class GPSFix(namedtuple('GPSFix', [
+        'latitude', 'longitude', 'speed', 'received_at',
+        'course', 'fix_quality', 'satellites', 'hdop', 'altitude'],
+        defaults=(None, None, None, None, None))):
+    """Immutable GPS fix; received_at is the local arrival time of the sentence"""
+    __slots__ = ()
+
+    def age(self, now=None):
+        """Seconds since the fix was received"""
+        return (time.time() if now is None else now) - self.received_at
+
+    def as_document(self):
+        """Fix in the gps_data shape stored with each buffer"""
+        document = {
+            "coordinates": {
+                "longitude": self.longitude,
+                "latitude": self.latitude,
+            },
+            "speed": self.speed,
+            "track_valid": True,
+            # GeoJSON point for the 2dsphere index
+            "location": {
+                "type": "Point",
+                "coordinates": [self.longitude, self.latitude],
+            },
+        }
+        for field in ('course', 'fix_quality', 'satellites', 'hdop', 'altitude'):
+            value = getattr(self, field)
+            if value is not None:
+                document[field] = value
+        return document
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def _float(field):
+    return float(field) if field else None
+
+
+def _int(field):
+    return int(field) if field else None
+
+
+def _degrees(value, hemisphere):
+    """ddmm.mmmm / dddmm.mmmm plus N/S/E/W to signed decimal degrees"""
+    if not value:
+        return None
+    dot = value.find(b'.')
+    if dot < 0:
+        dot = len(value)
+    decimal = int(value[:dot - 2] or 0) + float(value[dot - 2:]) / 60
+    return -decimal if hemisphere in (b'S', b'W') else decimal
+
+
+def checksum(body):
+    """XOR of all bytes between '$' and '*'"""
+    value = 0
+    for byte in body:
+        value ^= byte
+    return value
+
+
+def parse_sentence(raw):
+    """Parse one raw NMEA line (bytes) into (kind, fields) for RMC, GGA and VTG
+
+    Any talker is accepted ($GP, $GN, $GL, ...). Returns None for other or
+    malformed sentences and raises ChecksumError on a bad *hh checksum.
+    """
+    line = raw.strip()
+    if not line.startswith(b'$'):
+        return None
+    star = line.rfind(b'*')
+    if star < 0 or len(line) < star + 3:
+        return None
+    body = line[1:star]
+    try:
+        expected = int(line[star + 1:star + 3], 16)
+    except ValueError:
+        expected = None  # Not hex: as bad as a wrong checksum
+    if checksum(body) != expected:
+        raise ChecksumError(line.decode('ascii', errors='replace'))
+
+    fields = body.split(b',')
+    kind = fields[0][2:]
+    try:
+        if kind == b'RMC':
+            return 'RMC', {
+                'time': fields[1],
+                'valid': fields[2] == b'A',
+                'latitude': _degrees(fields[3], fields[4]),
+                'longitude': _degrees(fields[5], fields[6]),
+                'speed': _float(fields[7]),
+                'course': _float(fields[8]),
+            }
+        if kind == b'GGA':
+            return 'GGA', {
+                'time': fields[1],
+                'latitude': _degrees(fields[2], fields[3]),
+                'longitude': _degrees(fields[4], fields[5]),
+                'fix_quality': _int(fields[6]),
+                'satellites': _int(fields[7]),
+                'hdop': _float(fields[8]),
+                'altitude': _float(fields[9]),
+            }
+        if kind == b'VTG':
+            speed = _float(fields[5])
+            if speed is None and fields[7]:
+                speed = float(fields[7]) * KNOTS_PER_KMH
+            return 'VTG', {
+                'course': _float(fields[1]),
+                'speed': speed,
+            }
+    except (IndexError, ValueError):
+        return None
+    return None
+
+
+class FixAssembler:
+    def __init__(self, max_hdop=None, min_satellites=None):
+        """Combine RMC, GGA and VTG sentences of one epoch into a GPSFix
+
+        Until a GGA has been seen (and unless quality limits are set, which
+        need GGA), every valid RMC is emitted straight away. Otherwise an
+        epoch is emitted as soon as both its RMC and GGA have arrived, or
+        when a sentence of the next epoch shows up. Fixes whose GGA reports
+        no fix, too few satellites or an HDOP above max_hdop are rejected
+        before they reach storage.
+        """
+        self.max_hdop = max_hdop
+        self.min_satellites = min_satellites
+        self.sentences = 0
+        self.checksum_errors = 0
+        self.rejected = 0
+        self._gga_seen = max_hdop is not None or min_satellites is not None
+        self._reset(None)
+
+    def _reset(self, epoch):
+        self._epoch = epoch
+        self._rmc = None
+        self._gga = None
+        self._vtg = None
+        self._received_at = None
+
+    def feed(self, line, received_at=None):
+        """Feed one raw NMEA line; returns a new GPSFix when an epoch completes"""
+        if isinstance(line, str):
+            line = line.encode('ascii', errors='replace')
+        try:
+            sentence = parse_sentence(line)
+        except ChecksumError:
+            self.checksum_errors += 1
+            return None
+        if not sentence:
+            return None
+        self.sentences += 1
+        kind, fields = sentence
+
+        if kind == 'VTG':
+            self._vtg = fields
+            return None
+
+        fix = None
+        if fields['time'] != self._epoch:
+            fix = self._flush()
+            self._reset(fields['time'])
+        if kind == 'RMC':
+            self._rmc = fields
+            self._received_at = time.time() if received_at is None else received_at
+        else:
+            self._gga = fields
+            self._gga_seen = True
+
+        if self._rmc and (self._gga or not self._gga_seen):
+            fix = self._flush()
+            self._reset(self._epoch)
+        return fix
+
+    def _flush(self):
+        """Build the fix for the current epoch, None if invalid or rejected"""
+        rmc, gga, vtg = self._rmc, self._gga, self._vtg
+        self._rmc = self._gga = None
+        if not rmc or not rmc['valid'] or rmc['latitude'] is None:
+            return None
+
+        if gga and not self._good_quality(gga):
+            self.rejected += 1
+            return None
+
+        speed = rmc['speed']
+        course = rmc['course']
+        if vtg:
+            speed = vtg['speed'] if speed is None else speed
+            course = vtg['course'] if course is None else course
+        gga = gga or {}
+        return GPSFix(
+            latitude=rmc['latitude'],
+            longitude=rmc['longitude'],
+            speed=speed or 0,
+            received_at=self._received_at,
+            course=course,
+            fix_quality=gga.get('fix_quality'),
+            satellites=gga.get('satellites'),
+            hdop=gga.get('hdop'),
+            altitude=gga.get('altitude'),
+        )
+
+    def _good_quality(self, gga):
+        if not gga['fix_quality']:
+            return False
+        if self.min_satellites is not None and (gga['satellites'] or 0) < self.min_satellites:
+            return False
+        if self.max_hdop is not None and (gga['hdop'] is None or gga['hdop'] > self.max_hdop):
+            return False
+        return True
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+
+def position_point(gps_data):
+    """GeoJSON point of a gps_data document, None without a fix"""
+    if not gps_data or not gps_data.get('coordinates'):
+        return None
+    coordinates = gps_data['coordinates']
+    return {'type': 'Point', 'coordinates': [coordinates['longitude'], coordinates['latitude']]}
+
+
+class PresenceInterval:
+    """Continuous sighting of one MAC"""
+    __slots__ = ('mac', 'first_seen', 'last_seen', 'count', 'n_adv',
+                 'rssi_min', 'rssi_max', 'rssi_sum', 'first_position', 'last_position')
+
+    def __init__(self, mac, timestamp, rssi, n_adv, position):
+        self.mac = mac
+        self.first_seen = self.last_seen = timestamp
+        self.count = 1
+        self.n_adv = n_adv
+        self.rssi_min = self.rssi_max = self.rssi_sum = rssi
+        self.first_position = self.last_position = position
+
+    def update(self, timestamp, rssi, n_adv, position):
+        self.last_seen = timestamp
+        self.count += 1
+        self.n_adv += n_adv
+        self.rssi_sum += rssi
+        if rssi < self.rssi_min:
+            self.rssi_min = rssi
+        elif rssi > self.rssi_max:
+            self.rssi_max = rssi
+        if position:
+            self.last_position = position
+            if not self.first_position:
+                self.first_position = position
+
+    def to_document(self, receiver_id=None, closed_by=None):
+        return {
+            'mac': self.mac,
+            'receiver_id': receiver_id,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+            'duration_s': (self.last_seen - self.first_seen).total_seconds(),
+            'count': self.count,
+            'n_adv': self.n_adv,
+            'rssi_min': self.rssi_min,
+            'rssi_max': self.rssi_max,
+            'rssi_mean': round(self.rssi_sum / self.count, 2),
+            'first_position': self.first_position,
+            'last_position': self.last_position,
+            'closed_by': closed_by,
+        }
+
+
+class PresenceTable:
+    def __init__(self, idle_timeout=60.0, max_entries=10000):
+        """Per-MAC presence intervals built from consecutive buffers
+
+        Entries are kept in least-recently-seen order, so closing idle
+        intervals only looks at the front. An interval is closed when its
+        MAC has not been seen for idle_timeout seconds, or early when the
+        table grows past max_entries (least recently seen first).
+        """
+        self.idle_timeout = idle_timeout
+        self.max_entries = max_entries
+        self._open = OrderedDict()
+        self.closed = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._open)
+
+    def observe(self, macs, rssis, n_advs, timestamp, position=None):
+        """Account for one buffer; returns intervals closed by LRU eviction"""
+        table = self._open
+        for mac, rssi, n_adv in zip(macs, rssis, n_advs):
+            interval = table.get(mac)
+            if interval is None:
+                table[mac] = PresenceInterval(mac, timestamp, rssi, n_adv, position)
+            else:
+                interval.update(timestamp, rssi, n_adv, position)
+                table.move_to_end(mac)
+
+        evicted = []
+        while len(table) > self.max_entries:
+            evicted.append(table.popitem(last=False)[1])
+        self.evicted += len(evicted)
+        self.closed += len(evicted)
+        return evicted
+
+    def expire(self, now):
+        """Close and return the intervals idle for longer than idle_timeout"""
+        table = self._open
+        expired = []
+        while table:
+            interval = next(iter(table.values()))
+            if (now - interval.last_seen).total_seconds() <= self.idle_timeout:
+                break
+            expired.append(table.popitem(last=False)[1])
+        self.closed += len(expired)
+        return expired
+
+    def close_all(self):
+        """Close every open interval (e.g. on shutdown)"""
+        intervals = list(self._open.values())
+        self._open.clear()
+        self.closed += len(intervals)
+        return intervals
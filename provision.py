@@ -0,0 +1,97 @@
+from pymongo import ASCENDING, GEOSPHERE
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from mongo_writer import INGEST_FIELD
+
+TIME_FIELD = 'timestamp'
+META_FIELD = 'receiver_id'
+
+INDEXES = [
+    ([(META_FIELD, ASCENDING), (TIME_FIELD, ASCENDING)], 'receiver_time'),
+    ([('devices.mac', ASCENDING), (TIME_FIELD, ASCENDING)], 'device_mac_time'),
+    ([('macs', ASCENDING), (TIME_FIELD, ASCENDING)], 'compact_mac_time'),
+    ([('gps_data.location', GEOSPHERE)], 'gps_location'),
+    ([('trip_id', ASCENDING), (TIME_FIELD, ASCENDING)], 'trip_time'),
+    ([(META_FIELD, ASCENDING), (INGEST_FIELD, ASCENDING)], 'receiver_ingested'),
+]
+
+
+def provision_collection(db, name, granularity='seconds', timeseries=True, logger=None):
+    """Create the buffer collection and its indexes if they are missing
+
+    A new collection is created as a time-series collection (timestamp as
+    timeField, receiver_id as metaField) when timeseries is true. An
+    existing plain collection is kept as is, since it cannot be converted
+    in place. Indexes cover queries by receiver and time, by MAC (full and
+    compact schemas), by GeoJSON position, by trip and by receiver and
+    insert time (for incremental jobs). Safe to call on every start.
+    """
+    collection = db[name]
+    if name not in db.list_collection_names():
+        options = {}
+        if timeseries:
+            options['timeseries'] = {
+                'timeField': TIME_FIELD,
+                'metaField': META_FIELD,
+                'granularity': granularity,
+            }
+        try:
+            collection = db.create_collection(name, **options)
+            _log(logger, 'info', f"Colección {name} creada"
+                 + (" (time-series)" if timeseries else ""))
+        except CollectionInvalid:
+            pass  # Created concurrently by another receiver
+    elif timeseries and 'timeseries' not in collection.options():
+        _log(logger, 'warning', f"La colección {name} ya existe y no es time-series; se mantiene")
+
+    return _create_indexes(collection, INDEXES, logger)
+
+
+PRESENCE_INDEXES = [
+    ([('mac', ASCENDING), ('first_seen', ASCENDING)], 'mac_first_seen'),
+    ([(META_FIELD, ASCENDING), ('first_seen', ASCENDING)], 'receiver_first_seen'),
+    ([('first_position', GEOSPHERE)], 'first_position'),
+]
+
+
+def provision_presence(db, name, logger=None):
+    """Indexes for the presence interval collection (a plain collection)"""
+    return _create_indexes(db[name], PRESENCE_INDEXES, logger)
+
+
+TRACK_INDEXES = [
+    # Unique, so a chunk re-sent after a failed write is not stored twice
+    ([('trip_id', ASCENDING), ('chunk', ASCENDING)], 'trip_chunk', {'unique': True}),
+    ([(META_FIELD, ASCENDING), ('start', ASCENDING)], 'receiver_start'),
+]
+
+
+def provision_tracks(db, name, logger=None):
+    """Indexes for the track chunk collection (a plain collection)"""
+    return _create_indexes(db[name], TRACK_INDEXES, logger)
+
+
+TRIP_INDEXES = [
+    ([(META_FIELD, ASCENDING), ('start', ASCENDING)], 'receiver_start'),
+    ([('start_position', GEOSPHERE)], 'start_position'),
+]
+
+
+def provision_trips(db, name, logger=None):
+    """Indexes for the trip summary collection (_id is the trip_id)"""
+    return _create_indexes(db[name], TRIP_INDEXES, logger)
+
+
+def _create_indexes(collection, indexes, logger):
+    """Create (keys, name[, options]) indexes, logging the ones that fail"""
+    for keys, index_name, *options in indexes:
+        try:
+            collection.create_index(keys, name=index_name, **(options[0] if options else {}))
+        except OperationFailure as e:
+            _log(logger, 'error', f"No se pudo crear el índice {index_name}: {e}")
+    return collection
+
+
+def _log(logger, level, message):
+    if logger:
+        getattr(logger, level)(message)
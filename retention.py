@@ -0,0 +1,337 @@
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient
+
+from mongo_writer import server_time
+from rollups import BUFFER_MACS, BUFFER_RSSI, EPOCH, MAC_UNION, ingested
+
+STATE_ID = 'retention'
+
+HOUR = timedelta(hours=1)
+
+# Per-device fields of a buffer in either the full or the compact schema
+DEVICES = {'$ifNull': ['$devices', {'$map': {
+    'input': {'$range': [0, {'$size': {'$ifNull': ['$macs', []]}}]},
+    'as': 'i',
+    'in': {
+        'mac': {'$arrayElemAt': ['$macs', '$$i']},
+        'rssi': {'$arrayElemAt': ['$rssi', '$$i']},
+        'n_adv': {'$arrayElemAt': ['$n_adv', '$$i']},
+    },
+}}]}
+
+
+def _floor_hour(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def _merge(target, add):
+    """$merge into target: replace the hour's summary, or add to it the fields in add"""
+    if not add:
+        return {'$merge': {'into': target, 'on': '_id', 'whenMatched': 'replace'}}
+    return {'$merge': {'into': target, 'on': '_id', 'whenMatched': [{'$set': add}]}}
+
+
+def _weighted_mean(field, weight):
+    """Mean of the stored and new field values, weighted by their weight field"""
+    return {'$let': {
+        'vars': {'total': {'$add': [f'${weight}', f'$$new.{weight}']}},
+        'in': {'$cond': [{'$gt': ['$$total', 0]}, {'$divide': [{'$add': [
+            {'$multiply': [{'$ifNull': [f'${field}', 0]}, f'${weight}']},
+            {'$multiply': [{'$ifNull': [f'$$new.{field}', 0]}, f'$$new.{weight}']},
+        ]}, '$$total']}, None]},
+    }}
+
+
+# Adds a late buffers' summary to the one already stored for the hour
+HOURLY_MAC_ADD = {
+    'sightings': {'$add': ['$sightings', '$$new.sightings']},
+    'n_adv': {'$add': ['$n_adv', '$$new.n_adv']},
+    'rssi_min': {'$min': ['$rssi_min', '$$new.rssi_min']},
+    'rssi_max': {'$max': ['$rssi_max', '$$new.rssi_max']},
+    'rssi_mean': _weighted_mean('rssi_mean', 'sightings'),
+    'first_seen': {'$min': ['$first_seen', '$$new.first_seen']},
+    'last_seen': {'$max': ['$last_seen', '$$new.last_seen']},
+}
+
+HOURLY_AREA_ADD = {
+    'buffers': {'$add': ['$buffers', '$$new.buffers']},
+    'n_adv_raw': {'$add': ['$n_adv_raw', '$$new.n_adv_raw']},
+    'macs': {'$setUnion': ['$macs', '$$new.macs']},
+    'unique_macs': {'$size': {'$setUnion': ['$macs', '$$new.macs']}},
+    'rssi_mean': _weighted_mean('rssi_mean', 'rssi_count'),
+    'rssi_count': {'$add': ['$rssi_count', '$$new.rssi_count']},
+}
+
+
+def hourly_mac_pipeline(start, end, target='hourly_mac', match=None, add=False):
+    """Per receiver, hour and MAC: sightings, n_adv and RSSI statistics
+
+    match narrows the hour's buffers (e.g. to an insert-time range); with
+    add they are added to the stored summary instead of replacing it.
+    """
+    return [
+        {'$match': dict(match or {}, timestamp={'$gte': start, '$lt': end})},
+        {'$project': {'receiver_id': 1, 'timestamp': 1, 'device': DEVICES}},
+        {'$unwind': '$device'},
+        {'$group': {
+            '_id': {'receiver_id': '$receiver_id', 'hour': start, 'mac': '$device.mac'},
+            'sightings': {'$sum': 1},
+            'n_adv': {'$sum': '$device.n_adv'},
+            'rssi_min': {'$min': '$device.rssi'},
+            'rssi_max': {'$max': '$device.rssi'},
+            'rssi_mean': {'$avg': '$device.rssi'},
+            'first_seen': {'$min': '$timestamp'},
+            'last_seen': {'$max': '$timestamp'},
+        }},
+        _merge(target, add and HOURLY_MAC_ADD),
+    ]
+
+
+def hourly_area_pipeline(start, end, grid, target='hourly_area', match=None, add=False):
+    """Per receiver, hour and grid cell (grid degrees): buffers, unique MACs and RSSI
+
+    match and add as for hourly_mac_pipeline.
+    """
+    def cell(axis):
+        return {'$multiply': [{'$floor': {'$divide': [f'$gps_data.coordinates.{axis}', grid]}}, grid]}
+
+    return [
+        {'$match': dict(
+            match or {},
+            timestamp={'$gte': start, '$lt': end},
+            **{'gps_data.coordinates.latitude': {'$type': 'number'}},
+        )},
+        {'$group': {
+            '_id': {
+                'receiver_id': '$receiver_id',
+                'hour': start,
+                'cell': {'latitude': cell('latitude'), 'longitude': cell('longitude')},
+            },
+            'buffers': {'$sum': 1},
+            'n_adv_raw': {'$sum': '$n_adv_raw'},
+            'mac_sets': {'$push': BUFFER_MACS},
+            'rssi_sum': {'$sum': {'$sum': BUFFER_RSSI}},
+            'rssi_count': {'$sum': {'$size': BUFFER_RSSI}},
+        }},
+        {'$set': {'macs': MAC_UNION}},
+        {'$set': {
+            'unique_macs': {'$size': '$macs'},
+            'rssi_mean': {'$cond': [
+                {'$gt': ['$rssi_count', 0]}, {'$divide': ['$rssi_sum', '$rssi_count']}, None]},
+            'grid': grid,
+        }},
+        {'$unset': ['mac_sets', 'rssi_sum']},
+        _merge(target, add and HOURLY_AREA_ADD),
+    ]
+
+
+class RetentionJob:
+    def __init__(self, db, source='portfinal', raw_days=30, grid=0.01,
+                 delete_batch=5000, pause=0.5, settle=10, logger=None):
+        """Downsample raw buffers older than raw_days, then expire them
+
+        Each whole hour past the retention window is summarised into
+        hourly_mac (per receiver and MAC) and hourly_area (per receiver and
+        grid cell of grid degrees), then recorded as downsampled in
+        retention_state together with the insert-time (ingested_at) mark
+        it covers; buffers inserted less than settle seconds ago wait for
+        the next run. The batched delete of run() only removes buffers below
+        both marks, so a buffer uploaded after its hour was summarised is
+        added to the summary before it goes. The TTL set with ensure_ttl()
+        goes by age alone. Both the aggregation (one hour at a time) and the
+        delete (delete_batch documents at a time) pause between steps to
+        stay out of the way of live ingestion.
+        """
+        self.db = db
+        self.source = db[source]
+        self.state = db['retention_state']
+        self.raw_days = raw_days
+        self.grid = grid
+        self.delete_batch = delete_batch
+        self.pause = pause
+        self.settle = settle
+        self.logger = logger or logging.getLogger(__name__)
+
+    def cutoff(self, now=None):
+        """Start of the hour before which raw buffers are past retention"""
+        return _floor_hour((now or datetime.now()) - timedelta(days=self.raw_days))
+
+    def ensure_ttl(self, grace_days=2):
+        """Let MongoDB expire raw buffers grace_days after the retention window
+
+        The grace period leaves time for downsample() to summarise an hour
+        before the TTL monitor removes it. Time-series collections use
+        expireAfterSeconds, plain collections a TTL index on timestamp.
+        """
+        seconds = int(timedelta(days=self.raw_days + grace_days).total_seconds())
+        if 'timeseries' in self.source.options():
+            self.db.command('collMod', self.source.name, expireAfterSeconds=seconds)
+        elif 'timestamp_ttl' in self.source.index_information():
+            self.db.command('collMod', self.source.name, index={
+                'name': 'timestamp_ttl', 'expireAfterSeconds': seconds,
+            })
+        else:
+            self.source.create_index('timestamp', name='timestamp_ttl', expireAfterSeconds=seconds)
+        self.logger.info(f"TTL de {self.source.name}: {seconds} s")
+
+    def _state(self):
+        return self.state.find_one({'_id': STATE_ID}) or {}
+
+    def _save(self, fields, unset=None):
+        update = {'$set': dict(fields, updated_at=datetime.now())}
+        if unset:
+            update['$unset'] = dict.fromkeys(unset, '')
+        self.state.update_one({'_id': STATE_ID}, update, upsert=True)
+
+    def downsampled_through(self):
+        return self._state().get('downsampled_through')
+
+    def downsample(self, now=None):
+        """Summarise every whole hour older than the cutoff; returns hours processed
+
+        Buffers inserted since the last run into hours already summarised
+        (a spool uploaded late) are added to those hours' summaries first.
+        Both passes only take buffers inserted up to the run's insert-time
+        mark, which delete_expired() then uses as its limit.
+        """
+        cutoff = self.cutoff(now)
+        state = self._state()
+        # An interrupted late pass resumes with its own insert-time mark
+        upper = state.get('pending_ingested') or (
+            server_time(self.source) - timedelta(seconds=self.settle))
+        hours = 0
+        if state.get('downsampled_through') and 'ingested_through' in state:
+            hours += self._add_late(state, upper)
+        self._save({'ingested_through': upper}, unset=['pending_ingested', 'late_through'])
+
+        inserted = ingested(EPOCH, upper)
+        while True:
+            mark = self.downsampled_through()
+            query = {'timestamp': {'$lt': cutoff}}
+            if mark:
+                query['timestamp']['$gte'] = mark
+            oldest = self.source.find_one(query, {'timestamp': 1}, sort=[('timestamp', 1)])
+            if not oldest:
+                return hours
+            start = _floor_hour(oldest['timestamp'])
+            end = start + HOUR
+
+            self.source.aggregate(hourly_mac_pipeline(start, end, match=inserted), allowDiskUse=True)
+            self.source.aggregate(
+                hourly_area_pipeline(start, end, self.grid, match=inserted), allowDiskUse=True)
+            self._save({'downsampled_through': end})
+            self.logger.info(f"Resumen horario {start:%Y-%m-%d %H:00} completado")
+            hours += 1
+            time.sleep(self.pause)
+
+    def _add_late(self, state, upper):
+        """Add buffers inserted in (ingested_through, upper] to already summarised hours"""
+        late = ingested(state['ingested_through'], upper)
+        resume = state.get('late_through')
+        hours = 0
+        while True:
+            query = dict(late, timestamp={'$lt': state['downsampled_through']})
+            if resume:
+                query['timestamp']['$gte'] = resume
+            oldest = self.source.find_one(query, {'timestamp': 1}, sort=[('timestamp', 1)])
+            if not oldest:
+                return hours
+            start = _floor_hour(oldest['timestamp'])
+            resume = start + HOUR
+
+            self.source.aggregate(
+                hourly_mac_pipeline(start, resume, match=late, add=True), allowDiskUse=True)
+            self.source.aggregate(
+                hourly_area_pipeline(start, resume, self.grid, match=late, add=True), allowDiskUse=True)
+            self._save({'pending_ingested': upper, 'late_through': resume})
+            self.logger.info(f"Resumen horario {start:%Y-%m-%d %H:00}: buffers tardíos añadidos")
+            hours += 1
+            time.sleep(self.pause)
+
+    def delete_expired(self):
+        """Delete downsampled raw buffers in batches; returns the number deleted
+
+        Only buffers summarised by downsample() go: older than the
+        downsampled_through hour and inserted up to its insert-time mark.
+        Late buffers wait for the next downsample(). Time-series collections
+        only accept this from MongoDB 7.0 on; use ensure_ttl() on older
+        servers.
+        """
+        state = self._state()
+        mark = state.get('downsampled_through')
+        if not mark or 'ingested_through' not in state:
+            return 0
+        query = dict(ingested(EPOCH, state['ingested_through']), timestamp={'$lt': mark})
+        deleted = 0
+        while True:
+            ids = [document['_id'] for document in self.source.find(
+                query, {'_id': 1}).limit(self.delete_batch)]
+            if not ids:
+                break
+            deleted += self.source.delete_many({'_id': {'$in': ids}}).deleted_count
+            time.sleep(self.pause)
+        if deleted:
+            self.logger.info(f"{deleted} buffers anteriores a {mark} eliminados")
+        return deleted
+
+    def run(self, now=None, delete=True):
+        hours = self.downsample(now)
+        deleted = self.delete_expired() if delete else 0
+        return hours, deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retención y resumen horario de buffers crudos")
+    parser.add_argument(
+        "--mongo-uri",
+        type=str,
+        default="mongodb://localhost:27017/",
+        help="URI de MongoDB (default: mongodb://localhost:27017/)",
+    )
+    parser.add_argument(
+        "--raw-days", type=float, default=30, help="Días que se conservan los buffers crudos (default: 30)"
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=["job", "ttl"],
+        default="job",
+        help="Borrado por este job en lotes o por TTL de MongoDB (default: job)"
+    )
+    parser.add_argument(
+        "--grid", type=float, default=0.01, help="Tamaño de celda en grados del resumen por zona (default: 0.01)"
+    )
+    parser.add_argument(
+        "--delete-batch", type=int, default=5000, help="Buffers por lote de borrado (default: 5000)"
+    )
+    parser.add_argument(
+        "--pause", type=float, default=0.5, help="Pausa en segundos entre lotes (default: 0.5)"
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=10,
+        help="Segundos de margen para buffers todavía en vuelo (default: 10)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    client = MongoClient(args.mongo_uri)
+    try:
+        job = RetentionJob(
+            client.tracking_data,
+            raw_days=args.raw_days,
+            grid=args.grid,
+            delete_batch=args.delete_batch,
+            pause=args.pause,
+            settle=args.settle
+        )
+        if args.mode == "ttl":
+            job.ensure_ttl()
+        job.run(delete=args.mode == "job")
+    finally:
+        client.close()
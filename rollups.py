@@ -0,0 +1,302 @@
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+
+from pymongo import MongoClient
+
+from mongo_writer import INGEST_FIELD, server_time
+
+EARTH_RADIUS_M = 6371008.8
+
+STATE_COLLECTION = 'rollup_state'
+
+EPOCH = datetime(1970, 1, 1)
+
+# MAC and RSSI arrays of a buffer in either the full or the compact schema
+BUFFER_MACS = {'$ifNull': ['$devices.mac', {'$ifNull': ['$macs', []]}]}
+BUFFER_RSSI = {'$ifNull': ['$devices.rssi', {'$ifNull': ['$rssi', []]}]}
+
+# Union of the per-buffer MAC arrays collected with $push into mac_sets
+MAC_UNION = {'$reduce': {
+    'input': '$mac_sets', 'initialValue': [],
+    'in': {'$setUnion': ['$$value', '$$this']},
+}}
+
+# Additive fields of a rollup document, merged by summing
+SUMS = ('buffers', 'n_adv_raw', 'rssi_sum', 'rssi_count', 'distance_m', 'in_port_s', 'at_sea_s')
+
+
+def _haversine(a, b):
+    """Aggregation expression: metres between two [lon, lat] arrays"""
+    lon1, lat1 = ({'$degreesToRadians': {'$arrayElemAt': [a, i]}} for i in (0, 1))
+    lon2, lat2 = ({'$degreesToRadians': {'$arrayElemAt': [b, i]}} for i in (0, 1))
+
+    def half_sin_sq(x, y):
+        return {'$pow': [{'$sin': {'$divide': [{'$subtract': [x, y]}, 2]}}, 2]}
+
+    h = {'$add': [
+        half_sin_sq(lat2, lat1),
+        {'$multiply': [{'$cos': lat1}, {'$cos': lat2}, half_sin_sq(lon2, lon1)]},
+    ]}
+    return {'$multiply': [2 * EARTH_RADIUS_M, {'$asin': {'$sqrt': {'$min': [h, 1]}}}]}
+
+
+def _leg(prefix, max_gap):
+    """Leg duration and distance of a buffer from the one in {prefix}_position/_timestamp"""
+    position = '$gps_data.location.coordinates'
+    prev_position, prev_timestamp = f'${prefix}_position', f'${prefix}_timestamp'
+    return {
+        f'{prefix}_leg_s': {'$cond': [
+            {'$eq': [{'$type': prev_timestamp}, 'date']},
+            {'$min': [{'$divide': [{'$subtract': ['$timestamp', prev_timestamp]}, 1000]},
+                      max_gap]},
+            0,
+        ]},
+        f'{prefix}_leg_m': {'$cond': [
+            {'$and': [{'$isArray': position}, {'$isArray': prev_position}]},
+            _haversine(prev_position, position),
+            0,
+        ]},
+    }
+
+
+def _legs(max_gap):
+    """Per-buffer legs from the previous buffer of the receiver, now and before this run
+
+    prev is the previous buffer among all those read; old_prev the previous
+    one among buffers already rolled up (_new false), which is what the leg
+    was computed from when the buffer itself was rolled up.
+    """
+    position = '$gps_data.location.coordinates'
+    return [
+        {'$setWindowFields': {
+            'partitionBy': '$receiver_id',
+            'sortBy': {'timestamp': 1},
+            'output': {
+                'prev_position': {'$shift': {'output': position, 'by': -1}},
+                'prev_timestamp': {'$shift': {'output': '$timestamp', 'by': -1}},
+            },
+        }},
+        {'$setWindowFields': {
+            'partitionBy': {'receiver_id': '$receiver_id', 'new': '$_new'},
+            'sortBy': {'timestamp': 1},
+            'output': {
+                'old_prev_position': {'$shift': {'output': position, 'by': -1}},
+                'old_prev_timestamp': {'$shift': {'output': '$timestamp', 'by': -1}},
+            },
+        }},
+        {'$set': dict(_leg('prev', max_gap), **_leg('old_prev', max_gap))},
+    ]
+
+
+def ingested(since, until):
+    """Query for documents inserted in (since, until]
+
+    Documents stored before ingested_at was recorded count as inserted at
+    their timestamp.
+    """
+    return {'$or': [
+        {INGEST_FIELD: {'$gt': since, '$lte': until}},
+        {INGEST_FIELD: None, 'timestamp': {'$gt': since, '$lte': until}},
+    ]}
+
+
+def _rollup_pipeline(match, since, upper, first, last, group_id, target, max_gap=60,
+                     lookback=300):
+    """Aggregate the buffers inserted in (since, upper] into target via $merge
+
+    match selects the receiver (and trip buffers); first and last bound the
+    new buffers' timestamps. Buffers up to lookback seconds around them are
+    read as well, so that each new buffer gets its distance and duration
+    from its predecessor, and so that the buffer following a new one, rolled
+    up earlier from a different predecessor, has its leg corrected by the
+    difference. Works on both the full (devices[]) and the compact (macs[],
+    rssi[]) schema.
+    """
+    new = '$_new'
+    group = {
+        '_id': group_id,
+        'buffers': {'$sum': {'$cond': [new, 1, 0]}},
+        'n_adv_raw': {'$sum': {'$cond': [new, '$n_adv_raw', 0]}},
+        'mac_sets': {'$push': '$buffer_macs'},
+        'rssi_sum': {'$sum': {'$sum': '$buffer_rssi'}},
+        'rssi_count': {'$sum': {'$size': '$buffer_rssi'}},
+        'distance_m': {'$sum': '$leg_m'},
+        'in_port_s': {'$sum': {'$cond': [{'$eq': ['$in_port', True]}, '$leg_s', 0]}},
+        'at_sea_s': {'$sum': {'$cond': [{'$eq': ['$in_port', False]}, '$leg_s', 0]}},
+        'first_seen': {'$min': '$timestamp'},
+        'last_seen': {'$max': '$timestamp'},
+    }
+
+    read_match = dict(match, timestamp={'$gte': first - timedelta(seconds=lookback),
+                                        '$lte': last + timedelta(seconds=lookback)})
+    return [
+        {'$match': read_match},
+        {'$set': {'_ingested': {'$ifNull': [f'${INGEST_FIELD}', '$timestamp']}}},
+        {'$match': {'_ingested': {'$lte': upper}}},
+        {'$set': {'_new': {'$gt': ['$_ingested', since]}}},
+        *_legs(max_gap),
+        # New buffers, and rolled-up ones whose predecessor is a new buffer
+        {'$match': {'$or': [
+            {'_new': True},
+            {'$expr': {'$ne': ['$prev_timestamp', '$old_prev_timestamp']}},
+        ]}},
+        {'$set': {
+            'buffer_macs': {'$cond': [new, BUFFER_MACS, []]},
+            'buffer_rssi': {'$cond': [new, BUFFER_RSSI, []]},
+            'leg_s': {'$cond': [new, '$prev_leg_s',
+                                {'$subtract': ['$prev_leg_s', '$old_prev_leg_s']}]},
+            'leg_m': {'$cond': [new, '$prev_leg_m',
+                                {'$subtract': ['$prev_leg_m', '$old_prev_leg_m']}]},
+        }},
+        {'$group': group},
+        {'$set': {'macs': MAC_UNION}},
+        {'$unset': 'mac_sets'},
+        {'$set': _derived()},
+        {'$merge': {
+            'into': target,
+            'on': '_id',
+            'whenMatched': [
+                {'$set': dict(
+                    {field: {'$add': [f'${field}', f'$$new.{field}']} for field in SUMS},
+                    macs={'$setUnion': ['$macs', '$$new.macs']},
+                    first_seen={'$min': ['$first_seen', '$$new.first_seen']},
+                    last_seen={'$max': ['$last_seen', '$$new.last_seen']},
+                )},
+                {'$set': _derived()},
+            ],
+            'whenNotMatched': 'insert',
+        }},
+    ]
+
+
+def _derived():
+    return {
+        'unique_macs': {'$size': '$macs'},
+        'rssi_mean': {'$cond': [
+            {'$gt': ['$rssi_count', 0]},
+            {'$divide': ['$rssi_sum', '$rssi_count']},
+            None,
+        ]},
+    }
+
+
+class RollupJob:
+    def __init__(self, db, source='portfinal', settle=10, max_gap=60, window=3600, logger=None):
+        """Incremental per-minute and per-trip rollups of the buffer collection
+
+        Each receiver has its own high-water mark in rollup_state: the
+        latest insert time (ingested_at) rolled up, not the latest buffer
+        timestamp, so buffers that reach the database late (a spool uploaded
+        hours later, a spill file reloaded, a batch retried) are still
+        picked up. Buffers inserted less than settle seconds ago are left for
+        the next run, since a batch stamped just before insert_many only
+        becomes visible once the insert completes; insert times and the
+        marks are all taken from the server clock. Results are merged
+        additively into rollup_minute and rollup_trip, keyed by receiver and
+        minute / trip_id. Time in and out of port needs the buffer's in_port
+        flag; distance and durations come from consecutive GPS positions,
+        with gaps longer than max_gap seconds counted as max_gap. A backlog
+        is processed in steps of at most window seconds of insert time to
+        bound the aggregation's memory.
+        """
+        self.db = db
+        self.source = db[source]
+        self.state = db[STATE_COLLECTION]
+        self.settle = settle
+        self.max_gap = max_gap
+        self.window = window
+        self.logger = logger or logging.getLogger(__name__)
+
+    def receivers(self):
+        # Buffers stored before receiver_id existed roll up under None
+        return list(dict.fromkeys(self.source.distinct('receiver_id') + [None]))
+
+    def run(self, now=None):
+        """Roll up every receiver; returns {receiver_id: new high-water mark}"""
+        until = (now or server_time(self.source)) - timedelta(seconds=self.settle)
+        marks = {}
+        for receiver_id in self.receivers():
+            mark = self.run_receiver(receiver_id, until)
+            if mark:
+                marks[receiver_id] = mark
+        return marks
+
+    def _ingest_time(self, receiver_id, since, until, direction):
+        """Earliest (1) or latest (-1) insert time in (since, until], None if there is none"""
+        query = {'receiver_id': receiver_id, INGEST_FIELD: {'$gt': since, '$lte': until}}
+        stamped = self.source.find_one(query, {INGEST_FIELD: 1}, sort=[(INGEST_FIELD, direction)])
+        query = {'receiver_id': receiver_id, INGEST_FIELD: None,
+                 'timestamp': {'$gt': since, '$lte': until}}
+        legacy = self.source.find_one(query, {'timestamp': 1}, sort=[('timestamp', direction)])
+        times = [stamped[INGEST_FIELD]] if stamped else []
+        if legacy:
+            times.append(legacy['timestamp'])
+        if not times:
+            return None
+        return min(times) if direction == 1 else max(times)
+
+    def run_receiver(self, receiver_id, until):
+        """Roll up one receiver's buffers inserted up to until; returns the new high-water mark"""
+        state_id = f"buffers:{receiver_id}"
+        state = self.state.find_one({'_id': state_id}) or {}
+        since = state.get('high_water', EPOCH)
+        mark = None
+
+        while True:
+            oldest = self._ingest_time(receiver_id, since, until, 1)
+            if oldest is None:
+                return mark
+            # Fix the upper bound first, so buffers arriving meanwhile wait for the next step
+            limit = min(until, oldest + timedelta(seconds=self.window))
+            upper = self._ingest_time(receiver_id, since, limit, -1)
+            match = {'receiver_id': receiver_id}
+            span = next(self.source.aggregate([
+                {'$match': dict(match, **ingested(since, upper))},
+                {'$group': {'_id': None, 'first': {'$min': '$timestamp'},
+                            'last': {'$max': '$timestamp'}}},
+            ]))
+
+            minute = {'receiver_id': '$receiver_id',
+                      'minute': {'$dateTrunc': {'date': '$timestamp', 'unit': 'minute'}}}
+            self.source.aggregate(_rollup_pipeline(
+                match, since, upper, span['first'], span['last'], minute, 'rollup_minute',
+                max_gap=self.max_gap), allowDiskUse=True)
+
+            trip_match = dict(match, trip_id={'$exists': True, '$ne': None})
+            trip = {'receiver_id': '$receiver_id', 'trip_id': '$trip_id'}
+            self.source.aggregate(_rollup_pipeline(
+                trip_match, since, upper, span['first'], span['last'], trip, 'rollup_trip',
+                max_gap=self.max_gap), allowDiskUse=True)
+
+            self.state.update_one(
+                {'_id': state_id},
+                {'$set': {'high_water': upper, 'updated_at': datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+            self.logger.info(f"Rollup {receiver_id}: {since} -> {upper}")
+            since = mark = upper
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rollups incrementales por minuto y por viaje")
+    parser.add_argument(
+        "--mongo-uri",
+        type=str,
+        default="mongodb://localhost:27017/",
+        help="URI de MongoDB (default: mongodb://localhost:27017/)",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=10,
+        help="Segundos de margen para buffers todavía en vuelo (default: 10)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    client = MongoClient(args.mongo_uri)
+    try:
+        RollupJob(client.tracking_data, settle=args.settle).run()
+    finally:
+        client.close()
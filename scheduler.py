@@ -0,0 +1,94 @@
+import logging
+import time
+from collections import namedtuple
+
+Profile = namedtuple('Profile', [
+    'wifi_check_interval',  # seconds between uplink probes
+    'write_batch_size',     # documents per insert_many
+    'write_flush_interval', # seconds a partial batch may wait
+    'gps_poll_interval',    # seconds between GPS port reads in poll mode (0 = every loop)
+    'console_level',        # console logging level
+])
+
+PROFILES = {
+    # Tied up: nothing moves, the harbor Wi-Fi may show up at any time
+    'moored': Profile(15, 500, 10.0, 1.0, logging.WARNING),
+    # Manoeuvring inside a port zone
+    'harbor': Profile(15, 100, 0.5, 0, logging.INFO),
+    # At sea but within reach of a port's Wi-Fi
+    'coastal': Profile(30, 100, 0.5, 0, logging.INFO),
+    # No uplink expected; keep writes moderate and the console quiet
+    'offshore': Profile(600, 200, 2.0, 0, logging.WARNING),
+}
+
+
+class AdaptiveScheduler:
+    def __init__(self, tracker, profiles=None, near_port=2000.0, interval=1.0, logger=None):
+        """Tune a tracker's uplink probing, writes, GPS polling and logging to its situation
+
+        The mode is chosen from the tracker's motion state (moored when
+        STATIONARY) and geofence (harbor when in a port zone, coastal when
+        within near_port metres of one, offshore otherwise); without a
+        geofence a moving boat counts as coastal. update() re-evaluates at
+        most every interval seconds and applies the mode's Profile when it
+        changes. The GPS poll interval is capped at half the tracker's
+        extrapolation limit, so that buffers between polls still get a
+        position.
+        """
+        self.tracker = tracker
+        self.profiles = dict(PROFILES, **(profiles or {}))
+        self.near_port = near_port
+        self.interval = interval
+        self.logger = logger or tracker.logger
+        self.mode = None
+        self.changes = 0
+        self._next_update = 0.0
+
+    def classify(self):
+        tracker = self.tracker
+        motion = getattr(tracker, 'motion', None)
+        geofence = getattr(tracker, 'geofence', None)
+        fix = tracker.last_fix
+        if motion and motion.state == 'stationary':
+            return 'moored'
+        if geofence:
+            if geofence.in_port:
+                return 'harbor'
+            if fix and geofence.nearest_distance(fix.longitude, fix.latitude) <= self.near_port:
+                return 'coastal'
+            return 'offshore'
+        return 'coastal'
+
+    def update(self, now=None):
+        """Re-evaluate the mode; returns the new mode when it changed, else None"""
+        now = time.time() if now is None else now
+        if now < self._next_update:
+            return None
+        self._next_update = now + self.interval
+        mode = self.classify()
+        if mode == self.mode:
+            return None
+        self.apply(mode)
+        return mode
+
+    def apply(self, mode):
+        profile = self.profiles[mode]
+        tracker = self.tracker
+        # Read by StateMachineTracker before each probe
+        tracker.wifi_check_interval = profile.wifi_check_interval
+        writers = [tracker.writer] + [writer for _, writer, _ in tracker.sinks.values()]
+        for writer in writers:
+            if writer:
+                writer.batch_size = profile.write_batch_size
+                writer.flush_interval = profile.write_flush_interval
+        # A fix read late is timestamped late: stay well inside the extrapolation limit
+        tracker.gps_poll_interval = min(profile.gps_poll_interval,
+                                        tracker.gps_history.max_extrapolation / 2)
+        tracker.console_handler.setLevel(profile.console_level)
+        self.logger.info(
+            f"Modo {mode}: comprobación de red cada {profile.wifi_check_interval}s, "
+            f"lotes de {profile.write_batch_size} cada {profile.write_flush_interval}s, "
+            f"GPS cada {profile.gps_poll_interval}s"
+        )
+        self.mode = mode
+        self.changes += 1
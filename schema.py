@@ -0,0 +1,85 @@
+from uart import np, frame_mac_u64, frame_rssi
+
+SCHEMAS = ('full', 'compact')
+
+# Columns of a compact buffer document, one entry per device
+COLUMNS = ('macs', 'addr_type', 'adv_type', 'rssi', 'n_adv', 'payloads')
+
+DATA_LENGTH = 31
+
+
+def mac_to_int(mac):
+    """'AA:BB:CC:DD:EE:FF' or 6 raw bytes to a 48-bit integer"""
+    if isinstance(mac, str):
+        mac = bytes.fromhex(mac.replace(':', ''))
+    return int.from_bytes(mac, 'big')
+
+
+def int_to_mac(value):
+    """48-bit integer to an 'AA:BB:CC:DD:EE:FF' string"""
+    return value.to_bytes(6, 'big').hex(':').upper()
+
+
+def compact_devices(devices):
+    """Columnar compact fields for a list of BLEDevice records
+
+    The MAC becomes a 48-bit integer and the payload raw bytes (stored as
+    BSON binary) trimmed to data_len, so data_len itself is not stored.
+    """
+    columns = {column: [] for column in COLUMNS}
+    for device in devices:
+        columns['macs'].append(device.mac_int)
+        columns['addr_type'].append(device.addr_type)
+        columns['adv_type'].append(device.adv_type)
+        columns['rssi'].append(device.rssi)
+        columns['n_adv'].append(device.n_adv)
+        columns['payloads'].append(device.payload)
+    return columns
+
+
+def compact_frame(frame):
+    """compact_devices for a structured numpy frame (DEVICE_DTYPE)"""
+    lengths = np.minimum(frame['data_len'], DATA_LENGTH).tolist()
+    return {
+        'macs': frame_mac_u64(frame).tolist(),
+        'addr_type': frame['addr_type'].tolist(),
+        'adv_type': frame['adv_type'].tolist(),
+        'rssi': frame_rssi(frame).tolist(),
+        'n_adv': frame['n_adv'].tolist(),
+        'payloads': [data[:length].tobytes() for data, length in zip(frame['data'], lengths)],
+    }
+
+
+def is_compact(document):
+    return document.get('schema') == 'compact'
+
+
+def expand_devices(document):
+    """Per-device dicts (full schema layout) from a compact document
+
+    'data' holds only the data_len significant bytes; the zero padding of
+    the 31-byte field is not kept by the compact schema.
+    """
+    return [
+        {
+            'mac': int_to_mac(mac),
+            'addr_type': addr_type,
+            'adv_type': adv_type,
+            'rssi': rssi,
+            'data_len': len(payload),
+            'data': bytes(payload).hex(),
+            'n_adv': n_adv,
+        }
+        for mac, addr_type, adv_type, rssi, n_adv, payload in zip(
+            *(document[column] for column in COLUMNS))
+    ]
+
+
+def expand_document(document):
+    """Return a buffer document in the full schema, whichever schema it was stored in"""
+    if not is_compact(document):
+        return document
+    expanded = {key: value for key, value in document.items()
+                if key not in COLUMNS and key != 'schema'}
+    expanded['devices'] = expand_devices(document)
+    return expanded
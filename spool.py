@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+import zlib
+
+import bson
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from mongo_writer import DUPLICATE_KEY, stamp_ingest, unwritten
+
+
+class Spool:
+    def __init__(self, path, compress_level=6):
+        """Append-only on-disk document spool (SQLite in WAL mode)
+
+        Documents get their _id when appended and are stored as zlib
+        compressed BSON, so a drain that dies halfway can simply be run
+        again: rows are only deleted after their batch is in the database
+        and re-sent documents are recognised as duplicate keys.
+        """
+        self.path = path
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # No fsync per commit; WAL keeps the file consistent across crashes
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, body BLOB NOT NULL)"
+        )
+        self._db.commit()
+
+        # Statistics
+        self.appended = 0
+        self.drained = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    def append(self, document):
+        """Store one document; returns its _id"""
+        return self.extend([document])[0]
+
+    def extend(self, documents):
+        """Store several documents in one transaction; returns their _ids"""
+        rows = []
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+            rows.append((zlib.compress(bson.encode(document), self.compress_level),))
+        with self._lock, self._db:
+            self._db.executemany("INSERT INTO spool (body) VALUES (?)", rows)
+        self.appended += len(rows)
+        return [document['_id'] for document in documents]
+
+    def pending(self):
+        """Number of documents waiting to be drained"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def drain(self, collection, batch_size=1000, should_stop=None, ingest_field=None):
+        """Upload spooled documents in insert_many batches, oldest first
+
+        Stops when the spool is empty or should_stop() returns True and
+        returns the number of documents uploaded. Connection errors are
+        raised with the failed batch still in the spool. With ingest_field,
+        each batch is stamped with its upload time on the server clock.
+        """
+        uploaded = 0
+        resumed = True
+        while not (should_stop and should_stop()):
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT seq, body FROM spool ORDER BY seq LIMIT ?", (batch_size,)
+                ).fetchall()
+            if not rows:
+                break
+            documents = [bson.decode(zlib.decompress(body)) for _, body in rows]
+            if resumed:
+                # Only the head batch can have been sent by an interrupted drain
+                sent = len(documents)
+                documents = unwritten(collection, documents)
+                self.duplicates += sent - len(documents)
+                resumed = False
+            try:
+                if documents:
+                    if ingest_field:
+                        stamp_ingest(collection, documents, ingest_field)
+                    collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                duplicates = sum(1 for err in errors if err.get('code') == DUPLICATE_KEY)
+                # Already uploaded by an interrupted drain, or never insertable
+                self.duplicates += duplicates
+                self.rejected += len(errors) - duplicates
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM spool WHERE seq <= ?", (rows[-1][0],))
+            uploaded += len(rows)
+            self.drained += len(rows)
+        return uploaded
+
+    def stats(self):
+        return {
+            'pending': self.pending(),
+            'appended': self.appended,
+            'drained': self.drained,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
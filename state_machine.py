@@ -1,8 +1,14 @@
 import enum
-from gps_ble_tracker import CombinedTracker
-from transitions import Machine
-from transitions.extensions import GraphMachine
+import socket
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+from pymongo import uri_parser
+from transitions import Machine
+
+from gps_ble_tracker import CombinedTracker
 
 class TrackerState(enum.Enum):
     INITIALIZING = "initializing"
@@ -11,149 +17,246 @@ class TrackerState(enum.Enum):
     TRANSMITTING = "transmitting"
     ERROR = "error"
 
+STATES = [state.value for state in TrackerState]
+
+TRANSITIONS = [
+    {'trigger': 'initialize_complete', 'source': TrackerState.INITIALIZING.value,
+     'dest': TrackerState.SCANNING.value},
+    {'trigger': 'wifi_available', 'source': TrackerState.SCANNING.value,
+     'dest': TrackerState.CONNECTING.value},
+    {'trigger': 'connection_established', 'source': TrackerState.CONNECTING.value,
+     'dest': TrackerState.TRANSMITTING.value},
+    {'trigger': 'transmission_complete', 'source': TrackerState.TRANSMITTING.value,
+     'dest': TrackerState.SCANNING.value},
+    {'trigger': 'transmission_failed', 'source': TrackerState.TRANSMITTING.value,
+     'dest': TrackerState.SCANNING.value},
+    {'trigger': 'connection_failed', 'source': TrackerState.CONNECTING.value,
+     'dest': TrackerState.SCANNING.value},
+    {'trigger': 'error_occured', 'source': '*', 'dest': TrackerState.ERROR.value},
+    {'trigger': 'error_resolved', 'source': TrackerState.ERROR.value,
+     'dest': TrackerState.SCANNING.value},
+]
+
+
+def render_graph(path='state_machine.png'):
+    """Draw the state diagram (diagnostic only; needs pygraphviz and graphviz)"""
+    from transitions.extensions import GraphMachine
+
+    machine = GraphMachine(states=STATES, transitions=TRANSITIONS,
+                           initial=TrackerState.INITIALIZING.value)
+    machine.get_graph().draw(path, prog='dot')
+    return path
+
+
 class StateMachineTracker(CombinedTracker):
-    
-    states = [state.value for state in TrackerState]
 
-    def __init__(self, *args, **kwargs):
+    states = STATES
 
+    def __init__(self, *args, wifi_check_interval=60, probe_address=None, probe_timeout=3.0,
+                 tick_interval=0.5, **kwargs):
+        """CombinedTracker whose uplink is driven by a state machine
+
+        run() keeps reading BLE and GPS in the calling thread. Network probes
+        (SCANNING, every wifi_check_interval seconds), the database check
+        (CONNECTING) and the spool upload (TRANSMITTING) run one at a time on
+        a background worker; the loop polls the task after every frame or
+        tick_interval seconds and fires the resulting transition itself, so
+        the machine is only ever touched from one thread. The probe is a TCP
+        connect to probe_address (host, port), by default the MongoDB host.
+        """
         if kwargs.get('ble_port') in ['none','None', 'NONE', None]:
             kwargs['ble_port'] = None
             self.ble_enabled = False
         else: self.ble_enabled = True
 
+        super().__init__(*args, **kwargs)
 
-        self.machine = GraphMachine(
+        self.machine = Machine(
             model = self,
             states = self.states,
-            initial = TrackerState.INITIALIZING.value
+            transitions = TRANSITIONS,
+            initial = TrackerState.INITIALIZING.value,
+            after_state_change = '_log_state'
         )
 
-        # transitions
-
-        self.machine.add_transition(
-            trigger='initialize_complete',
-            source = TrackerState.INITIALIZING.value,
-            dest = TrackerState.SCANNING.value
-        )
-
-        self.machine.add_transition(
-            trigger='wifi_available',
-            source = TrackerState.SCANNING.value,
-            dest = TrackerState.CONNECTING.value
-        )
-
-        self.machine.add_transition(
-            trigger='transmission_complete',
-            source=TrackerState.CONNECTING.value,
-            dest = TrackerState.SCANNING.value
-        )
-
-        self.machine.add_transition(
-            trigger = 'transmission_failed',
-            source=TrackerState.TRANSMITTING.value,
-            dest= TrackerState.SCANNING.value
-        )
-
-        self.machine.add_transition(
-            trigger='connection_failed',
-            source=TrackerState.CONNECTING.value,
-            dest = TrackerState.SCANNING.value
-        )
-
-
-        self.machine.add_transition(
-            trigger='error_occured',
-            source='*',
-            dest= TrackerState.ERROR.value
-        )
-
-
-        self.machine.add_transition(
-            trigger='error_resolved',
-            source=TrackerState.ERROR.value,
-            dest=TrackerState.SCANNING.value
-        )
-
-        self.pending_data = []
         self.last_wifi_check = 0
-        self.wifi_check_interval = kwargs.get('wifi_check_interval',60)
-        self.last_state_change = time.time(),
-        self.machine.get_graph().draw('test.png',prog='dot')
+        self.wifi_check_interval = wifi_check_interval
+        self.probe_address = probe_address or self._mongo_address(
+            kwargs.get('mongo_uri', "mongodb://localhost:27017/"))
+        self.probe_timeout = probe_timeout
+        self.tick_interval = tick_interval
+        self.last_state_change = time.time()
+        self.in_port = False
+        if getattr(self, 'geofence', None):
+            self.geofence.subscribe(self.on_geofence_event)
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='uplink')
+        self._task = None
+        self._stopping = threading.Event()
+
+    @staticmethod
+    def _mongo_address(uri):
+        return uri_parser.parse_uri(uri)['nodelist'][0]
+
+    def _log_state(self):
+        self.last_state_change = time.time()
+        self.logger.info(f"Uplink state: {self.state}")
+
+    def on_geofence_event(self, event):
+        """Track harbor entry/exit; entering port makes the next Wi-Fi check immediate"""
+        self.in_port = self.geofence.in_port
+        if event.kind == 'enter':
+            self.last_wifi_check = 0
+
+    # Background tasks
+
+    def _submit(self, function, on_success, on_failure):
+        """Run function on the uplink worker; its outcome fires on_success/on_failure"""
+        self._task = (self._executor.submit(function), on_success, on_failure)
+
+    def _poll_task(self):
+        """Fire the transition of a finished background task"""
+        if not self._task or not self._task[0].done():
+            return
+        future, on_success, on_failure = self._task
+        self._task = None
+        try:
+            succeeded = future.result()
+        except Exception as e:
+            self.logger.error(f"Uplink task failed in {self.state}: {e}")
+            succeeded = False
+        if succeeded and on_success:
+            on_success()
+        elif not succeeded and on_failure:
+            on_failure()
+
+    def _probe_network(self):
+        try:
+            socket.create_connection(self.probe_address, timeout=self.probe_timeout).close()
+            return True
+        except OSError:
+            return False
+
+    def _check_database(self):
+        self.client.admin.command('ping')
+        return True
+
+    def _upload(self):
+        self.drain_spool(should_stop=self._stopping.is_set)
+        return True
+
+    def on_enter_connecting(self):
+        self._submit(self._check_database, self.connection_established, self.connection_failed)
+
+    def on_enter_transmitting(self):
+        """Upload the local spool in the background, then go back to scanning"""
+        self._submit(self._upload, self.transmission_complete, self.transmission_failed)
+
+    def step(self):
+        """Advance the uplink state machine without blocking"""
+        self._poll_task()
+        if self.scheduler:
+            self.scheduler.update()
+        if (self.state == TrackerState.SCANNING.value and not self._task
+                and time.time() - self.last_wifi_check >= self.wifi_check_interval):
+            self.last_wifi_check = time.time()
+            self._submit(self._probe_network, self.wifi_available, None)
+
+    # Run loop
+
+    def run(self, duration=None):
+        """Capture for duration seconds (or until Ctrl-C) while the uplink runs alongside"""
+        if self.state == TrackerState.INITIALIZING.value:
+            self.initialize_complete()
+        if self.ble_enabled and getattr(self.serial, 'timeout', 0) is None:
+            # A silent BLE port must not stall the state machine
+            self.serial.timeout = self.tick_interval
+        start = time.time()
+        processed = 0
+        try:
+            while not duration or time.time() - start < duration:
+                try:
+                    self.step()
+                    if self.gps_polling:
+                        self._parse_gps()
+                    if not self.ble_enabled:
+                        time.sleep(self.tick_interval)
+                        continue
+                    frame = self._next_frame()
+                    if frame and self._process_frame(*frame):
+                        processed += 1
+                except serial.SerialException as e:
+                    self.logger.error(f"Serial error: {e}")
+                    self.error_occured()
+                    break
+                except KeyboardInterrupt:
+                    raise
+                except Exception as e:
+                    self.logger.error(f"Unexpected error: {e}")
+        except KeyboardInterrupt:
+            self.logger.info("Capture interrupted by the user")
+        finally:
+            self._stopping.set()
+            self._executor.shutdown(wait=True)
+            self._poll_task()
+            self.logger.info(f"Buffers processed: {processed}")
+        return processed
 
-def create_test_machine():
-    tracker = StateMachineTracker(ble_port=None, wifi_check_interval=60)
-    return tracker
 
 if __name__ == "__main__":
-    # Create the state machine
-    tracker = create_test_machine()
-    
-    # The graph will be automatically generated as 'test.png'
-    print("State machine graph has been generated as 'test.png'")
-    
-    print(f"Initial state: {tracker.state}")
-    
-    tracker.initialize_complete()
-    print(f"After initialize_complete: {tracker.state}")
-    
-    tracker.wifi_available()
-    print(f"After wifi_available: {tracker.state}")
-    
-    tracker.connection_failed()
-    print(f"After connection_failed: {tracker.state}")
-    
-    tracker.error_occured()
-    print(f"After error_occured: {tracker.state}")
-    
-    tracker.error_resolved()
-    print(f"After error_resolved: {tracker.state}")
-
-
-    #separation of the classes
-    
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-    
-
-
-
-
-
-
-
-
-
-
-
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rastreador GPS + BLE con máquina de estados de subida")
+    parser.add_argument(
+        "--graph", type=str, help="Dibuja el diagrama de estados en este fichero y termina (requiere graphviz)"
+    )
+    parser.add_argument("--gps-port", type=str, default="COM26", help="Puerto GPS (default: COM26)")
+    parser.add_argument(
+        "--ble-port", type=str, default="COM20", help="Puerto BLE, 'none' para desactivarlo (default: COM20)"
+    )
+    parser.add_argument(
+        "--mongo-uri",
+        type=str,
+        default="mongodb://localhost:27017/",
+        help="URI de MongoDB (default: mongodb://localhost:27017/)",
+    )
+    parser.add_argument("--spool", type=str, help="Spool SQLite local que se sube al haber conexión")
+    parser.add_argument("--duration", type=int, help="Duración del rastreo en segundos")
+    parser.add_argument(
+        "--wifi-check-interval",
+        type=float,
+        default=60,
+        help="Segundos entre comprobaciones de conectividad (default: 60)"
+    )
+    parser.add_argument(
+        "--geofence", type=str, help="GeoJSON con los polígonos de puertos y muelles"
+    )
+    parser.add_argument(
+        "--motion",
+        action="store_true",
+        help="Detecta si el barco está parado o en movimiento"
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Ajusta comprobaciones de red, lotes, lectura GPS y log según el estado del barco"
+    )
+    args = parser.parse_args()
+
+    if args.graph:
+        print(f"Diagrama de estados guardado en {render_graph(args.graph)}")
+    else:
+        tracker = StateMachineTracker(
+            gps_port=args.gps_port,
+            ble_port=args.ble_port,
+            mongo_uri=args.mongo_uri,
+            spool_path=args.spool,
+            wifi_check_interval=args.wifi_check_interval,
+            geofence_path=args.geofence,
+            motion=args.motion,
+            adaptive=args.adaptive
+        )
+        try:
+            tracker.run(duration=args.duration)
+        finally:
+            tracker.close()
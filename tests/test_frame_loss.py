@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_loss import FrameLossTracker
+
+
+def feed(tracker, sequences):
+    return [tracker.observe(sequence % 256, now=0.0) for sequence in sequences]
+
+
+def test_burst_loss_longer_than_half_the_sequence_space_is_counted_as_lost():
+    tracker = FrameLossTracker()
+    feed(tracker, range(0, 11))
+    # Frames 11..150 are lost, then the stream carries on
+    results = feed(tracker, range(151, 200))
+    assert [kind for kind, _ in results[:3]] == ['stale', 'stale', 'resync']
+    assert results[2] == ('resync', 140)
+    assert all(kind == 'ok' for kind, _ in results[3:])
+    assert tracker.lost == 140
+    assert tracker.reordered == 0
+    assert tracker.duplicates == 0
+    assert tracker.stale == 0
+    assert tracker.last_sequence == 199 % 256
+
+
+def test_firmware_restart_resyncs_without_loss():
+    tracker = FrameLossTracker()
+    feed(tracker, range(0, 101))
+    results = feed(tracker, range(0, 50))
+    assert results[2] == ('restart', 0)
+    assert all(kind == 'ok' for kind, _ in results[3:])
+    assert tracker.restarts == 1
+    assert tracker.lost == 0
+    assert tracker.reordered == 0
+    assert tracker.last_sequence == 49
+
+
+def test_late_frame_that_went_missing_is_a_reorder():
+    tracker = FrameLossTracker()
+    feed(tracker, [1, 2, 4, 5])
+    assert tracker.lost == 1
+    assert tracker.observe(3, now=0.0) == ('reorder', 0)
+    assert tracker.lost == 0
+    # Not missing any more: a second copy is out of window
+    assert tracker.observe(3, now=0.0) == ('stale', 0)
+    assert tracker.observe(6, now=0.0) == ('ok', 0)
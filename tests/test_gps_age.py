@@ -0,0 +1,74 @@
+import io
+import os
+import random
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_ingest import make_frame, make_rmc
+from capture import STREAM_BLE, STREAM_GPS, CaptureWriter, open_replay
+from gps_ble_tracker import CombinedTracker
+from uart import UARTReceiver
+
+
+class FakeCollection:
+    def __init__(self, database):
+        self.database = database
+        self.documents = []
+
+    def insert_one(self, document):
+        self.documents.append(document)
+        return type('InsertOneResult', (), {'inserted_id': len(self.documents)})
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self)
+        return self.collections[name]
+
+    __getattr__ = __getitem__
+
+    def command(self, name):
+        assert name == 'hello'
+        return {'localTime': datetime.now(timezone.utc).replace(tzinfo=None)}
+
+
+class FakeClient:
+    def __init__(self):
+        self.tracking_data = FakeDatabase()
+
+
+def write_capture(path, seconds, gps_lead):
+    """One RMC per second, each followed gps_lead seconds later by a BLE frame"""
+    rng = random.Random(7)
+    receiver = UARTReceiver(io.BytesIO(), n_mac_bytes=2)
+    writer = CaptureWriter(path)
+    for i in range(seconds):
+        writer.write(STREAM_GPS, make_rmc(rng), timestamp=1000.0 + i)
+        writer.write(STREAM_BLE, make_frame(receiver, i, 2, rng), timestamp=1000.0 + i + gps_lead)
+    writer.close()
+
+
+@pytest.mark.parametrize('gps_mode', ['poll', 'thread'])
+def test_gps_age_is_the_time_since_the_fix_arrived(tmp_path, monkeypatch, gps_mode):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / 'capture.bin')
+    write_capture(path, seconds=10, gps_lead=0.5)
+    ble, gps = open_replay(path, speed=20)
+    tracker = CombinedTracker(gps_port=gps, ble_port=ble, mongo_client=FakeClient(),
+                              write_batch_size=0, gps_mode=gps_mode, n_mac_bytes=2)
+    try:
+        tracker.receive_messages()
+    finally:
+        tracker.close()
+
+    ages = [document['gps_age'] for document in tracker.collection.documents[1:]]
+    assert len(ages) == 9
+    assert sum(ages) / len(ages) == pytest.approx(0.5, abs=0.05)
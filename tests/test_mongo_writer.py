@@ -0,0 +1,137 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+from mongo_writer import BatchWriter
+
+
+class FakeCollection:
+    def __init__(self):
+        self.documents = []
+        self.inserted = threading.Event()
+
+    def insert_many(self, documents, ordered=True):
+        self.documents.extend(documents)
+        self.inserted.set()
+
+    def find(self, query, projection=None):
+        ids = set(query['_id']['$in'])
+        return [document for document in self.documents if document.get('_id') in ids]
+
+
+class RejectingCollection(FakeCollection):
+    def insert_many(self, documents, ordered=True):
+        self.documents.extend(documents[1:])
+        raise BulkWriteError({'nInserted': len(documents) - 1, 'writeErrors': [
+            {'index': 0, 'code': 121, 'errmsg': 'Document failed validation'}]})
+
+
+class StuckCollection(FakeCollection):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def insert_many(self, documents, ordered=True):
+        self.inserted.set()
+        self.release.wait(5.0)
+
+
+def test_partial_batch_is_flushed_after_flush_interval():
+    collection = FakeCollection()
+    writer = BatchWriter(collection, batch_size=100, flush_interval=0.2)
+    writer.start()
+    try:
+        time.sleep(0.05)  # Let the writer thread go idle on the empty queue
+        writer.put({'n': 1})
+        assert collection.inserted.wait(2.0)
+        assert collection.documents == [{'n': 1}]
+        assert writer.stats()['queued'] == 0
+    finally:
+        writer.close()
+
+
+def test_full_batch_is_flushed_immediately():
+    collection = FakeCollection()
+    writer = BatchWriter(collection, batch_size=3, flush_interval=60.0)
+    writer.start()
+    try:
+        for n in range(3):
+            writer.put({'n': n})
+        assert collection.inserted.wait(2.0)
+        assert len(collection.documents) == 3
+    finally:
+        writer.close()
+
+
+def test_rejected_documents_are_not_counted_as_inserted():
+    writer = BatchWriter(RejectingCollection(), batch_size=3, flush_interval=60.0)
+    writer.start()
+    try:
+        for n in range(3):
+            writer.put({'n': n})
+        assert writer.flush(2.0)
+    finally:
+        writer.close()
+    assert writer.stats()['inserted'] == 2
+    assert writer.stats()['failed'] == 1
+
+
+def test_close_timeout_spills_the_batch_in_flight(tmp_path):
+    spill_path = str(tmp_path / 'spill.jsonl')
+    collection = StuckCollection()
+    writer = BatchWriter(collection, batch_size=2, flush_interval=60.0, spill_path=spill_path)
+    writer.start()
+    try:
+        writer.put({'n': 1})
+        writer.put({'n': 2})
+        assert collection.inserted.wait(2.0)
+        writer.close(timeout=0.1)
+    finally:
+        collection.release.set()
+    with open(spill_path, encoding='utf-8') as f:
+        spilled = [json_util.loads(line) for line in f]
+    assert [document['n'] for document in spilled] == [1, 2]
+    assert all('_id' in document for document in spilled)
+
+
+def test_spilled_documents_keep_their_id_on_reload(tmp_path):
+    spill_path = str(tmp_path / 'spill.jsonl')
+    collection = FakeCollection()
+    writer = BatchWriter(collection, batch_size=10, flush_interval=0.05, spill_path=spill_path)
+    documents = [{'n': n} for n in range(3)]
+    writer._spill(documents)
+    # The first one already reached the database before the spill was reloaded
+    collection.documents.append(dict(documents[0]))
+    writer.start()
+    try:
+        deadline = time.monotonic() + 2.0
+        while os.path.exists(spill_path + '.reloading') or os.path.exists(spill_path):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        writer.close()
+    assert sorted(document['n'] for document in collection.documents) == [0, 1, 2]
+    assert {document['_id'] for document in collection.documents} == {
+        document['_id'] for document in documents}
+
+
+def test_flush_waits_for_the_batch_in_flight():
+    collection = StuckCollection()
+    writer = BatchWriter(collection, batch_size=2, flush_interval=60.0)
+    writer.start()
+    try:
+        writer.put({'n': 1})
+        writer.put({'n': 2})
+        assert collection.inserted.wait(2.0)
+        assert not writer.flush(0.1)
+        collection.release.set()
+        assert writer.flush(2.0)
+    finally:
+        collection.release.set()
+        writer.close()
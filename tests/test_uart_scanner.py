@@ -0,0 +1,44 @@
+import io
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uart import UARTReceiver
+
+
+def device(n):
+    mac = bytes([0xc0, 0, 0, 0, n >> 8, n & 0xff])
+    return mac + bytes([0, 0, 0xc8, 3]) + b'\x02\x01\x06' + bytes(28) + b'\x01'
+
+
+def frame(sequence, n_mac, sent=None):
+    devices = b''.join(device(sequence * 10 + i) for i in range(n_mac if sent is None else sent))
+    return struct.pack('<4sBHH', b'\x55\x55\x55\x55', sequence, n_mac, n_mac) + devices
+
+
+def frames_from(stream):
+    receiver = UARTReceiver(io.BytesIO(), n_mac_bytes=2)
+    receiver._rx_feed(stream)
+    frames = []
+    while True:
+        frame = receiver._rx_pop_frame()
+        if not frame:
+            return receiver, frames
+        frames.append(frame)
+
+
+def test_frames_in_a_continuous_stream_are_split():
+    receiver, frames = frames_from(b''.join(frame(seq, 3) for seq in range(5)))
+    assert [header['sequence'] for header, _ in frames] == [0, 1, 2, 3, 4]
+    assert receiver.truncated_frames == 0
+
+
+def test_truncated_frame_does_not_swallow_the_next_one():
+    stream = frame(0, 3) + frame(1, 3, sent=1) + frame(2, 3) + frame(3, 3)
+    receiver, frames = frames_from(stream)
+    assert [header['sequence'] for header, _ in frames] == [0, 2, 3]
+    assert all(payload == frame(header['sequence'], 3)[9:] for header, payload in frames)
+    assert receiver.truncated_frames == 1
+    assert receiver.loss.short_reads == 1
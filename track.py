@@ -0,0 +1,196 @@
+import math
+from datetime import datetime
+
+METRES_PER_DEGREE = 111320.0
+
+POLYLINE_PRECISION = 5
+
+
+def encode_values(values):
+    """Encode signed integers with the polyline varint scheme (printable ASCII)"""
+    chunks = []
+    for value in values:
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def decode_values(text):
+    values = []
+    value = shift = 0
+    for char in text:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    return values
+
+
+def _deltas(values):
+    previous = 0
+    for value in values:
+        yield value - previous
+        previous = value
+
+
+def _cumulative(deltas):
+    total = 0
+    for delta in deltas:
+        total += delta
+        yield total
+
+
+def encode_polyline(points, precision=POLYLINE_PRECISION):
+    """[(lat, lon), ...] to a delta-encoded polyline string"""
+    factor = 10 ** precision
+    flat = []
+    for lat, lon in points:
+        flat.extend((round(lat * factor), round(lon * factor)))
+    lats = _deltas(flat[0::2])
+    lons = _deltas(flat[1::2])
+    return encode_values(value for pair in zip(lats, lons) for value in pair)
+
+
+def decode_polyline(text, precision=POLYLINE_PRECISION):
+    factor = 10 ** precision
+    values = decode_values(text)
+    lats = _cumulative(values[0::2])
+    lons = _cumulative(values[1::2])
+    return [(lat / factor, lon / factor) for lat, lon in zip(lats, lons)]
+
+
+def decode_track(chunks):
+    """(received_at, lat, lon) points of a trip from its track chunk documents"""
+    points = []
+    for chunk in sorted(chunks, key=lambda chunk: chunk['chunk']):
+        start = chunk['start'].timestamp()
+        offsets = _cumulative(decode_values(chunk['times']))
+        coordinates = decode_polyline(chunk['polyline'], chunk.get('precision', POLYLINE_PRECISION))
+        chunk_points = [(start + offset / 1000, lat, lon)
+                        for offset, (lat, lon) in zip(offsets, coordinates)]
+        if points:
+            chunk_points = chunk_points[1:]  # Chunks overlap by one point
+        points.extend(chunk_points)
+    return points
+
+
+class TrackRecorder:
+    def __init__(self, tolerance=10.0, max_interval=60.0, max_window=200, chunk_points=100):
+        """Online error-bounded simplification of the GPS fix stream
+
+        Uses an opening window with the synchronized euclidean distance: a
+        fix is dropped while every skipped fix lies within tolerance metres
+        of its time-interpolated position on the current segment, so the
+        stored track can be interpolated by time. A point is also kept every
+        max_interval seconds and when max_window fixes have been skipped.
+        Kept points are handed out as chunks of chunk_points points (each
+        chunk starts with the last point of the previous one).
+        """
+        self.tolerance = tolerance
+        self.max_interval = max_interval
+        self.max_window = max_window
+        self.chunk_points = chunk_points
+        self.trip_id = None
+        self.started_at = None
+        self.fixes = 0
+        self.kept = 0
+        self._chunk = 0
+        self._reset()
+
+    def _reset(self):
+        self._anchor = None
+        self._window = []
+        self._points = []
+
+    def start(self, trip_id, started_at):
+        """Begin a new trip; started_at is a time.time() value"""
+        self.trip_id = trip_id
+        self.started_at = started_at
+        self.fixes = 0
+        self.kept = 0
+        self._chunk = 0
+        self._reset()
+
+    def offset(self, timestamp):
+        """Seconds since the trip started, for buffers referencing the track"""
+        if self.started_at is None:
+            return None
+        return round(timestamp - self.started_at, 3)
+
+    def add(self, fix):
+        """Feed a GPSFix; returns a finished chunk document or None"""
+        if self.trip_id is None:
+            return None
+        self.fixes += 1
+        point = (fix.received_at, fix.latitude, fix.longitude)
+        if self._anchor is None:
+            self._keep(point)
+        elif (point[0] - self._anchor[0] > self.max_interval
+                or len(self._window) >= self.max_window
+                or not self._within_tolerance(point)):
+            if self._window:
+                # The previous fix closes the segment and becomes the new anchor
+                self._keep(self._window[-1])
+                self._window = [point]
+            else:
+                self._keep(point)
+        else:
+            self._window.append(point)
+        return self._take_chunk(full=True)
+
+    def finish(self):
+        """End the trip; returns the last chunk document (or None)"""
+        if self._window:
+            self._keep(self._window[-1])
+            self._window = []
+        chunk = self._take_chunk(full=False)
+        self.trip_id = None
+        self.started_at = None
+        self._reset()
+        return chunk
+
+    def _keep(self, point):
+        self._anchor = point
+        self._points.append(point)
+        self.kept += 1
+
+    def _within_tolerance(self, point):
+        """Every skipped fix stays within tolerance of the anchor -> point segment"""
+        t0, lat0, lon0 = self._anchor
+        t1, lat1, lon1 = point
+        span = t1 - t0
+        scale = math.cos(math.radians(lat0))
+        for t, lat, lon in self._window:
+            ratio = (t - t0) / span if span > 0 else 0.0
+            dy = (lat - (lat0 + (lat1 - lat0) * ratio)) * METRES_PER_DEGREE
+            dx = (lon - (lon0 + (lon1 - lon0) * ratio)) * METRES_PER_DEGREE * scale
+            if dx * dx + dy * dy > self.tolerance * self.tolerance:
+                return False
+        return True
+
+    def _take_chunk(self, full):
+        points = self._points
+        # After the first chunk, points[0] was already sent as the overlap
+        needed = self.chunk_points if full else (1 if self._chunk == 0 else 2)
+        if len(points) < needed:
+            return None
+        # Whole milliseconds, as stored by MongoDB, so decoded times are exact
+        start = math.floor(points[0][0] * 1000) / 1000
+        chunk = {
+            'trip_id': self.trip_id,
+            'chunk': self._chunk,
+            'start': datetime.fromtimestamp(start),
+            'end': datetime.fromtimestamp(points[-1][0]),
+            'points': len(points),
+            'precision': POLYLINE_PRECISION,
+            'polyline': encode_polyline([(lat, lon) for _, lat, lon in points]),
+            'times': encode_values(_deltas(round((t - start) * 1000) for t, _, _ in points)),
+        }
+        self._chunk += 1
+        self._points = [points[-1]]
+        return chunk
@@ -0,0 +1,113 @@
+import math
+from datetime import datetime
+
+from track import METRES_PER_DEGREE
+
+
+class Trip:
+    """One departure-to-arrival segment of a receiver's fix stream"""
+    __slots__ = ('trip_id', 'receiver_id', 'start', 'end', 'distance_m', 'buffers', 'macs',
+                 'start_position', 'end_position', '_last_point')
+
+    def __init__(self, trip_id, receiver_id, start, fix):
+        self.trip_id = trip_id
+        self.receiver_id = receiver_id
+        self.start = self.end = start
+        self.distance_m = 0.0
+        self.buffers = 0
+        self.macs = set()
+        self.start_position = self.end_position = (fix.longitude, fix.latitude)
+        self._last_point = (fix.longitude, fix.latitude)
+
+    def add_fix(self, fix, min_step):
+        """Accumulate distance in steps of at least min_step metres (ignores jitter)"""
+        self.end = fix.received_at
+        self.end_position = (fix.longitude, fix.latitude)
+        lon0, lat0 = self._last_point
+        dy = (fix.latitude - lat0) * METRES_PER_DEGREE
+        dx = (fix.longitude - lon0) * METRES_PER_DEGREE * math.cos(math.radians(lat0))
+        step = math.hypot(dx, dy)
+        if step >= min_step:
+            self.distance_m += step
+            self._last_point = (fix.longitude, fix.latitude)
+
+    def to_document(self, closed_by=None):
+        return {
+            '_id': self.trip_id,
+            'trip_id': self.trip_id,
+            'receiver_id': self.receiver_id,
+            'start': datetime.fromtimestamp(self.start),
+            'end': datetime.fromtimestamp(self.end),
+            'duration_s': round(self.end - self.start, 3),
+            'distance_m': round(self.distance_m, 1),
+            'buffers': self.buffers,
+            'unique_devices': len(self.macs),
+            'start_position': {'type': 'Point', 'coordinates': list(self.start_position)},
+            'end_position': {'type': 'Point', 'coordinates': list(self.end_position)},
+            'closed_by': closed_by,
+        }
+
+
+class TripSegmenter:
+    def __init__(self, receiver_id, depart_dwell=0.0, arrive_dwell=120.0, min_step=5.0):
+        """Online split of a fix stream into trips
+
+        update() is given each fix and whether the boat is at sea (out of
+        every port zone, or moving when there is no geofence). A trip starts
+        once the boat has been at sea for depart_dwell seconds and ends once
+        it has been back for arrive_dwell seconds, so a short stop at a dock
+        or a drift does not split the trip; both ends are dated from the
+        first fix of the new condition. Distance counts position steps of at
+        least min_step metres.
+        """
+        self.receiver_id = receiver_id
+        self.depart_dwell = depart_dwell
+        self.arrive_dwell = arrive_dwell
+        self.min_step = min_step
+        self.current = None
+        self.trips = 0
+        self._change_since = None
+        self._change_fix = None
+
+    @property
+    def trip_id(self):
+        trip = self.current
+        return trip.trip_id if trip else None
+
+    def update(self, fix, at_sea):
+        """Feed a GPSFix; returns (started Trip or None, finished Trip or None)"""
+        now = fix.received_at
+        trip = self.current
+        if trip:
+            trip.add_fix(fix, self.min_step)
+        if at_sea == (trip is not None):
+            self._change_since = self._change_fix = None
+            return None, None
+        if self._change_since is None:
+            self._change_since, self._change_fix = now, fix
+        if now - self._change_since < (self.depart_dwell if at_sea else self.arrive_dwell):
+            return None, None
+
+        since, first = self._change_since, self._change_fix
+        self._change_since = self._change_fix = None
+        if at_sea:
+            trip_id = f"{self.receiver_id}-{datetime.fromtimestamp(since):%Y%m%dT%H%M%S.%f}"[:-3]
+            self.current = Trip(trip_id, self.receiver_id, since, first)
+            self.trips += 1
+            return self.current, None
+        trip.end = since
+        trip.end_position = (first.longitude, first.latitude)
+        self.current = None
+        return None, trip
+
+    def observe(self, macs):
+        """Account for one stored buffer of the current trip"""
+        trip = self.current
+        if trip:
+            trip.buffers += 1
+            trip.macs.update(macs)
+
+    def close(self):
+        """End the current trip (e.g. on shutdown); returns it or None"""
+        trip, self.current = self.current, None
+        return trip
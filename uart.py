@@ -1,12 +1,196 @@
 import serial
 import struct
+import time
 from datetime import datetime
+from capture import CaptureWriter, CaptureTap, STREAM_BLE
+from frame_loss import FrameLossTracker
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for frame_format='numpy'
+    np = None
+
+FRAME_FORMATS = ('dict', 'numpy')
+
+# Device record layout: field name and struct code, in wire order
+DEVICE_FIELDS = (
+    ('mac', '6s'),
+    ('addr_type', 'B'),
+    ('adv_type', 'B'),
+    ('rssi', 'b'),      # signed
+    ('data_len', 'B'),
+    ('data', '31s'),
+    ('n_adv', 'B'),
+)
+DEVICE_STRUCT = struct.Struct('<' + ''.join(code for _, code in DEVICE_FIELDS))
+
+
+def _field_slices(fields):
+    """Byte range of each field within a packed device record"""
+    slices, offset = {}, 0
+    for name, code in fields:
+        size = struct.calcsize('<' + code)
+        slices[name] = slice(offset, offset + size)
+        offset += size
+    return slices
+
+
+DEVICE_SLICES = _field_slices(DEVICE_FIELDS)
+_MAC = DEVICE_SLICES['mac']
+_ADDR_TYPE = DEVICE_SLICES['addr_type'].start
+_ADV_TYPE = DEVICE_SLICES['adv_type'].start
+_RSSI = DEVICE_SLICES['rssi'].start
+_DATA_LEN = DEVICE_SLICES['data_len'].start
+_DATA = DEVICE_SLICES['data']
+_DATA_MAX = _DATA.stop - _DATA.start
+_N_ADV = DEVICE_SLICES['n_adv'].start
+
+
+def _numpy_field(name, code):
+    """Structured dtype entry for one DEVICE_FIELDS struct code"""
+    if code.endswith('s'):
+        return (name, 'u1', (int(code[:-1]),))
+    return (name, {'B': 'u1', 'b': 'i1'}[code])
+
+
+if np is not None:
+    # Built from DEVICE_FIELDS, so it matches DEVICE_STRUCT byte for byte (42 bytes, packed)
+    DEVICE_DTYPE = np.dtype([_numpy_field(name, code) for name, code in DEVICE_FIELDS])
+    _MAC_SHIFTS = np.arange(40, -1, -8, dtype=np.uint64)
+else:
+    DEVICE_DTYPE = None
+
+
+class BLEDevice:
+    """Device record backed by its raw DEVICE_STRUCT slice of the frame
+
+    Numeric fields are read straight from the slice at their DEVICE_FIELDS
+    offsets; the MAC string and hex payload are only formatted on first
+    access and then cached. Supports
+    device['field'] lookups so it can stand in for the old per-device dicts.
+    """
+    __slots__ = ('raw', '_mac', '_data_hex')
+
+    FIELDS = tuple(name for name, _ in DEVICE_FIELDS)
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._mac = None
+        self._data_hex = None
+
+    @property
+    def mac(self):
+        if self._mac is None:
+            self._mac = self.raw[_MAC].hex(':').upper()
+        return self._mac
+
+    @property
+    def mac_bytes(self):
+        return bytes(self.raw[_MAC])
+
+    @property
+    def mac_int(self):
+        """MAC address as a 48-bit integer"""
+        return int.from_bytes(self.raw[_MAC], 'big')
+
+    @property
+    def addr_type(self):
+        return self.raw[_ADDR_TYPE]
+
+    @property
+    def adv_type(self):
+        return self.raw[_ADV_TYPE]
+
+    @property
+    def rssi(self):
+        # Firmware sends |RSSI| for values <= 127, so force the sign
+        rssi_byte = self.raw[_RSSI]
+        return -(256 - rssi_byte) if rssi_byte > 127 else -rssi_byte
+
+    @property
+    def data_len(self):
+        return self.raw[_DATA_LEN]
+
+    @property
+    def data(self):
+        return bytes(self.raw[_DATA])
+
+    @property
+    def payload(self):
+        """Advertisement data trimmed to data_len"""
+        return bytes(self.raw[_DATA.start:_DATA.start + min(self.raw[_DATA_LEN], _DATA_MAX)])
+
+    @property
+    def data_hex(self):
+        if self._data_hex is None:
+            self._data_hex = self.raw[_DATA].hex()
+        return self._data_hex
+
+    @property
+    def n_adv(self):
+        return self.raw[_N_ADV]
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def keys(self):
+        return self.FIELDS
+
+    def to_dict(self):
+        """Plain dict with the same fields as the original device records"""
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return f"BLEDevice(mac={self.mac}, rssi={self.rssi}, n_adv={self.n_adv})"
+
+
+def frame_rssi(frame):
+    """Signed RSSI (dBm) of every device in a structured frame"""
+    # Firmware sends |RSSI| for values <= 127, so force the sign
+    return -np.abs(frame['rssi'].astype(np.int16))
+
+
+def frame_mac_u64(frame):
+    """MAC addresses of a structured frame packed into 48-bit integers"""
+    return (frame['mac'].astype(np.uint64) << _MAC_SHIFTS).sum(axis=1, dtype=np.uint64)
+
+
+def frame_macs(frame):
+    """MAC addresses of a structured frame as 'AA:BB:...' strings"""
+    return [bytes(mac).hex(':').upper() for mac in frame['mac']]
+
 
 class UARTReceiver:
-    def __init__(self, port='COM21', baudrate=115200):
-        """Initialize UART receiver with updated buffer format"""
-        self.serial = serial.Serial(port, baudrate)
+    def __init__(self, port='COM21', baudrate=115200, frame_format='dict', capture_path=None,
+                 n_mac_bytes=2):
+        """Initialize UART receiver with updated buffer format
+
+        port may also be an already open serial-like object (e.g. a
+        capture.ReplaySource). With capture_path, every raw byte read from
+        the port is appended to that capture segment file. n_mac_bytes is
+        the width of the header's n_mac field: 2 for the current firmware
+        (main.c), 1 for firmware sending the older 8-byte header.
+        """
+        if n_mac_bytes not in (1, 2):
+            raise ValueError(f"n_mac_bytes must be 1 or 2, not {n_mac_bytes}")
+        if frame_format not in FRAME_FORMATS:
+            raise ValueError(f"Unknown frame format: {frame_format}")
+        if frame_format == 'numpy' and np is None:
+            raise ImportError("frame_format='numpy' requires numpy")
+        self.frame_format = frame_format
+
+        if hasattr(port, 'read'):
+            self.serial = port
+        else:
+            self.serial = serial.Serial(port, baudrate)
         self.sequence = 0
+        self.loss = FrameLossTracker()
+
+        self.capture = CaptureWriter(capture_path) if capture_path else None
+        if self.capture:
+            self.serial = CaptureTap(self.serial, self.capture, STREAM_BLE)
         
         # Header format constants
         self.HEADER_MAGIC = b'\x55\x55\x55\x55'
@@ -14,23 +198,42 @@ class UARTReceiver:
             'header': 4,       # Magic bytes
             'sequence': 1,     # Sequence number
             'n_adv_raw': 2,    # Total advertisements counter (now uint16_t)
-            'n_mac': 2,        # Number of unique MACs (now uint16_t)
+            'n_mac': n_mac_bytes,  # Number of unique MACs (uint16_t in main.c)
         }
         
-        # Device data format
-        self.DEVICE_FORMAT = {
-            'mac': 6,         # MAC address
-            'addr_type': 1,   # Address type
-            'adv_type': 1,    # Advertisement type
-            'rssi': 1,        # RSSI value
-            'data_len': 1,    # Data length
-            'data': 31,       # Advertisement data
-            'n_adv': 1,       # Number of advertisements from this MAC
-        }
+        # Device data format: bytes per field, from DEVICE_FIELDS
+        self.DEVICE_FORMAT = {name: field.stop - field.start for name, field in DEVICE_SLICES.items()}
         
-        self.HEADER_LENGTH = sum(self.HEADER_FORMAT.values())  # Now 9 bytes
-        self.DEVICE_LENGTH = sum(self.DEVICE_FORMAT.values())  # Still 42 bytes
         self.MAX_DEVICES = 1024  # Updated to match main.c
+        self._compile_formats()
+
+        # Frame scanner state: unconsumed bytes and resync accounting
+        self._rx = bytearray()
+        self._rx_needed = 1
+        self._rx_in_frame = False
+        self._rx_last_seq = None
+        self._rx_stalled_since = None
+        # Seconds without a byte before a partly received frame is abandoned
+        self.frame_timeout = 1.0
+        self.resync_skipped = 0
+        self.invalid_headers = 0
+        self.truncated_frames = 0
+
+    def _compile_formats(self):
+        """Derive lengths and precompiled structs from the format tables"""
+        self.HEADER_LENGTH = sum(self.HEADER_FORMAT.values())  # 9 bytes with main.c
+        self.DEVICE_LENGTH = sum(self.DEVICE_FORMAT.values())  # Still 42 bytes
+
+        # magic, sequence, n_adv_raw, n_mac (field widths follow HEADER_FORMAT)
+        widths = {1: 'B', 2: 'H', 4: 'I'}
+        self.HEADER_STRUCT = struct.Struct('<4s' + ''.join(
+            widths[self.HEADER_FORMAT[field]] for field in ('sequence', 'n_adv_raw', 'n_mac')))
+
+        # BLEDevice and DEVICE_DTYPE decode records with the DEVICE_FIELDS layout
+        self.DEVICE_STRUCT = DEVICE_STRUCT
+        if self.DEVICE_STRUCT.size != self.DEVICE_LENGTH:
+            raise ValueError(f"DEVICE_FORMAT ({self.DEVICE_LENGTH} bytes) does not match "
+                             f"DEVICE_STRUCT ({self.DEVICE_STRUCT.size} bytes)")
 
     def _check_header(self, data):
         """Verify message header"""
@@ -39,26 +242,16 @@ class UARTReceiver:
     def _parse_header(self, data):
         """Parse buffer header with new format"""
         try:
-            offset = 0
-            header = {}
-            
             # Verify magic header
             if not self._check_header(data):
                 return None
-            offset += 4
-
-            # Parse sequence number (1 byte)
-            header['sequence'] = data[offset]
-            offset += 1
-
-            # Parse n_adv_raw (2 bytes, uint16_t)
-            header['n_adv_raw'] = struct.unpack('<H', data[offset:offset+2])[0]
-            offset += 2
 
-            # Parse n_mac (2 bytes, uint16_t)
-            header['n_mac'] = struct.unpack('<H', data[offset:offset+2])[0]
-            
-            return header
+            _, sequence, n_adv_raw, n_mac = self.HEADER_STRUCT.unpack_from(data)
+            return {
+                'sequence': sequence,
+                'n_adv_raw': n_adv_raw,
+                'n_mac': n_mac,
+            }
 
         except Exception as e:
             print(f"Error parsing header: {e}")
@@ -69,51 +262,174 @@ class UARTReceiver:
         try:
             if len(data) != self.DEVICE_LENGTH:
                 print(f"Invalid device data length: {len(data)} != {self.DEVICE_LENGTH}")
+                self.loss.record_short_read(self.DEVICE_LENGTH, len(data))
                 return None
-                
-            offset = 0
-            device = {}
-            
-            # Parse MAC address
-            device['mac'] = ':'.join(f'{b:02X}' for b in data[offset:offset+6])
-            offset += 6
-
-            # Parse address type
-            device['addr_type'] = data[offset]
-            offset += 1
-
-            # Parse advertisement type
-            device['adv_type'] = data[offset]
-            offset += 1
-
-            # Parse RSSI (signed byte)
-            rssi_byte = data[offset]
-            device['rssi'] = -(256 - rssi_byte) if rssi_byte > 127 else -rssi_byte
-            offset += 1
-
-            # Parse data length
-            device['data_len'] = data[offset]
-            offset += 1
-
-            # Parse advertisement data
-            device['data'] = data[offset:offset+31]
-            offset += 31
-
-            # Parse number of advertisements
-            device['n_adv'] = data[offset]
-            
-            return device
+
+            return BLEDevice(memoryview(bytes(data)))
 
         except Exception as e:
             print(f"Error parsing device data: {e}")
             return None
 
+    def _decode_records(self, payload):
+        """Split a frame payload into BLEDevice records without copying it"""
+        view = memoryview(payload)
+        step = self.DEVICE_LENGTH
+        return [BLEDevice(view[i:i + step]) for i in range(0, len(view) - step + 1, step)]
+
+    def _decode_devices(self, payload):
+        """Decode a frame payload in the configured frame format"""
+        if self.frame_format == 'numpy':
+            # Zero-copy view over the payload, one row per device
+            return np.frombuffer(payload, dtype=DEVICE_DTYPE)
+        return self._decode_records(payload)
+
+    def _device_list(self, devices):
+        """Return devices as a list of BLEDevice records whatever the frame format"""
+        if self.frame_format == 'numpy':
+            return self._decode_records(devices.tobytes())
+        return devices
+
+    def _rx_skip(self, count):
+        """Drop bytes from the scanner buffer while resynchronizing"""
+        del self._rx[:count]
+        self.resync_skipped += count
+
+    def _rx_feed(self, data):
+        """Append received bytes to the frame scanner buffer"""
+        self._rx += data
+
+    def _rx_pop_frame(self):
+        """Extract the next complete frame from the scanner buffer
+
+        Returns (header, payload) or None when more bytes are needed, in which
+        case _rx_needed holds how many bytes are still missing. A frame is
+        only emitted when the bytes buffered after it start a new header.
+        """
+        rx = self._rx
+        while True:
+            start = rx.find(self.HEADER_MAGIC)
+            if start < 0:
+                # Keep the tail in case it holds the start of a magic
+                self._rx_skip(max(0, len(rx) - len(self.HEADER_MAGIC) + 1))
+                self._rx_needed = 1
+                return None
+            if start:
+                self._rx_skip(start)
+
+            # A run of 0x55 longer than the magic (trailing garbage, or a
+            # sequence number of 0x55) leaves several candidate frame starts
+            run = len(self.HEADER_MAGIC)
+            while run < len(rx) and rx[run] == 0x55:
+                run += 1
+            if run == len(rx) or len(rx) < run - len(self.HEADER_MAGIC) + self.HEADER_LENGTH:
+                self._rx_needed = max(1, run - len(self.HEADER_MAGIC) + self.HEADER_LENGTH - len(rx))
+                return None
+
+            offset, header = self._pick_header(run - len(self.HEADER_MAGIC))
+            if not header:
+                # False magic (e.g. a run of 0x55 in device data), slide past it
+                self.invalid_headers += 1
+                self._rx_skip(1)
+                continue
+            if offset:
+                self._rx_skip(offset)
+
+            end = self.HEADER_LENGTH + header['n_mac'] * self.DEVICE_LENGTH
+            if len(rx) < end:
+                self._rx_needed = end - len(rx)
+                self._rx_in_frame = True
+                return None
+
+            if not self.HEADER_MAGIC.startswith(rx[end:end + len(self.HEADER_MAGIC)]):
+                # The bytes after n_mac devices are not the next header: this
+                # frame was cut short and the next one started inside it
+                following = rx.find(self.HEADER_MAGIC, len(self.HEADER_MAGIC))
+                if 0 < following < end:
+                    self.loss.record_short_read(end, following)
+                self.truncated_frames += 1
+                self._rx_skip(len(self.HEADER_MAGIC))
+                continue
+
+            payload = bytes(rx[self.HEADER_LENGTH:end])
+            del rx[:end]
+            self._rx_needed = 1
+            self._rx_in_frame = False
+            self._rx_last_seq = header['sequence']
+            return header, payload
+
+    def _pick_header(self, last_offset):
+        """Choose the most likely frame start among offsets 0..last_offset
+
+        Prefers the header continuing the last sequence number, then the
+        latest offset passing the strict check, then any plausible one.
+        """
+        candidates = []
+        for offset in range(last_offset, -1, -1):
+            header = self._parse_header(self._rx[offset:offset + self.HEADER_LENGTH])
+            if self._plausible_header(header):
+                candidates.append((offset, header))
+        if not candidates:
+            return 0, None
+        if len(candidates) > 1:
+            if self._rx_last_seq is not None:
+                expected = (self._rx_last_seq + 1) % 256
+                for offset, header in candidates:
+                    if header['sequence'] == expected:
+                        return offset, header
+            for offset, header in candidates:
+                if self._plausible_header(header, strict=True):
+                    return offset, header
+        return candidates[0]
+
+    def _plausible_header(self, header, strict=False):
+        """Sanity check a parsed header before trusting its n_mac"""
+        if not header or header['n_mac'] > self.MAX_DEVICES:
+            return False
+        # Every MAC contributes at least one advertisement
+        return not strict or header['n_adv_raw'] >= header['n_mac']
+
+    def _rx_fill(self):
+        """Read everything the port has buffered, or block for what the scanner needs"""
+        data = self.serial.read(max(self.serial.in_waiting, self._rx_needed))
+        if data or not self._rx_in_frame:
+            self._rx_stalled_since = None
+        elif self._rx_stalled_since is None:
+            # A read timeout mid-frame is only a pause until frame_timeout passes
+            self._rx_stalled_since = time.monotonic()
+        elif time.monotonic() - self._rx_stalled_since >= self.frame_timeout:
+            self._rx_abandon()
+        self._rx += data
+        return len(data)
+
+    def _rx_abandon(self):
+        """Give up on a frame whose remaining bytes stopped arriving and resync"""
+        self.loss.record_short_read(len(self._rx) + self._rx_needed, len(self._rx))
+        self._rx_skip(len(self.HEADER_MAGIC))
+        self._rx_needed = 1
+        self._rx_in_frame = False
+        self._rx_stalled_since = None
+
+    def _next_frame(self):
+        """Return the next complete (header, payload) frame, or None on read timeout"""
+        while True:
+            frame = self._rx_pop_frame()
+            if frame:
+                return frame
+            if not self._rx_fill():
+                return None
+
     def _check_sequence(self, received_seq):
-        """Verify message sequence with improved logging"""
-        if received_seq != (self.sequence + 1) % 256:
-            print(f"Sequence mismatch! Expected: {(self.sequence + 1) % 256}, "
-                  f"Received: {received_seq}")
-        self.sequence = received_seq
+        """Verify message sequence and feed the frame loss tracker
+
+        Returns (kind, count) as reported by FrameLossTracker.observe.
+        """
+        kind, lost = self.loss.observe(received_seq)
+        if kind not in ('first', 'ok'):
+            print(f"Sequence {kind}! Expected: {(self.sequence + 1) % 256}, "
+                  f"Received: {received_seq}, Lost: {lost}")
+        self.sequence = self.loss.last_sequence
+        return kind, lost
 
     def receive_messages(self, duration=None):
         """Receive and process messages with support for larger buffers"""
@@ -127,43 +443,31 @@ class UARTReceiver:
                     print(f"Duration {duration}s reached. Stopping.")
                     break
 
-                # Search for header
-                while True:
-                    if self.serial.read() == b'\x55':
-                        potential_header = b'\x55' + self.serial.read(3)
-                        if potential_header == self.HEADER_MAGIC:
-                            break
-
-                # Read and parse header
-                header_data = potential_header + self.serial.read(self.HEADER_LENGTH - 4)
-                header = self._parse_header(header_data)
-                
-                if not header:
+                frame = self._next_frame()
+                if not frame:
                     continue
+                header, payload = frame
+                self._check_sequence(header['sequence'])
 
                 print("\n=== Buffer Received ===")
                 print(f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}")
                 print(f"Sequence: {header['sequence']}")
                 print(f"Total Advertisements: {header['n_adv_raw']}")
                 print(f"Number of MACs: {header['n_mac']}")
+                print(f"Resync skipped: {self.resync_skipped} bytes "
+                      f"(truncated frames: {self.truncated_frames})")
+                print(f"Frames lost: {self.loss.lost} (duplicates: {self.loss.duplicates}, "
+                      f"reordered: {self.loss.reordered}, short reads: {self.loss.short_reads})")
                 print("====================\n")
 
-                # Validate n_mac
-                if header['n_mac'] > self.MAX_DEVICES:
-                    print(f"Warning: n_mac ({header['n_mac']}) exceeds MAX_DEVICES ({self.MAX_DEVICES})")
-                    continue
-
-                # Read and parse each device
-                for i in range(header['n_mac']):
-                    device_data = self.serial.read(self.DEVICE_LENGTH)
-                    device = self._parse_device(device_data)
-                    
-                    if device:
-                        print(f"Device {i+1}:")
-                        print(f"  MAC: {device['mac']}")
-                        print(f"  RSSI: {device['rssi']} dBm")
-                        print(f"  Advertisements: {device['n_adv']}")
-                        print("--------------------")
+                # Decode all devices of the frame in one pass
+                devices = self._device_list(self._decode_devices(payload))
+                for i, device in enumerate(devices):
+                    print(f"Device {i+1}:")
+                    print(f"  MAC: {device['mac']}")
+                    print(f"  RSSI: {device['rssi']} dBm")
+                    print(f"  Advertisements: {device['n_adv']}")
+                    print("--------------------")
 
             except serial.SerialException as e:
                 print(f"Serial communication error: {e}")
@@ -179,6 +483,8 @@ class UARTReceiver:
         """Close serial connection"""
         if self.serial.is_open:
             self.serial.close()
+        if self.capture:
+            self.capture.close()
 
 if __name__ == "__main__":
     try: